@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+
+Find the fastest block size, warp memory, GDAL cache and GDAL_NUM_THREADS for this machine by running short
+trials of the real kernels on a sample of a LiDAR quad, and save them as the profile process_tiles.py applies:
+
+  python autotune.py SSNERR_LIDAR be43124c2 --sample-size 2048
+"""
+
+# Import core modules
+import sys
+import os
+import argparse
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import HMT specific packages
+from hmt_processor import autotune as hmt_autotune
+from hmt_processor import runtime as hmt_runtime
+from hmt_processor import formats as hmt_formats
+import process_tiles
+
+# get a reference to the path that holds this file
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Log file of the auto-tuner
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'autotune.log')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Tune block size, warp memory, GDAL cache and threads on a sample quad.")
+  parser.add_argument('data_block', help="LIDAR data block, e.g. SSNERR_LIDAR")
+  parser.add_argument('quad', help="quad of the block to sample, e.g. be43124c2")
+  parser.add_argument('--sample-size', type=int, default=2048, help="width / height of the sample in cells (default 2048)")
+  parser.add_argument('--memory-mb', type=int, default=None, help="keep cache and warp memory within this budget")
+  parser.add_argument('--repeat', type=int, default=1, help="runs per trial; the fastest counts")
+  parser.add_argument('--data-dir', default=None, help="data directory (default PROJECT_DIR/data)")
+  parser.add_argument('--output', default=None, help="profile path (default HMT_PROFILE or hmt_profile.json)")
+  args = parser.parse_args(argv)
+  
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
+  lidar_dir, tidaldatums_dir, tidalincriment_dir = process_tiles.data_paths(args.data_dir)
+  inputs = {
+    'quad': os.path.join(lidar_dir, args.data_block, 'raw', args.quad),
+    'tss': hmt_formats.find_raster(tidaldatums_dir, "tss_merged_epsg2992_filled_invdist"),
+    'mhhw': hmt_formats.find_raster(tidaldatums_dir, "mhhw_merged_epsg2992_filled_invdist"),
+    'hmt_navd88': os.path.join(tidalincriment_dir, 'dlcd_hmt_mhhw_nearest.img'),
+  }
+  settings = hmt_autotune.tune(inputs, sample_size=args.sample_size, memory_mb=args.memory_mb, repeat=args.repeat, path=args.output)
+  for key, value in settings.items():
+    print("{0}: {1}".format(key, value))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Output format benchmark: size and throughput of each output format (see hmt_processor/formats.py) on our data.
+
+An input raster (a LiDAR quad, ingested or raw, by default a synthetic one) is copied block by block into every
+format twice: as the elevations themselves and as the 0/1 binary raster HMT thresholding produces (written as a
+mask). Reported per format and kind: size on disk including sidecars and overviews, compression ratio against the
+uncompressed cells, and write and read throughput in MB/s of uncompressed cells (reads are of a freshly opened
+file, so they come from the OS page cache rather than the disk):
+
+  python benchmarks/bench_formats.py --input data/LIDAR/Tillamook/raw/45123e8 --repeat 3
+  python benchmarks/bench_formats.py --size 4000 --formats HFA GTiff-DEFLATE GTiff-ZSTD
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import collections
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+# get a reference to the path that holds the project
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import synthetic
+from bench_kernels import BENCHMARK_OUTPUT_DIR, environment
+from hmt_processor import formats as hmt_formats
+from hmt_processor import runtime as hmt_runtime
+
+# What the binary rasters are thresholded at (feet NAVD88, about the HMT of the synthetic data)
+BINARY_THRESHOLD = 9.5
+
+
+def block_offsets(cols, rows, blocksize):
+  """ (j, i, numCols, numRows) of every block """
+  for i in range(0, rows, blocksize[1]):
+    for j in range(0, cols, blocksize[0]):
+      yield j, i, min(blocksize[0], cols - j), min(blocksize[1], rows - i)
+
+
+def write_copy(input_path, output_path, driver, kind, blocksize):
+  """ Copy the input block by block into a format as kind ('elevation' or 'binary'); returns the output datatype """
+  input_fh = gdal.Open(input_path, gdal.GA_ReadOnly)
+  input_band = input_fh.GetRasterBand(1)
+  nodata = input_band.GetNoDataValue()
+  cols = input_fh.RasterXSize
+  rows = input_fh.RasterYSize
+  datatype = gdal.GDT_Byte if kind == 'binary' else input_band.DataType
+  output_fh = hmt_formats.create(output_path, cols, rows, 1, datatype, driver=driver, mask=(kind == 'binary'), blocksize=blocksize)
+  output_fh.SetGeoTransform(input_fh.GetGeoTransform())
+  output_fh.SetProjection(input_fh.GetProjection())
+  output_band = output_fh.GetRasterBand(1)
+  if kind == 'binary':
+    output_band.SetNoDataValue(0)
+  elif nodata is not None:
+    output_band.SetNoDataValue(nodata)
+  for j, i, numCols, numRows in block_offsets(cols, rows, blocksize):
+    block_np = input_band.ReadAsArray(j, i, numCols, numRows)
+    if kind == 'binary':
+      block_np = np.less_equal(block_np, BINARY_THRESHOLD) & (block_np != nodata)
+    output_band.WriteArray(block_np, j, i)
+  hmt_formats.build_overviews(output_fh, [2,4,8,16,32,64,128])
+  output_band = None
+  output_fh = None  # closing flushes and compresses the last tiles, so it is part of the write time
+  input_fh = None
+  return datatype
+
+
+def read_all(path, blocksize):
+  """ Read every block of a raster; returns the number of cells """
+  raster_fh = gdal.Open(path, gdal.GA_ReadOnly)
+  raster_band = raster_fh.GetRasterBand(1)
+  cells = 0
+  for j, i, numCols, numRows in block_offsets(raster_fh.RasterXSize, raster_fh.RasterYSize, blocksize):
+    cells += raster_band.ReadAsArray(j, i, numCols, numRows).size
+  raster_band = None
+  raster_fh = None
+  return cells
+
+
+def bench_format(input_path, workdir, driver, kind, blocksize, repeat=3):
+  """ Time writing and reading one format repeat times; returns the summary dict for the JSON report """
+  output_path = hmt_formats.raster_path(workdir, "bench_{0}_{1}".format(kind, driver))
+  write_seconds = list()
+  read_seconds = list()
+  for run_n in range(repeat):
+    if os.path.exists(output_path):
+      hmt_formats.delete(output_path)
+    start = time.time()
+    datatype = write_copy(input_path, output_path, driver, kind, blocksize)
+    write_seconds.append(time.time() - start)
+    start = time.time()
+    cells = read_all(output_path, blocksize)
+    read_seconds.append(time.time() - start)
+  
+  cell_mb = cells*gdal.GetDataTypeSize(datatype)/8.0/(1024*1024)
+  size_mb = hmt_formats.dataset_bytes(output_path)/(1024.0*1024.0)
+  hmt_formats.delete(output_path)
+  return collections.OrderedDict([
+    ('format', driver),
+    ('kind', kind),
+    ('creation_options', hmt_formats.creation_options(driver, datatype, mask=(kind == 'binary'), blocksize=blocksize)),
+    ('cells', cells),
+    ('repeat', repeat),
+    ('size_mb', size_mb),
+    ('compression_ratio', cell_mb/size_mb if size_mb > 0 else None),
+    ('write_seconds_min', min(write_seconds)),
+    ('read_seconds_min', min(read_seconds)),
+    ('write_mb_per_second', cell_mb/min(write_seconds) if min(write_seconds) > 0 else None),
+    ('read_mb_per_second', cell_mb/min(read_seconds) if min(read_seconds) > 0 else None),
+  ])
+
+
+def print_results(results):
+  print("{0:<16} {1:<10} {2:>10} {3:>7} {4:>10} {5:>10}".format('format', 'kind', 'size MB', 'ratio', 'write MB/s', 'read MB/s'))
+  for result in results:
+    print("{0:<16} {1:<10} {2:>10.1f} {3:>7.2f} {4:>10.1f} {5:>10.1f}".format(result['format'], result['kind'], result['size_mb'],
+          result['compression_ratio'] or 0, result['write_mb_per_second'] or 0, result['read_mb_per_second'] or 0))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the output formats: size and read / write throughput.")
+  parser.add_argument('--input', default=None, help="raster to copy (default a synthetic LiDAR quad)")
+  parser.add_argument('--size', type=int, default=3000, help="synthetic quad width / height in cells (default 3000)")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--formats', nargs='*', default=None, choices=list(hmt_formats.PROFILES.keys()), help="formats to compare (default all this GDAL supports)")
+  parser.add_argument('--blocksize', type=int, default=512, help="block size of the copy (default 512)")
+  parser.add_argument('--repeat', type=int, default=3, help="runs per format; the fastest is reported")
+  parser.add_argument('--output', default=None, help="JSON result path (default output/benchmarks/formats_<timestamp>.json)")
+  parser.add_argument('--workdir', default=None, help="where the copies are written (default a temp dir that is removed)")
+  args = parser.parse_args(argv)
+  
+  hmt_runtime.configure()
+  logger.setLevel(logging.WARNING)
+  formats = args.formats or list(hmt_formats.PROFILES.keys())
+  for driver in [driver for driver in formats if not hmt_formats.available(driver)]:
+    print("skipping {0}: not supported by this GDAL".format(driver))
+  formats = [driver for driver in formats if hmt_formats.available(driver)]
+  
+  workdir = args.workdir or tempfile.mkdtemp(prefix='hmt_bench_')
+  blocksize = (args.blocksize, args.blocksize)
+  try:
+    input_path = args.input
+    if input_path is None:
+      input_path = synthetic.make_lidar_quad(os.path.join(workdir, 'synthetic_quad.img'), args.size, args.size, seed=args.seed)
+    results = [bench_format(input_path, workdir, driver, kind, blocksize, repeat=args.repeat) for kind in ('elevation', 'binary') for driver in formats]
+  finally:
+    if args.workdir is None:
+      shutil.rmtree(workdir, ignore_errors=True)
+  
+  report = collections.OrderedDict([
+    ('environment', environment()),
+    ('parameters', collections.OrderedDict([('input', args.input), ('size', args.size), ('seed', args.seed), ('blocksize', args.blocksize), ('repeat', args.repeat)])),
+    ('results', results),
+  ])
+  output_path = args.output or os.path.join(BENCHMARK_OUTPUT_DIR, "formats_{0}.json".format(time.strftime('%Y%m%d-%H%M%S')))
+  if not os.path.exists(os.path.dirname(output_path)):
+    os.makedirs(os.path.dirname(output_path))
+  with open(output_path, 'w') as report_fh:
+    json.dump(report, report_fh, indent=2)
+  
+  print_results(results)
+  print("results written to {0}".format(output_path))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Micro-benchmarks of the raster kernels on synthetic data.
+
+Each kernel runs in its own process so its peak resident memory is not polluted by the others. Results
+(seconds, pixels/second, peak RSS) are written as JSON so runs can be compared:
+
+  python benchmarks/bench_kernels.py --size 4000 --repeat 3
+  python benchmarks/bench_kernels.py --compare output/benchmarks/kernels_A.json output/benchmarks/kernels_B.json
+
+--allocations (Python 3) also traces the Python / numpy heap of each kernel with tracemalloc and reports its
+peak, which shows how many block-sized temporaries each block loop holds at once. Tracing slows the kernels, so
+compare timings of runs made without it.
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import resource
+import collections
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+# get a reference to the path that holds the project
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import synthetic
+
+# Where results go by default
+BENCHMARK_OUTPUT_DIR = os.path.join(PROJECT_DIR, 'output', 'benchmarks')
+
+# name -> function(workdir, inputs) returning the number of pixels processed
+KERNELS = collections.OrderedDict()
+
+
+def kernel(name):
+  """ Register a benchmark kernel """
+  def register(function):
+    KERNELS[name] = function
+    return function
+  return register
+
+
+def raster_pixels(path):
+  raster_fh = gdal.Open(path, gdal.GA_ReadOnly)
+  pixels = raster_fh.RasterXSize*raster_fh.RasterYSize
+  raster_fh = None
+  return pixels
+
+
+def hmt_modules():
+  """ Import the modules under test and configure GDAL the way the scripts do """
+  from hmt_processor import processors as hmt
+  from hmt_processor import runtime as hmt_runtime
+  import fix_and_interpolate_vdatum_grids as vdatum
+  hmt_runtime.configure()
+  return hmt, vdatum
+
+
+@kernel('reproject_dataset_to_quad')
+def bench_reproject(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  hmt.reproject_dataset_to_quad(inputs['tss'], inputs['lidar'], os.path.join(workdir, 'bench_tss_quad.img'), respample_method=gdal.GRA_Bilinear)
+  return raster_pixels(inputs['lidar'])
+
+
+@kernel('convert_navd88_to_tidal')
+def bench_convert(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  hmt.convert_navd88_to_tidal(inputs['lidar'], inputs['tss_quad'], inputs['mhhw_quad'], os.path.join(workdir, 'bench_lidar_in_mhhw.img'))
+  return raster_pixels(inputs['lidar'])
+
+
+@kernel('convert_navd88_to_tidal_sampled')
+def bench_convert_sampled(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  hmt.convert_navd88_to_tidal_sampled(inputs['lidar'], inputs['tss'], inputs['mhhw'], os.path.join(workdir, 'bench_lidar_in_mhhw_sampled.img'))
+  return raster_pixels(inputs['lidar'])
+
+
+@kernel('hmt_tile_binary_processor')
+def bench_binary(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  hmt.hmt_tile_binary_processor(inputs['lidar'], 9.5, os.path.join(workdir, 'bench_binary.img'))
+  return raster_pixels(inputs['lidar'])
+
+
+@kernel('hmt_tile_binary_processor_griddedHMT')
+def bench_binary_gridded(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  hmt.hmt_tile_binary_processor_griddedHMT(inputs['lidar'], inputs['hmt_navd88_quad'], os.path.join(workdir, 'bench_binary_gridded.img'))
+  return raster_pixels(inputs['lidar'])
+
+
+@kernel('hmt_tile_binary_processor_sampledHMT')
+def bench_binary_sampled(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  hmt.hmt_tile_binary_processor_sampledHMT(inputs['lidar'], inputs['hmt_navd88'], os.path.join(workdir, 'bench_binary_sampled.img'))
+  return raster_pixels(inputs['lidar'])
+
+
+@kernel('binary_raster_to_vector')
+def bench_polygonize(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  output_vector_path = os.path.join(workdir, 'bench_polygons.shp')
+  if os.path.exists(output_vector_path):
+    from osgeo import ogr
+    ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(output_vector_path)
+  hmt.binary_raster_to_vector(inputs['binary'], output_vector_path)
+  return raster_pixels(inputs['binary'])
+
+
+@kernel('fix_nodata')
+def bench_fix_nodata(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  vdatum.fix_nodata(inputs['mhhw_raw'], os.path.join(workdir, 'bench_mhhw_fixed.img'))
+  return raster_pixels(inputs['mhhw_raw'])
+
+
+@kernel('fill_nodata')
+def bench_fill_nodata(workdir, inputs):
+  hmt, vdatum = hmt_modules()
+  vdatum.fill_nodata(inputs['mhhw_raw'], inputs['mhhw_raw_mask'], os.path.join(workdir, 'bench_mhhw_filled.img'), quiet=True)
+  return raster_pixels(inputs['mhhw_raw'])
+
+
+def prepare_inputs(workdir, size, seed, grid_cellsize):
+  """ Write the synthetic inputs and the intermediates some kernels start from (not timed) """
+  inputs = synthetic.make_quad_inputs(workdir, size, size, seed=seed, grid_cellsize=grid_cellsize)
+  
+  hmt, vdatum = hmt_modules()
+  inputs['tss_quad'] = hmt.reproject_dataset_to_quad(inputs['tss'], inputs['lidar'], os.path.join(workdir, 'tss_quad.img'), respample_method=gdal.GRA_Bilinear)
+  inputs['mhhw_quad'] = hmt.reproject_dataset_to_quad(inputs['mhhw'], inputs['lidar'], os.path.join(workdir, 'mhhw_quad.img'), respample_method=gdal.GRA_Bilinear)
+  inputs['hmt_navd88_quad'] = hmt.reproject_dataset_to_quad(inputs['hmt_navd88'], inputs['lidar'], os.path.join(workdir, 'hmt_navd88_quad.img'), respample_method=gdal.GRA_Bilinear)
+  inputs['binary'] = hmt.hmt_tile_binary_processor(inputs['lidar'], 9.5, os.path.join(workdir, 'binary.img'))
+  inputs['mhhw_raw_mask'] = vdatum.create_nodata_mask(inputs['mhhw_raw'], os.path.join(workdir, 'mhhw_raw_mask.img'))
+  return inputs
+
+
+def max_rss_mb():
+  """ Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on OS X) """
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return max_rss/(1024.0*1024.0)
+  return max_rss/1024.0
+
+
+def cpu_seconds():
+  """ User + system CPU time of this process """
+  times = os.times()
+  return times[0] + times[1]
+
+
+class AllocationTracer(object):
+  """ Peak traced Python / numpy heap of a kernel (tracemalloc, Python 3) """
+  
+  def __init__(self):
+    import tracemalloc
+    self.tracemalloc = tracemalloc
+    self.peak_bytes = 0
+  
+  def start(self):
+    self.tracemalloc.start()
+  
+  def stop(self):
+    self.peak_bytes = self.tracemalloc.get_traced_memory()[1]
+    self.tracemalloc.stop()
+
+
+def _run_kernel_child(name, workdir, inputs, result_queue, allocations=False):
+  """ Time one kernel in a fresh process and report back through result_queue """
+  logger.setLevel(logging.WARNING)
+  tracer = AllocationTracer() if allocations else None
+  baseline_rss_mb = max_rss_mb()
+  cpu_start = cpu_seconds()
+  if tracer is not None: tracer.start()
+  wall_start = time.time()
+  pixels = KERNELS[name](workdir, inputs)
+  wall_seconds = time.time() - wall_start
+  if tracer is not None: tracer.stop()
+  result = {'pixels': pixels, 'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds() - cpu_start,
+            'peak_rss_mb': max_rss_mb(), 'baseline_rss_mb': baseline_rss_mb}
+  if tracer is not None:
+    result['traced_peak_mb'] = tracer.peak_bytes/(1024.0*1024.0)
+  result_queue.put(result)
+
+
+def run_kernel(name, workdir, inputs, repeat=3, allocations=False):
+  """ Run a kernel repeat times, each in its own process; returns the summary dict for the JSON report """
+  runs = list()
+  for run_n in range(repeat):
+    result_queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_kernel_child, args=(name, workdir, inputs, result_queue, allocations))
+    child.start()
+    result = result_queue.get()
+    child.join()
+    runs.append(result)
+  
+  wall = sorted(run['wall_seconds'] for run in runs)
+  pixels = runs[0]['pixels']
+  summary = collections.OrderedDict([
+    ('kernel', name),
+    ('pixels', pixels),
+    ('repeat', repeat),
+    ('wall_seconds_min', wall[0]),
+    ('wall_seconds_median', wall[len(wall)//2]),
+    ('cpu_seconds_median', sorted(run['cpu_seconds'] for run in runs)[len(runs)//2]),
+    ('pixels_per_second', pixels/wall[0] if wall[0] > 0 else None),
+    ('peak_rss_mb', max(run['peak_rss_mb'] for run in runs)),
+    ('peak_rss_delta_mb', max(run['peak_rss_mb'] - run['baseline_rss_mb'] for run in runs)),
+  ])
+  if allocations:
+    summary['traced_peak_mb'] = max(run['traced_peak_mb'] for run in runs)
+  return summary
+
+
+def environment():
+  """ What the numbers were measured on """
+  return collections.OrderedDict([
+    ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+    ('host', platform.node()),
+    ('platform', platform.platform()),
+    ('python', platform.python_version()),
+    ('cpus', multiprocessing.cpu_count()),
+    ('gdal', gdal.__version__),
+    ('numpy', np.__version__),
+  ])
+
+
+def print_results(results):
+  print("{0:<40} {1:>12} {2:>10} {3:>14} {4:>10}".format('kernel', 'pixels', 'seconds', 'Mpixels/s', 'peak MB'))
+  for result in results:
+    mpps = (result['pixels_per_second'] or 0)/1e6
+    print("{0:<40} {1:>12} {2:>10.3f} {3:>14.2f} {4:>10.1f}".format(result['kernel'], result['pixels'], result['wall_seconds_min'], mpps, result['peak_rss_mb']))
+  if any('traced_peak_mb' in result for result in results):
+    print("{0:<40} {1:>16}".format('kernel', 'traced peak MB'))
+    for result in results:
+      print("{0:<40} {1:>16.1f}".format(result['kernel'], result['traced_peak_mb']))
+
+
+def compare(baseline_path, candidate_path):
+  """ Print the speedup of each kernel between two result files """
+  with open(baseline_path) as baseline_fh:
+    baseline = dict((result['kernel'], result) for result in json.load(baseline_fh)['results'])
+  with open(candidate_path) as candidate_fh:
+    candidate = json.load(candidate_fh)['results']
+  print("{0:<40} {1:>10} {2:>10} {3:>9} {4:>12}".format('kernel', 'base s', 'new s', 'speedup', 'peak MB diff'))
+  for result in candidate:
+    base = baseline.get(result['kernel'])
+    if base is None:
+      continue
+    speedup = base['wall_seconds_min']/result['wall_seconds_min'] if result['wall_seconds_min'] > 0 else float('inf')
+    print("{0:<40} {1:>10.3f} {2:>10.3f} {3:>8.2f}x {4:>12.1f}".format(result['kernel'], base['wall_seconds_min'], result['wall_seconds_min'], speedup, result['peak_rss_mb'] - base['peak_rss_mb']))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the HMT raster kernels on synthetic data.")
+  parser.add_argument('--size', type=int, default=3000, help="LiDAR quad width / height in cells (default 3000)")
+  parser.add_argument('--grid-cellsize', type=float, default=300.0, help="cell size of the coarse grids in feet (default 300)")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=3, help="runs per kernel; the fastest is reported")
+  parser.add_argument('--kernels', nargs='*', default=None, choices=list(KERNELS.keys()), help="kernels to run (default all)")
+  parser.add_argument('--output', default=None, help="JSON result path (default output/benchmarks/kernels_<timestamp>.json)")
+  parser.add_argument('--workdir', default=None, help="where synthetic data is written (default a temp dir that is removed)")
+  parser.add_argument('--allocations', action='store_true', help="trace numpy / Python allocations of each kernel (Python 3)")
+  parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'), help="compare two result files and exit")
+  args = parser.parse_args(argv)
+  
+  if args.compare:
+    compare(*args.compare)
+    return 0
+  
+  logger.setLevel(logging.WARNING)
+  workdir = args.workdir or tempfile.mkdtemp(prefix='hmt_bench_')
+  try:
+    inputs = prepare_inputs(workdir, args.size, args.seed, args.grid_cellsize)
+    results = [run_kernel(name, workdir, inputs, repeat=args.repeat, allocations=args.allocations) for name in (args.kernels or KERNELS.keys())]
+  finally:
+    if args.workdir is None:
+      shutil.rmtree(workdir, ignore_errors=True)
+  
+  report = collections.OrderedDict([
+    ('environment', environment()),
+    ('parameters', collections.OrderedDict([('size', args.size), ('grid_cellsize', args.grid_cellsize), ('seed', args.seed), ('repeat', args.repeat), ('allocations', args.allocations)])),
+    ('results', results),
+  ])
+  output_path = args.output or os.path.join(BENCHMARK_OUTPUT_DIR, "kernels_{0}.json".format(time.strftime('%Y%m%d-%H%M%S')))
+  if not os.path.exists(os.path.dirname(output_path)):
+    os.makedirs(os.path.dirname(output_path))
+  with open(output_path, 'w') as report_fh:
+    json.dump(report, report_fh, indent=2)
+  
+  print_results(results)
+  print("results written to {0}".format(output_path))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
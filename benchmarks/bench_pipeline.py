@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+End-to-end scaling benchmark of the quad pipeline on a synthetic estuary block.
+
+For each block configuration (quad count x quad size) the whole chain (warp / convert, binary, polygonize in
+process_tiles.data_processor, then dissolve and tabulate in tabulate_areas.data_area_tabulator) runs once per
+worker count. Each run starts cold: processed rasters, block indexes and shapefiles of the previous run are
+removed. Reported per run: wall time, quads and Mpixels per second, speedup and parallel efficiency relative to
+one worker, and the bottleneck stage (largest summed stage time over all quads):
+
+  python benchmarks/bench_pipeline.py --quads 1 4 16 --size 1500 --workers 1 2 4
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import collections
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# get a reference to the path that holds the project
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import synthetic
+from bench_kernels import BENCHMARK_OUTPUT_DIR, environment
+
+BLOCK_NAME = 'SYN_LIDAR'
+
+
+def pipeline_modules():
+  """ Import the pipeline scripts """
+  import process_tiles
+  import tabulate_areas
+  from hmt_processor import metrics as hmt_metrics
+  return process_tiles, tabulate_areas, hmt_metrics
+
+
+def reset_block(workdir):
+  """ Remove everything a previous run produced so the next run starts cold """
+  block_dir = os.path.join(workdir, 'data', 'LIDAR', BLOCK_NAME)
+  for folder in [os.path.join(block_dir, 'processed'), os.path.join(block_dir, 'shp'), os.path.join(workdir, 'output')]:
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+
+def run_pipeline(workdir, quads, workers, backend=None, same_crs_fast_path=True):
+  """ Run data_processor and the tabulator once; returns (wall seconds, stage records) """
+  process_tiles, tabulate_areas, hmt_metrics = pipeline_modules()
+  reset_block(workdir)
+  timer = hmt_metrics.StageTimer()
+  wall_start = time.time()
+  results = process_tiles.data_processor(BLOCK_NAME, BLOCK_NAME, quads, parallel=workers > 1, workers=workers, backend=backend,
+                                         same_crs_fast_path=same_crs_fast_path, data_dir=os.path.join(workdir, 'data'), metrics_path=None)
+  with timer.stage('tabulate'):
+    tabulate_areas.data_area_tabulator(BLOCK_NAME, "{0}_areas.csv".format(BLOCK_NAME), BLOCK_NAME, quads, project_dir=workdir, metrics_path=None)
+  wall_seconds = time.time() - wall_start
+  records = [record for result in results for record in result['stages']] + timer.records
+  return wall_seconds, records
+
+
+def benchmark_block(quad_count, size, worker_counts, seed=0, grid_cellsize=300.0, backend=None, same_crs_fast_path=True, workdir=None):
+  """ Build one synthetic block and run the pipeline for each worker count; returns the result rows """
+  process_tiles, tabulate_areas, hmt_metrics = pipeline_modules()
+  remove_workdir = workdir is None
+  workdir = workdir or tempfile.mkdtemp(prefix='hmt_bench_pipeline_')
+  try:
+    quads = synthetic.make_estuary_block(os.path.join(workdir, 'data'), BLOCK_NAME, quad_count, size, size, seed=seed, grid_cellsize=grid_cellsize)
+    pixels = quad_count*size*size
+    rows = list()
+    baseline_seconds = None
+    for workers in worker_counts:
+      wall_seconds, records = run_pipeline(workdir, quads, workers, backend=backend, same_crs_fast_path=same_crs_fast_path)
+      if baseline_seconds is None or workers == 1:
+        baseline_seconds, baseline_workers = wall_seconds, workers
+      speedup = baseline_seconds/wall_seconds if wall_seconds > 0 else None
+      stage, stage_seconds = hmt_metrics.bottleneck(records)
+      rows.append(collections.OrderedDict([
+        ('quads', quad_count),
+        ('size', size),
+        ('pixels', pixels),
+        ('workers', workers),
+        ('wall_seconds', wall_seconds),
+        ('quads_per_second', quad_count/wall_seconds if wall_seconds > 0 else None),
+        ('pixels_per_second', pixels/wall_seconds if wall_seconds > 0 else None),
+        ('speedup', speedup),
+        ('efficiency', speedup*baseline_workers/workers if speedup is not None else None),
+        ('bottleneck_stage', stage),
+        ('bottleneck_seconds', stage_seconds),
+        ('stage_seconds', hmt_metrics.stage_totals(records)),
+      ]))
+    return rows
+  finally:
+    if remove_workdir:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_results(results):
+  print("{0:>6} {1:>6} {2:>8} {3:>10} {4:>8} {5:>10} {6:>8} {7:>6}  {8}".format('quads', 'size', 'workers', 'seconds', 'quads/s', 'Mpixels/s', 'speedup', 'eff', 'bottleneck'))
+  for result in results:
+    print("{0:>6} {1:>6} {2:>8} {3:>10.2f} {4:>8.3f} {5:>10.2f} {6:>7.2f}x {7:>6.2f}  {8} ({9:.1f} s)".format(
+      result['quads'], result['size'], result['workers'], result['wall_seconds'], result['quads_per_second'] or 0,
+      (result['pixels_per_second'] or 0)/1e6, result['speedup'] or 0, result['efficiency'] or 0,
+      result['bottleneck_stage'], result['bottleneck_seconds']))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark how the HMT quad pipeline scales with quads, quad size and workers.")
+  parser.add_argument('--quads', type=int, nargs='+', default=[1, 4], help="quad counts of the synthetic blocks (default 1 4)")
+  parser.add_argument('--size', type=int, nargs='+', default=[1000], help="quad width / height in cells (default 1000)")
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="worker counts to sweep (default 1 2 4)")
+  parser.add_argument('--backend', default=None, choices=['serial', 'multiprocessing', 'pp'], help="scheduler backend (default by worker count)")
+  parser.add_argument('--no-fast-path', action='store_true', help="always warp the grids to each quad")
+  parser.add_argument('--grid-cellsize', type=float, default=300.0, help="cell size of the coarse grids in feet (default 300)")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None, help="JSON result path (default output/benchmarks/pipeline_<timestamp>.json)")
+  args = parser.parse_args(argv)
+  
+  pipeline_modules()
+  logger.setLevel(logging.WARNING)
+  results = list()
+  for quad_count in args.quads:
+    for size in args.size:
+      results.extend(benchmark_block(quad_count, size, args.workers, seed=args.seed, grid_cellsize=args.grid_cellsize,
+                                     backend=args.backend, same_crs_fast_path=not args.no_fast_path))
+  
+  report = collections.OrderedDict([
+    ('environment', environment()),
+    ('parameters', collections.OrderedDict([('quads', args.quads), ('size', args.size), ('workers', args.workers), ('backend', args.backend),
+                                            ('same_crs_fast_path', not args.no_fast_path), ('grid_cellsize', args.grid_cellsize), ('seed', args.seed)])),
+    ('results', results),
+  ])
+  output_path = args.output or os.path.join(BENCHMARK_OUTPUT_DIR, "pipeline_{0}.json".format(time.strftime('%Y%m%d-%H%M%S')))
+  if not os.path.exists(os.path.dirname(output_path)):
+    os.makedirs(os.path.dirname(output_path))
+  with open(output_path, 'w') as report_fh:
+    json.dump(report, report_fh, indent=2)
+  
+  print_results(results)
+  print("results written to {0}".format(output_path))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
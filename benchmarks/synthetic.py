@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Seeded synthetic stand-ins for the project's inputs: NAVD88 LiDAR quads (international feet, 3 ft cells),
+coarse VDatum TSS / MHHW grids (meters) and HMT incriment grids (feet), all in EPSG:2992.
+The same seed always produces the same rasters.
+"""
+
+# Import core modules
+import sys
+import os
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+from osgeo import osr
+
+LIDAR_NODATA = -3.4028234663852886e+38
+GRID_NODATA = -9999.0
+
+# A point near Tillamook Bay in EPSG:2992 (international feet)
+DEFAULT_ORIGIN = (350000.0, 1340000.0)
+
+
+def epsg2992_wkt():
+  srs = osr.SpatialReference()
+  srs.ImportFromEPSG(2992)
+  return srs.ExportToWkt()
+
+
+def write_raster(path, array, geotransform, nodata=None, driver="HFA"):
+  """ Write a 2d numpy array to a single band raster """
+  gdal_type = {np.dtype(np.float32): gdal.GDT_Float32, np.dtype(np.float64): gdal.GDT_Float64,
+               np.dtype(np.uint8): gdal.GDT_Byte, np.dtype(np.int32): gdal.GDT_Int32}[array.dtype]
+  output_fh = gdal.GetDriverByName(driver).Create(path, array.shape[1], array.shape[0], 1, gdal_type)
+  output_fh.SetGeoTransform(geotransform)
+  output_fh.SetProjection(epsg2992_wkt())
+  output_band = output_fh.GetRasterBand(1)
+  if nodata is not None:
+    output_band.SetNoDataValue(nodata)
+  output_band.WriteArray(array, 0, 0)
+  output_band = None
+  output_fh = None
+  return path
+
+
+def lidar_surface(cols, rows, seed=0, nodata_fraction=0.15):
+  """
+  A coastal elevation surface in feet: rising from about -5 ft on the ocean (left) side to about 60 ft inland,
+  cut by meandering tidal channels, with noise. The leftmost nodata_fraction of the tile is nodata (open water).
+  """
+  rng = np.random.RandomState(seed)
+  x = np.linspace(0.0, 1.0, cols, dtype=np.float32)[np.newaxis, :]
+  y = np.linspace(0.0, 1.0, rows, dtype=np.float32)[:, np.newaxis]
+  surface = -5.0 + 65.0*x**2
+  for channel in range(3):
+    phase = rng.uniform(0, 2*np.pi)
+    centre = rng.uniform(0.2, 0.8) + 0.1*np.sin(6*np.pi*x + phase)
+    surface = surface - 12.0*np.exp(-((y - centre)/0.02)**2)*(1.0 - x)
+  surface = surface + rng.normal(0.0, 0.5, size=(rows, cols)).astype(np.float32)
+  surface = surface.astype(np.float32)
+  surface[:, :int(cols*nodata_fraction)] = LIDAR_NODATA
+  return surface
+
+
+def coarse_surface(cols, rows, low, high, seed=0, nodata_fraction=0.0):
+  """ A smooth coarse grid varying between low and high, with an optional nodata band along the top """
+  rng = np.random.RandomState(seed)
+  x = np.linspace(0.0, 1.0, cols)[np.newaxis, :]
+  y = np.linspace(0.0, 1.0, rows)[:, np.newaxis]
+  phase = rng.uniform(0, 2*np.pi, size=2)
+  surface = 0.5 + 0.25*np.sin(2*np.pi*x + phase[0]) + 0.25*np.cos(2*np.pi*y + phase[1])
+  surface = (low + (high - low)*surface).astype(np.float32)
+  if nodata_fraction > 0:
+    surface[:int(rows*nodata_fraction), :] = GRID_NODATA
+  return surface
+
+
+def make_lidar_quad(path, cols, rows, origin=DEFAULT_ORIGIN, cellsize=3.0, seed=0, driver="HFA"):
+  """ Write a synthetic LiDAR quad; returns its path """
+  geotransform = (origin[0], cellsize, 0.0, origin[1], 0.0, -cellsize)
+  return write_raster(path, lidar_surface(cols, rows, seed=seed), geotransform, nodata=LIDAR_NODATA, driver=driver)
+
+
+def make_coarse_grid(path, footprint, low, high, cellsize=300.0, seed=0, nodata_fraction=0.0, driver="HFA"):
+  """
+  Write a coarse grid covering footprint (minx, maxx, miny, maxy) with a one cell margin; returns its path.
+  """
+  minx, maxx, miny, maxy = footprint
+  cols = int(np.ceil((maxx - minx)/cellsize)) + 2
+  rows = int(np.ceil((maxy - miny)/cellsize)) + 2
+  geotransform = (minx - cellsize, cellsize, 0.0, maxy + cellsize, 0.0, -cellsize)
+  surface = coarse_surface(cols, rows, low, high, seed=seed, nodata_fraction=nodata_fraction)
+  return write_raster(path, surface, geotransform, nodata=GRID_NODATA, driver=driver)
+
+
+def make_quad_inputs(directory, cols, rows, origin=DEFAULT_ORIGIN, cellsize=3.0, seed=0, grid_footprint=None, grid_cellsize=300.0, driver="HFA", quad_name="synthetic_quad"):
+  """
+  Write a synthetic LiDAR quad and the coarse TSS, MHHW, HMT incriment (MHHW and NAVD88) grids and a raw
+  (unfilled) MHHW grid with a nodata band into directory. The grids cover grid_footprint, the quad by default.
+  Returns a dict of paths.
+  """
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  if grid_footprint is None:
+    grid_footprint = (origin[0], origin[0] + cols*cellsize, origin[1] - rows*cellsize, origin[1])
+  extension = ".img" if driver == "HFA" else ".tif"
+  paths = dict()
+  paths['lidar'] = make_lidar_quad(os.path.join(directory, quad_name + extension), cols, rows, origin=origin, cellsize=cellsize, seed=seed, driver=driver)
+  paths['tss'] = make_coarse_grid(os.path.join(directory, "tss" + extension), grid_footprint, -1.05, -0.85, seed=seed + 1, cellsize=grid_cellsize, driver=driver)
+  paths['mhhw'] = make_coarse_grid(os.path.join(directory, "mhhw" + extension), grid_footprint, 1.05, 1.35, seed=seed + 2, cellsize=grid_cellsize, driver=driver)
+  paths['hmt_mhhw'] = make_coarse_grid(os.path.join(directory, "hmt_mhhw" + extension), grid_footprint, 1.5, 3.0, seed=seed + 3, cellsize=grid_cellsize, driver=driver)
+  paths['hmt_navd88'] = make_coarse_grid(os.path.join(directory, "hmt_navd88" + extension), grid_footprint, 8.0, 11.0, seed=seed + 4, cellsize=grid_cellsize, driver=driver)
+  paths['mhhw_raw'] = make_coarse_grid(os.path.join(directory, "mhhw_raw" + extension), grid_footprint, 1.05, 1.35, seed=seed + 2, cellsize=grid_cellsize, nodata_fraction=0.2, driver=driver)
+  return paths
+
+
+def make_estuary_block(data_dir, block_name, quad_count, cols, rows, origin=DEFAULT_ORIGIN, cellsize=3.0, seed=0, grid_cellsize=300.0):
+  """
+  Write a synthetic estuary block in the layout process_tiles expects under data_dir:
+  LIDAR/<block_name>/raw/<quad> (extensionless GeoTIFF quads on a square-ish grid, like the ESRI grid directories
+  of the real data), empty processed / shp folders, and the statewide TSS / MHHW grids in tidal_datums and HMT
+  incriment grids in hmt_incriment covering the whole block. Returns the list of quad names.
+  """
+  block_dir = os.path.join(data_dir, 'LIDAR', block_name)
+  for folder in [os.path.join(block_dir, 'raw'), os.path.join(block_dir, 'processed'), os.path.join(block_dir, 'shp'),
+                 os.path.join(data_dir, 'tidal_datums'), os.path.join(data_dir, 'hmt_incriment')]:
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+  
+  quads_per_row = int(np.ceil(np.sqrt(quad_count)))
+  quad_width = cols*cellsize
+  quad_height = rows*cellsize
+  quads = list()
+  for quad_n in range(quad_count):
+    quad_row, quad_col = divmod(quad_n, quads_per_row)
+    quad_origin = (origin[0] + quad_col*quad_width, origin[1] - quad_row*quad_height)
+    quad = "syn{0:04d}".format(quad_n)
+    make_lidar_quad(os.path.join(block_dir, 'raw', quad), cols, rows, origin=quad_origin, cellsize=cellsize, seed=seed + quad_n, driver="GTiff")
+    quads.append(quad)
+  
+  block_rows = int(np.ceil(float(quad_count)/quads_per_row))
+  footprint = (origin[0], origin[0] + quads_per_row*quad_width, origin[1] - block_rows*quad_height, origin[1])
+  tidaldatums_dir = os.path.join(data_dir, 'tidal_datums')
+  tidalincriment_dir = os.path.join(data_dir, 'hmt_incriment')
+  make_coarse_grid(os.path.join(tidaldatums_dir, "tss_merged_epsg2992_filled_invdist.img"), footprint, -1.05, -0.85, seed=seed + 1, cellsize=grid_cellsize)
+  make_coarse_grid(os.path.join(tidaldatums_dir, "mhhw_merged_epsg2992_filled_invdist.img"), footprint, 1.05, 1.35, seed=seed + 2, cellsize=grid_cellsize)
+  make_coarse_grid(os.path.join(tidalincriment_dir, "dlcd_hmt_mhhw_invdist.img"), footprint, 1.5, 3.0, seed=seed + 3, cellsize=grid_cellsize)
+  make_coarse_grid(os.path.join(tidalincriment_dir, "dlcd_hmt_mhhw_nearest.img"), footprint, 8.0, 11.0, seed=seed + 4, cellsize=grid_cellsize)
+  return quads
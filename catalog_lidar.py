@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Scan the raw LIDAR quads into the quad catalog (data/LIDAR/hmt_catalog.sqlite, see hmt_processor/catalog.py) and
+list what it holds. Only new or changed quads are described, so re-running it is cheap:
+
+  python catalog_lidar.py --workers 4
+  python catalog_lidar.py SSNERR_LIDAR --list
+"""
+
+# Import core modules
+import sys
+import os
+import argparse
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import HMT specific packages
+from hmt_processor import catalog as hmt_catalog
+from hmt_processor import runtime as hmt_runtime
+import process_tiles
+
+# get a reference to the path that holds this file
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Log file of the catalog scans
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'catalog_lidar.log')
+
+
+def print_entries(entries):
+  print("{0:<16} {1:<14} {2:>7} {3:>7} {4:>8} {5:>10} {6:>10} {7:>9}  {8}".format('block', 'quad', 'cols', 'rows', 'cell', 'blocks', 'MB', 'nodata', 'checksum'))
+  for entry in entries:
+    print("{0:<16} {1:<14} {2:>7} {3:>7} {4:>8.2f} {5:>10} {6:>10.1f} {7:>9}  {8}".format(
+      entry['block'], entry['quad'], entry['cols'], entry['rows'], entry['pixel_width'], "{0}x{1}".format(entry['block_cols'], entry['block_rows']),
+      entry['size_bytes']/1000000.0, entry['nodata'], entry['checksum'] or '-'))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Catalog the raw LIDAR quads.")
+  parser.add_argument('data_blocks', nargs='*', help="LIDAR data blocks to scan (default every block)")
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--no-checksums', action='store_true', help="skip the MD5 checksums of the quad files")
+  parser.add_argument('--list', action='store_true', help="print the catalogued quads")
+  parser.add_argument('--data-dir', default=None, help="data directory (default PROJECT_DIR/data)")
+  args = parser.parse_args(argv)
+  
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
+  lidar_dir = process_tiles.data_paths(args.data_dir)[0]
+  catalog = hmt_catalog.open_catalog(lidar_dir, blocks=args.data_blocks or None, workers=args.workers, checksums=not args.no_checksums)
+  if args.list:
+    print_entries([entry for block in (args.data_blocks or catalog.blocks()) for entry in catalog.entries(block)])
+  catalog.close()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
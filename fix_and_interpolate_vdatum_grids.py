@@ -26,20 +26,11 @@ gdal_fillnodata.py -md 0 mhhw_merged_v2.img -mask mhhw_merged_v2_mask.img mhhw_m
 import sys
 import os
 import pprint
+import time
 
 # Import and configure logging
 import logging
 logger = logging.getLogger('hmt_processor')
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-fhnd = logging.FileHandler('logs/fix_and_interpolate_vdatum_grids.log')
-fhnd.setLevel(logging.DEBUG)
-fhnd.setFormatter(formatter)
-logger.addHandler(fhnd)
 
 
 # Import Numpy
@@ -56,23 +47,26 @@ from gmtools import geospatial as gm_gdal
 
 # Import HMT specific packages
 from hmt_processor import processors as hmt
-
-# Fix osgeo error reporting
-gdal.UseExceptions()
-ogr.UseExceptions()
-osr.UseExceptions()
-
-# Set gdal configuration parameters
-gdal.SetCacheMax(2147483648)  # 2 GB. This sets the caching max size for gdal. Bigger number can lead to faster reads / writes
-gdal.SetConfigOption('HFA_USE_RRD', 'YES')  # Configure GDAL to use blocks
+from hmt_processor import metrics as hmt_metrics
+from hmt_processor import tracing as hmt_trace
+from hmt_processor import runtime as hmt_runtime
+from hmt_processor import formats as hmt_formats
+from hmt_processor import dtypes as hmt_dtypes
+from hmt_processor import objectstore as hmt_store
 
 # get a reference to the path that holds this file
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Path to the LIDAR datasets
-VDATUM_GRIDS_DIR = os.path.join(PROJECT_DIR, 'data', 'tidal_datums')
+# Path to the VDatum grids, a local path or an s3:// URI (HMT_VDATUM_DIR); outputs of remote grids go to the local mirror
+VDATUM_GRIDS_DIR = hmt_store.vsi_path(os.environ.get('HMT_VDATUM_DIR') or os.path.join(PROJECT_DIR, 'data', 'tidal_datums'))
+
+# Log file of the VDatum preparation
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'fix_and_interpolate_vdatum_grids.log')
+
+# Stage metrics of every run (JSON lines, see hmt_processor.metrics)
+METRICS_PATH = os.path.join(PROJECT_DIR, 'logs', 'hmt_metrics.jsonl')
 
-def fix_nodata(input_path, output_path, desired_nodata=-9999, driver="HFA", blocksize=(600,600)):
+def fix_nodata(input_path, output_path, desired_nodata=-9999, driver=None, blocksize=(600,600)):
   """
   This function takes the data from the grid dataset and restablishes the nodata field in GDAL.
   """
@@ -102,6 +96,7 @@ def fix_nodata(input_path, output_path, desired_nodata=-9999, driver="HFA", bloc
     logger.warn("  Using a nodata value of -88.88 because the src file didn't define a nodata value.")
     grid_original_nodata = float(-88.8)
   logger.info("  desired nodata value: {0}".format(desired_nodata))
+  read_dtype = hmt_dtypes.read_dtype(grid_original_nodata)  # float32 unless it cannot hold the original nodata
   
   # Get block size from parameters
   xBlockSize = blocksize[0]
@@ -115,8 +110,7 @@ def fix_nodata(input_path, output_path, desired_nodata=-9999, driver="HFA", bloc
   
   # Create a copy of the data using in the input tile as an example.
   logger.info("  Creating new raster...")
-  output_driver = gdal.GetDriverByName(driver)  # Setup the output driver
-  output_fh = output_driver.Create(output_path, cols, rows, 1, grid_datatype)
+  output_fh = hmt_formats.create(output_path, cols, rows, 1, hmt_dtypes.SURFACE_TYPE, driver=driver, blocksize=blocksize)  # float32, nodata cells become NaN
   output_fh.SetGeoTransform(geotransform)
   output_fh.SetProjection(projection)
   output_band = output_fh.GetRasterBand(1)
@@ -135,15 +129,19 @@ def fix_nodata(input_path, output_path, desired_nodata=-9999, driver="HFA", bloc
       else: numCols = cols - j
       # Build job here
       #logger.info("    Working on block offset ({0},{1}); cols {2}; rows: {3}...".format(j,i, numCols, numRows))
-      grid_np = grid_data.ReadAsArray(j, i, numCols, numRows)
-      grid_np_masked = np.ma.masked_less_equal(grid_np, grid_original_nodata, copy=False).filled(np.NaN)  # Create the mask
+      lap = hmt_trace.block_spans(j, i)
+      grid_np = grid_data.ReadAsArray(j, i, numCols, numRows, buf_obj=np.empty((numRows, numCols), dtype=read_dtype))
+      lap('read')
+      grid_np[grid_np <= grid_original_nodata] = np.nan  # nodata (and anything below it) becomes NaN in place
+      lap('compute')
       
       # Write the array to the raster
-      output_band.WriteArray(grid_np_masked, j, i)
+      output_band.WriteArray(grid_np, j, i)
+      lap('write')
       
       # Clean Up
       output_fh.FlushCache()
-      grid_np_masked = None
+      lap('flush')
       grid_np = None
   # Done looping through blocks
   
@@ -155,7 +153,7 @@ def fix_nodata(input_path, output_path, desired_nodata=-9999, driver="HFA", bloc
   logger.info("    done.")
   
   logger.info("  Building blocks...")
-  output_fh.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(output_fh, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -171,7 +169,7 @@ def fix_nodata(input_path, output_path, desired_nodata=-9999, driver="HFA", bloc
   
   return output_path
 
-def create_nodata_mask(mhhw_path, output_path, desired_nodata=99, driver="HFA", blocksize=(600,600)):
+def create_nodata_mask(mhhw_path, output_path, desired_nodata=None, driver=None, blocksize=(600,600)):
   """
   This function takes the data from the merged dataset created using ArcGIS
   and restablishes the nodata field in GDAL.
@@ -209,12 +207,12 @@ def create_nodata_mask(mhhw_path, output_path, desired_nodata=99, driver="HFA",
   
   # Create a copy of the data using in the input tile as an example.
   logger.info("  Creating new raster...")
-  output_driver = gdal.GetDriverByName(driver)  # Setup the output driver
-  output_fh = output_driver.Create(output_path, cols, rows, 1, gdal.GDT_Int32)
+  output_fh = hmt_formats.create(output_path, cols, rows, 1, hmt_dtypes.MASK_TYPE, driver=driver, mask=True, blocksize=blocksize)  # 0/1, a single bit per cell where the format packs bits
   output_fh.SetGeoTransform(geotransform)
   output_fh.SetProjection(projection)
   output_band = output_fh.GetRasterBand(1)
-  output_band.SetNoDataValue(desired_nodata)
+  if desired_nodata is not None:
+    output_band.SetNoDataValue(desired_nodata)
   logger.info("    done.")
   
   logger.info("  Processing data...")
@@ -230,14 +228,19 @@ def create_nodata_mask(mhhw_path, output_path, desired_nodata=99, driver="HFA",
       else: numCols = cols - j
       # Build job here
       #logger.info("    Working on block offset ({0},{1}); cols {2}; rows: {3}...".format(j,i, numCols, numRows))
+      lap = hmt_trace.block_spans(j, i)
       mhhw_np = mhhw_data.ReadAsArray(j, i, numCols, numRows)
-      mhhw_wp_interp_mask = np.greater(mhhw_np, mhhw_original_nodata)  # This marks each cell as 0/1. 0 means we want to interpolate.
+      lap('read')
+      mhhw_wp_interp_mask = np.greater(mhhw_np, mhhw_original_nodata, out=np.empty((numRows, numCols), dtype=hmt_dtypes.MASK_DTYPE))  # This marks each cell as 0/1. 0 means we want to interpolate.
+      lap('compute')
       
       # Write the array to the raster
       output_band.WriteArray(mhhw_wp_interp_mask, j, i)
+      lap('write')
       
       # Clean Up
       output_fh.FlushCache()
+      lap('flush')
       mhhw_wp_interp_mask = None
       mhhw_np = None
   # Done looping through blocks
@@ -250,7 +253,7 @@ def create_nodata_mask(mhhw_path, output_path, desired_nodata=99, driver="HFA",
   logger.info("    done.")
   
   logger.info("  Building blocks...")
-  output_fh.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(output_fh, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -266,10 +269,11 @@ def create_nodata_mask(mhhw_path, output_path, desired_nodata=99, driver="HFA",
   
   return output_path
 
-def fill_nodata(input_path, mask_path, output_path, max_distance=0, smoothing_iterations=0, options=[], driver="HFA", desired_nodata=-9999, quiet=False):
+def fill_nodata(input_path, mask_path, output_path, max_distance=0, smoothing_iterations=0, options=[], driver=None, desired_nodata=-9999, quiet=False, copy_workers=1):
   """
   This function mimicks the gdal_fillnodata.py script because it's heavily based on it.
   Basically I just added more logging to fit it into this project.
+  copy_workers > 1 reads the input on that many threads while it is copied to the output.
   """
   
   logger.info('input: {0}'.format(input_path))
@@ -298,8 +302,7 @@ def fill_nodata(input_path, mask_path, output_path, max_distance=0, smoothing_it
   
   # Create a copy of the data using in the input tile as an example.
   logger.info("  Creating new raster...")
-  output_driver = gdal.GetDriverByName(driver)  # Setup the output driver
-  output_fh = output_driver.Create(output_path, cols, rows, 1, gdal.GDT_CFloat32)
+  output_fh = hmt_formats.create(output_path, cols, rows, 1, hmt_dtypes.SURFACE_TYPE, driver=driver)
   output_fh.SetGeoTransform(geotransform)
   output_fh.SetProjection(projection)
   output_band = output_fh.GetRasterBand(1)
@@ -307,7 +310,7 @@ def fill_nodata(input_path, mask_path, output_path, max_distance=0, smoothing_it
   logger.info("    done.")
   
   logger.info("  copying band to destination file...")
-  gm_gdal.CopyBand( input_data, output_band )
+  gm_gdal.CopyBand( input_data, output_band, workers=copy_workers )
   logger.info("    done.")
   
   # Suppress progress report if we ask for quiet behavior
@@ -317,7 +320,8 @@ def fill_nodata(input_path, mask_path, output_path, max_distance=0, smoothing_it
     prog_func = gdal.TermProgress
   
   logger.info("  Running FillNodata()...")
-  result = gdal.FillNodata(output_band, mask_band, max_distance, smoothing_iterations, options, callback = prog_func)
+  with hmt_trace.span('FillNodata', category='block'):
+    result = gdal.FillNodata(output_band, mask_band, max_distance, smoothing_iterations, options, callback = prog_func)
   logger.info("    done.")
   
   # Compute Statistics before closing out the dataset
@@ -333,7 +337,7 @@ def fill_nodata(input_path, mask_path, output_path, max_distance=0, smoothing_it
   logger.info("    done.")
 
   logger.info("  Building blocks...")
-  output_fh.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(output_fh, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -355,13 +359,17 @@ if __name__ == '__main__':
   
   This took 1.25 hours to run on the Linux box.
   """
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
+  timer = hmt_metrics.StageTimer(log_path=METRICS_PATH, run="vdatum-{0}".format(time.strftime('%Y%m%dT%H%M%S')))  # records are tagged with the grid name
+  
   # Replace the nodata value supplied by ArcGIS with the desired nodata value.
   #for folder in ('CAORblan01_8301', 'OR_centr01_8301', 'ORWAcolr01_8301'):
   #  for grid_name in ('mhhw.img', 'mllw.img', 'tss.img'):
   #    inpath = os.path.join(VDATUM_GRIDS_DIR, 'shift_grids_hfa', folder, grid_name)
   #    outname = '__'.join([folder, grid_name])
   #    outpath = os.path.join(VDATUM_GRIDS_DIR, 'shift_grids_hfa', 'fixed_grids', outname)
-  #    fix_nodata(inpath, outpath, desired_nodata=-9999)
+  #    with timer.stage('fix_nodata', quad=outname, outputs=[outpath]):
+  #      fix_nodata(inpath, outpath, desired_nodata=-9999)
   
   #mhhw_grids = list()
   #for folder in ('CAORblan01_8301', 'OR_centr01_8301', 'ORWAcolr01_8301'):
@@ -397,17 +405,21 @@ if __name__ == '__main__':
   for grid_name in ('mhhw_merged_epsg2992.img', 'mllw_merged_epsg2992.img', 'tss_merged_epsg2992.img'):  
     filename_split = os.path.splitext(grid_name)  # split the extension from grid_name
     input_path = os.path.join(VDATUM_GRIDS_DIR, grid_name)  # path to the input grid
-    output_path = os.path.join(VDATUM_GRIDS_DIR, filename_split[0]+"_mask"+filename_split[1])  # output path for grid
-    create_nodata_mask(input_path, output_path)  # Do the work
+    output_path = hmt_store.local_path(hmt_formats.raster_path(VDATUM_GRIDS_DIR, filename_split[0]+"_mask"))  # output path for grid
+    with timer.stage('create_nodata_mask', quad=grid_name, outputs=[output_path]):
+      create_nodata_mask(input_path, output_path)  # Do the work
   
   #for grid_name in ('mhhw_merged_epsg2992.img', 'mllw_merged_epsg2992.img', 'tss_merged_epsg2992.img'):
   #  filename_split = os.path.splitext(grid_name)  # split the extension from grid_name
   #  grid_path = os.path.join(VDATUM_GRIDS_DIR, grid_name)  # path to the input grid
-  #  mask_path = os.path.join(VDATUM_GRIDS_DIR, filename_split[0]+"_mask"+filename_split[1])
-  #  output_path = os.path.join(VDATUM_GRIDS_DIR, filename_split[0]+"_filled_invdist"+filename_split[1])
+  #  mask_path = hmt_store.local_path(hmt_formats.raster_path(VDATUM_GRIDS_DIR, filename_split[0]+"_mask"))
+  #  output_path = hmt_store.local_path(hmt_formats.raster_path(VDATUM_GRIDS_DIR, filename_split[0]+"_filled_invdist"))
   # 
   #  # Equivelent to gdal_fillnodata.py -md 0 mhhw_merged_v2.img -mask mhhw_merged_v2_mask.img mhhw_merged_v2_mask_filled_v2.img
   #  # max_distance= 0 means that the script is allowed to search the entire raster for values
   #  # takes about 45 min to run on Linux box.
-  #  fillnodata_result = fill_nodata(grid_path, mask_path, output_path, max_distance=0)
-  #  print fillnodata_result
\ No newline at end of file
+  #  with timer.stage('fill_nodata', quad=grid_name, outputs=[output_path]):
+  #    fillnodata_result = fill_nodata(grid_path, mask_path, output_path, max_distance=0)
+  #  print fillnodata_result
+  
+  hmt_metrics.log_summary(timer.records)
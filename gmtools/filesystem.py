@@ -9,7 +9,7 @@ def get_size(filepath):
     for dirpath, dirnames, filenames in os.walk(filepath):
       for file in filenames:  file_size += os.path.getsize(os.path.join(dirpath, file))  # pass
   else:
-    file_size = os.path.getsize(raw_quad_path)
+    file_size = os.path.getsize(filepath)
   filesize_mb = float(file_size)/float(1000000)
   filesize_gb = float(filesize_mb)/float(1024)
   return {'bytes': file_size, 'MB': filesize_mb, 'GB': filesize_gb, }
\ No newline at end of file
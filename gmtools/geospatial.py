@@ -23,80 +23,269 @@ IN THE SOFTWARE.
 import sys
 import os
 import pprint
+import collections
 
 # Import and configure logging
 import logging
 logger = logging.getLogger('hmt_processor')
 
+# Import Numpy
+import numpy as np
+
 # Import osgeo
 from osgeo import osr
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import gdalconst
 
+class Window(collections.namedtuple('Window', ['xoff', 'yoff', 'xsize', 'ysize'])):
+    """
+    A pixel window (xoff, yoff, xsize, ysize) in the order used by ReadAsArray / WriteArray.
+    Immutable; an empty window has a zero xsize or ysize.
+    """
+    __slots__ = ()
+    
+    @property
+    def is_empty(self):
+        return self.xsize <= 0 or self.ysize <= 0
+    
+    @property
+    def slices(self):
+        """ (row slice, col slice) for indexing a numpy array that covers the parent raster """
+        return (slice(self.yoff, self.yoff + self.ysize), slice(self.xoff, self.xoff + self.xsize))
+    
+    def intersection(self, other):
+        """ The overlap of two windows; empty (size 0) when they do not overlap """
+        xoff = max(self.xoff, other.xoff)
+        yoff = max(self.yoff, other.yoff)
+        xend = min(self.xoff + self.xsize, other.xoff + other.xsize)
+        yend = min(self.yoff + self.ysize, other.yoff + other.ysize)
+        return Window(xoff, yoff, max(xend - xoff, 0), max(yend - yoff, 0))
+    
+    def clipped(self, cols, rows):
+        """ The part of the window inside a raster of cols x rows """
+        return self.intersection(Window(0, 0, cols, rows))
+    
+    def grown(self, cells):
+        """ The window grown by `cells` on every side (not clipped) """
+        return Window(self.xoff - cells, self.yoff - cells, self.xsize + 2*cells, self.ysize + 2*cells)
+    
+    def relative_to(self, other):
+        """ This window with its offsets expressed relative to the origin of `other` """
+        return Window(self.xoff - other.xoff, self.yoff - other.yoff, self.xsize, self.ysize)
+
+
+class GeoTransform(collections.namedtuple('GeoTransform', ['origin_x', 'pixel_width', 'row_rotation', 'origin_y', 'col_rotation', 'pixel_height'])):
+    """
+    An immutable affine geotransform in GDAL order:
+      origin_x, e-w resolution, rotation, origin_y, rotation, n-s resoluton (usually negative)
+    
+      x = origin_x + col*pixel_width + row*row_rotation
+      y = origin_y + col*col_rotation + row*pixel_height
+    
+    It is a tuple, so it can be passed straight to SetGeoTransform. forward() and inverse() take scalars
+    or numpy arrays, so millions of coordinates can be transformed in one call.
+    """
+    __slots__ = ()
+    
+    @classmethod
+    def from_gdal(cls, gdal_geotransform):
+        """ Build from a GDAL geotransform sequence or an open dataset """
+        if hasattr(gdal_geotransform, 'GetGeoTransform'):
+            gdal_geotransform = gdal_geotransform.GetGeoTransform()
+        return cls(*[float(value) for value in gdal_geotransform])
+    
+    @property
+    def is_north_up(self):
+        return self.row_rotation == 0 and self.col_rotation == 0
+    
+    @property
+    def determinant(self):
+        return self.pixel_width*self.pixel_height - self.row_rotation*self.col_rotation
+    
+    def forward(self, col, row):
+        """ Pixel (col, row) to world (x, y). Use col + 0.5, row + 0.5 for cell centres. """
+        col = np.asarray(col, dtype=np.float64)
+        row = np.asarray(row, dtype=np.float64)
+        world_x = self.origin_x + col*self.pixel_width + row*self.row_rotation
+        world_y = self.origin_y + col*self.col_rotation + row*self.pixel_height
+        return world_x, world_y
+    
+    def inverse(self, world_x, world_y):
+        """ World (x, y) to fractional pixel (col, row); floor the result to get the containing cell """
+        dx = np.asarray(world_x, dtype=np.float64) - self.origin_x
+        dy = np.asarray(world_y, dtype=np.float64) - self.origin_y
+        det = self.determinant
+        col = (dx*self.pixel_height - dy*self.row_rotation)/det
+        row = (dy*self.pixel_width - dx*self.col_rotation)/det
+        return col, row
+    
+    def inverted(self):
+        """ The geotransform mapping world (x, y) to pixel (col, row), like gdal.InvGeoTransform """
+        det = self.determinant
+        return GeoTransform((self.row_rotation*self.origin_y - self.pixel_height*self.origin_x)/det,
+                            self.pixel_height/det,
+                            -self.row_rotation/det,
+                            (self.col_rotation*self.origin_x - self.pixel_width*self.origin_y)/det,
+                            -self.col_rotation/det,
+                            self.pixel_width/det)
+    
+    def compose(self, other):
+        """ The transform that applies `other` first, then this one (self * other as 3x3 matrices) """
+        return GeoTransform(self.origin_x + self.pixel_width*other.origin_x + self.row_rotation*other.origin_y,
+                            self.pixel_width*other.pixel_width + self.row_rotation*other.col_rotation,
+                            self.pixel_width*other.row_rotation + self.row_rotation*other.pixel_height,
+                            self.origin_y + self.col_rotation*other.origin_x + self.pixel_height*other.origin_y,
+                            self.col_rotation*other.pixel_width + self.pixel_height*other.col_rotation,
+                            self.col_rotation*other.row_rotation + self.pixel_height*other.pixel_height)
+    
+    __mul__ = compose
+    
+    def offset(self, xoff, yoff):
+        """ The geotransform of the pixel window that starts at (xoff, yoff) """
+        origin_x, origin_y = self.forward(xoff, yoff)
+        return self._replace(origin_x=float(origin_x), origin_y=float(origin_y))
+    
+    def window_transform(self, window):
+        """ The geotransform of a Window of this raster """
+        return self.offset(window.xoff, window.yoff)
+    
+    def rescaled(self, scale_x, scale_y=None):
+        """ The geotransform of the same footprint with cells scale_x (and scale_y) times larger, e.g. an overview """
+        if scale_y is None: scale_y = scale_x
+        return self._replace(pixel_width=self.pixel_width*scale_x, row_rotation=self.row_rotation*scale_y,
+                             col_rotation=self.col_rotation*scale_x, pixel_height=self.pixel_height*scale_y)
+    
+    def bounds(self, cols, rows):
+        """ World bounding box (minx, maxx, miny, maxy) of a raster of cols x rows """
+        world_x, world_y = self.forward([0, cols, 0, cols], [0, 0, rows, rows])
+        return (float(world_x.min()), float(world_x.max()), float(world_y.min()), float(world_y.max()))
+    
+    def window_for_bounds(self, minx, maxx, miny, maxy, snap='out'):
+        """
+        The pixel Window covering a world bounding box.
+          snap='out'      every cell touched by the box (grows to whole cells)
+          snap='in'       only cells entirely inside the box
+          snap='nearest'  edges rounded to the nearest cell edge
+        """
+        col, row = self.inverse([minx, maxx, minx, maxx], [miny, miny, maxy, maxy])
+        eps = 1e-9  # ignore floating point noise on exact cell edges
+        if snap == 'out':
+            left, top = np.floor(col.min() + eps), np.floor(row.min() + eps)
+            right, bottom = np.ceil(col.max() - eps), np.ceil(row.max() - eps)
+        elif snap == 'in':
+            left, top = np.ceil(col.min() - eps), np.ceil(row.min() - eps)
+            right, bottom = np.floor(col.max() + eps), np.floor(row.max() + eps)
+        elif snap == 'nearest':
+            left, top = np.round(col.min()), np.round(row.min())
+            right, bottom = np.round(col.max()), np.round(row.max())
+        else:
+            raise ValueError("unknown snap mode: {0}".format(snap))
+        return Window(int(left), int(top), max(int(right - left), 0), max(int(bottom - top), 0))
+    
+    def window_in(self, other, cols, rows, snap='out'):
+        """ The Window of the `other` geotransform's raster covering a cols x rows raster on this geotransform """
+        minx, maxx, miny, maxy = self.bounds(cols, rows)
+        return other.window_for_bounds(minx, maxx, miny, maxy, snap=snap)
+    
+    def cell_centers(self, window):
+        """ World x (per column) and y (per row) of the cell centres of a Window of a north-up raster """
+        assert(self.is_north_up), "cell_centers() needs a north-up geotransform"
+        world_x = self.origin_x + (window.xoff + np.arange(window.xsize) + 0.5)*self.pixel_width
+        world_y = self.origin_y + (window.yoff + np.arange(window.ysize) + 0.5)*self.pixel_height
+        return world_x, world_y
+
+
 def World2PixelCoords(gdal_geotransform, world_x, world_y):
-    """ Convert from world coordinates to pixel coordinates using the GDAL geotransform from a raster """
-    # Get data from geotransform
-    #   gdal_geotransform
-    #     origin_x, e-w resolution, rotation, origin_y, rotation, n-s resoluton (usually negative)
-    origin_x = gdal_geotransform[0]
-    ew_resoltion = gdal_geotransform[1]
-    origin_y = gdal_geotransform[3]
-    nw_resolution = gdal_geotransform[5]
-    
-    # Do the conversions
-    pixel_x = int((world_x - origin_x)/ew_resoltion)
-    pixel_y = int((world_y - origin_y)/(nw_resolution))
-    return (pixel_x, pixel_y)
+    """ Convert from world coordinates to (the containing) pixel coordinates using the GDAL geotransform from a raster """
+    pixel_x, pixel_y = GeoTransform.from_gdal(gdal_geotransform).inverse(world_x, world_y)
+    return (int(np.floor(pixel_x)), int(np.floor(pixel_y)))
     
 def Pixel2WorldCoords(gdal_geotransform, pixel_x, pixel_y):
     """ Convert from pixel coordinates to world coordinates using the GDAL geotransform from a raster """
+    world_x, world_y = GeoTransform.from_gdal(gdal_geotransform).forward(pixel_x, pixel_y)
+    return (float(world_x), float(world_y))
+
+# Target size of the chunks CopyBand moves at a time
+COPY_CHUNK_MB = 64
+
+def _lcm(a, b):
+    """ Least common multiple of two positive integers """
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+    return a*b//x
+
+def copy_chunks(xsize, ysize, block_heights, bytes_per_row, chunk_mb=COPY_CHUNK_MB):
+    """
+    Full-width row strips covering an xsize x ysize raster, as Windows, of at most as many rows as fit in
+    chunk_mb (at least one). Their height is a multiple of each of block_heights (the native block heights of
+    the bands involved) so every strip reads and writes whole blocks; when that least common multiple does not
+    fit in chunk_mb the strips are aligned with the largest block height that does, or not at all.
+    """
+    budget_rows = max(1, chunk_mb*1024*1024//max(1, bytes_per_row))
+    heights = [max(1, min(block_height, ysize)) for block_height in block_heights]
+    step = 1
+    for block_height in heights:
+        step = _lcm(step, block_height)
+    if step > budget_rows:
+        step = max([block_height for block_height in heights if block_height <= budget_rows] or [1])
+    rows = budget_rows//step*step
+    return [Window(0, yoff, xsize, min(rows, ysize - yoff)) for yoff in range(0, ysize, rows)]
+
+def _read_chunk_arrays(src_path, band_n, dtype, windows, workers):
+    """
+    Read windows of a band on `workers` threads, each with its own dataset handle; yields arrays in order. At most
+    workers + 1 windows are read ahead of the consumer, so memory stays bounded by the chunk size.
+    """
+    from multiprocessing.pool import ThreadPool
+    import threading
+    handles = threading.local()
     
-    # Get data from geotransform
-    #   gdal_geotransform
-    #     origin_x, e-w resolution, rotation, origin_y, rotation, n-s resoluton (usually negative)
-    #
-    origin_x = gdal_geotransform[0]
-    ew_resoltion = gdal_geotransform[1]
-    origin_y = gdal_geotransform[3]
-    nw_resolution = gdal_geotransform[5]
-    
-    # Do the conversions
-    world_x =  (pixel_x*ew_resoltion)+origin_x
-    world_y = (pixel_y*nw_resolution)+origin_y
+    def read(window):
+        if getattr(handles, 'band', None) is None:
+            handles.dataset = gdal.Open(src_path, gdal.GA_ReadOnly)
+            handles.band = handles.dataset.GetRasterBand(band_n)
+        return handles.band.ReadAsArray(window.xoff, window.yoff, window.xsize, window.ysize,
+                                        buf_obj=np.empty((window.ysize, window.xsize), dtype=dtype))
     
-    return (world_x, world_y)
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for window in windows:
+            pending.append(pool.apply_async(read, (window,)))
+            if len(pending) > workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
 
-def CopyBand( srcband, dstband ):
+def CopyBand( srcband, dstband, chunk_mb=COPY_CHUNK_MB, workers=1 ):
     """
-    CopyBand is from gdal_fillnodata.py
-    
-    Project:  GDAL Python Interface
-    Purpose:  Application for filling nodata areas in a raster by interpolation
-    Author:   Frank Warmerdam, warmerdam@pobox.com
- 
-    Copyright (c) 2008, Frank Warmerdam
-    # 
-    #  Permission is hereby granted, free of charge, to any person obtaining a
-    #  copy of this software and associated documentation files (the "Software"),
-    #  to deal in the Software without restriction, including without limitation
-    #  the rights to use, copy, modify, merge, publish, distribute, sublicense,
-    #  and/or sell copies of the Software, and to permit persons to whom the
-    #  Software is furnished to do so, subject to the following conditions:
-    # 
-    #  The above copyright notice and this permission notice shall be included
-    #  in all copies or substantial portions of the Software.
-    # 
-    #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
-    #  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-    #  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
-    #  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-    #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
-    #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
-    #  DEALINGS IN THE SOFTWARE.
-    #******************************************************************************
+    Copy srcband into dstband (same size) in full-width strips aligned with the native blocks of both bands,
+    through one reused buffer, rather than one scanline round trip at a time as gdal_fillnodata.py's CopyBand
+    did. Strips are read straight into dstband's data type (GDAL converts while reading).
     
+    workers > 1 reads the strips on that many threads, each opening the source dataset by its file name, while
+    this thread writes them in order (a dataset handle is only ever used by one thread). Sources whose description
+    is not a file GDAL can stat (e.g. MEM datasets, VRT strings) are copied serially.
     """
-    for line in range(srcband.YSize):
-        line_data = srcband.ReadRaster( 0, line, srcband.XSize, 1 )
-        dstband.WriteRaster( 0, line, srcband.XSize, 1, line_data, buf_type = srcband.DataType )
\ No newline at end of file
+    from osgeo import gdal_array
+    xsize, ysize = srcband.XSize, srcband.YSize
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dstband.DataType))
+    block_heights = [srcband.GetBlockSize()[1], dstband.GetBlockSize()[1]]
+    windows = copy_chunks(xsize, ysize, block_heights, xsize*dtype.itemsize, chunk_mb)
+    
+    src_path = srcband.GetDataset().GetDescription() if workers > 1 else ''
+    if src_path and gdal.VSIStatL(src_path) is not None:
+        for window, array in zip(windows, _read_chunk_arrays(src_path, srcband.GetBand(), dtype, windows, workers)):
+            dstband.WriteArray(array, window.xoff, window.yoff)
+        return
+    
+    flat = np.empty(windows[0].xsize*windows[0].ysize if windows else 0, dtype=dtype)  # reused by every strip
+    for window in windows:
+        array = flat[:window.xsize*window.ysize].reshape(window.ysize, window.xsize)
+        srcband.ReadAsArray(window.xoff, window.yoff, window.xsize, window.ysize, buf_obj=array)
+        dstband.WriteArray(array, window.xoff, window.yoff)
\ No newline at end of file
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Area of interest (AOI) selection.
+
+An AOI is a bounding box in the CRS of the quads or the polygons of an OGR-readable file (shapefile, GeoJSON, ...),
+reprojected to the quads' CRS. select() asks the catalog's R-tree of quad footprints for candidate quads and keeps
+those whose footprint intersects the AOI geometry; window() is the pixel window of a quad covering its part of the
+AOI. process_tiles runs a windowed quad through a VRT of that window (clip_raster()), so every stage only reads,
+computes and writes the cells of the window (of the AOI's bounding box within the quad).
+"""
+
+# Import core modules
+import sys
+import os
+import re
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import GDAL et al.
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+
+import gmtools.geospatial as gm_geo
+
+BBOX_PATTERN = re.compile(r'^\s*(-?[\d.eE+]+)\s*,\s*(-?[\d.eE+]+)\s*,\s*(-?[\d.eE+]+)\s*,\s*(-?[\d.eE+]+)\s*$')
+
+
+def _srs(wkt):
+  srs = osr.SpatialReference()
+  srs.ImportFromWkt(wkt)
+  if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+  return srs
+
+
+def box_geometry(minx, maxx, miny, maxy):
+  """ A rectangle polygon """
+  ring = ogr.Geometry(ogr.wkbLinearRing)
+  for x, y in ((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)):
+    ring.AddPoint_2D(x, y)
+  polygon = ogr.Geometry(ogr.wkbPolygon)
+  polygon.AddGeometry(ring)
+  return polygon
+
+
+class AOI(object):
+  """
+  An area of interest: an OGR geometry and the WKT of its CRS (None when it is in the CRS of the quads).
+  name tags the outputs of an AOI run so they do not replace the outputs of whole quads.
+  """
+
+  def __init__(self, geometry, wkt=None, name='aoi'):
+    self.geometry = geometry
+    self.wkt = wkt
+    self.name = name
+
+  @classmethod
+  def from_bbox(cls, minx, miny, maxx, maxy, name='aoi'):
+    """ A bounding box in the CRS of the quads """
+    return cls(box_geometry(minx, maxx, miny, maxy), name=name)
+
+  @classmethod
+  def from_file(cls, path, name=None):
+    """ The union of the polygons of every layer of a vector file """
+    vector_fh = ogr.Open(path)
+    if vector_fh is None:
+      raise ValueError("Cannot open AOI file {0}".format(path))
+    geometry = None
+    wkt = None
+    for layer_n in range(vector_fh.GetLayerCount()):
+      layer = vector_fh.GetLayer(layer_n)
+      if layer.GetSpatialRef() is not None and wkt is None:
+        wkt = layer.GetSpatialRef().ExportToWkt()
+      for feature in layer:
+        feature_geometry = feature.GetGeometryRef()
+        if feature_geometry is None:
+          continue
+        geometry = feature_geometry.Clone() if geometry is None else geometry.Union(feature_geometry)
+    vector_fh = None
+    if geometry is None:
+      raise ValueError("AOI file {0} has no geometries".format(path))
+    return cls(geometry, wkt=wkt, name=name or os.path.splitext(os.path.basename(path))[0])
+
+  def geometry_in(self, target_wkt):
+    """ The geometry reprojected to target_wkt (unchanged when either CRS is unknown or they are the same) """
+    geometry = self.geometry.Clone()
+    if self.wkt is None or not target_wkt or _srs(self.wkt).IsSame(_srs(target_wkt)):
+      return geometry
+    geometry.Transform(osr.CoordinateTransformation(_srs(self.wkt), _srs(target_wkt)))
+    return geometry
+
+  def select(self, catalog, blocks=None):
+    """ Catalog rows of the quads (of blocks, every block by default) that intersect the AOI """
+    entries = list()
+    for projection in catalog.projections(blocks):
+      geometry = self.geometry_in(projection)
+      minx, maxx, miny, maxy = geometry.GetEnvelope()
+      for entry in catalog.intersecting(minx, maxx, miny, maxy, blocks=blocks):
+        if entry['projection'] == projection and geometry.Intersects(box_geometry(entry['minx'], entry['maxx'], entry['miny'], entry['maxy'])):
+          entries.append(entry)
+    return sorted(entries, key=lambda entry: (entry['block'], entry['quad']))
+
+  def window(self, entry):
+    """ The gmtools.geospatial.Window of a catalogued quad covering its part of the AOI, None if they do not meet """
+    footprint = box_geometry(entry['minx'], entry['maxx'], entry['miny'], entry['maxy'])
+    overlap = self.geometry_in(entry['projection']).Intersection(footprint)
+    if overlap is None or overlap.IsEmpty():
+      return None
+    minx, maxx, miny, maxy = overlap.GetEnvelope()
+    geotransform = gm_geo.GeoTransform(entry['origin_x'], entry['pixel_width'], 0.0, entry['origin_y'], 0.0, entry['pixel_height'])
+    window = geotransform.window_for_bounds(minx, maxx, miny, maxy, snap='out').clipped(entry['cols'], entry['rows'])
+    return None if window.is_empty else window
+
+
+def parse(spec, name=None):
+  """ An AOI from 'minx,miny,maxx,maxy' (in the CRS of the quads) or the path of a vector file """
+  if isinstance(spec, AOI):
+    return spec
+  match = BBOX_PATTERN.match(spec)
+  if match:
+    return AOI.from_bbox(*[float(value) for value in match.groups()], name=name or 'aoi')
+  return AOI.from_file(spec, name=name)
+
+
+def clip_raster(raster_path, window, vrt_path):
+  """ Write a VRT of a pixel window of a raster; returns vrt_path """
+  if not os.path.exists(os.path.dirname(vrt_path)):
+    os.makedirs(os.path.dirname(vrt_path))
+  vrt_fh = gdal.Translate(vrt_path, raster_path, format='VRT', srcWin=[window.xoff, window.yoff, window.xsize, window.ysize])
+  vrt_fh = None
+  return vrt_path
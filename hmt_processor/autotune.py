@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Auto-tuning of the block size, warp memory, GDAL cache and GDAL_NUM_THREADS.
+
+tune() crops a sample from a real quad, then runs short trials of the real kernels (the grid warp, the datum
+conversion and the binary HMT processor) on it, each trial in a fresh process configured with the candidate
+settings. The search is coordinate descent: each parameter in turn is set to its fastest candidate while the
+others keep their best values so far, after one discarded warm-up run so the first candidate does not pay for a
+cold page cache. A trial whose process dies (e.g. killed for memory) or overruns TRIAL_TIMEOUT counts as a failed
+candidate. The fastest settings are saved as a JSON profile (PROFILE_PATH, or
+HMT_PROFILE); load_profile() is used by the memory plan and runtime of later runs, which cap the profile to each
+worker's share of the budget and of the cores.
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import shutil
+import platform
+import tempfile
+import collections
+import multiprocessing
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import runtime as hmt_runtime
+import formats as hmt_formats
+
+# Default profile location
+PROFILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hmt_profile.json')
+
+# Seconds a trial may run before it is killed and counted as failed
+TRIAL_TIMEOUT = int(os.environ.get('HMT_TRIAL_TIMEOUT', 1800))
+
+# Settings a profile holds and the defaults the search starts from (the values the processors used to hard code)
+DEFAULTS = collections.OrderedDict([
+  ('blocksize', 600),
+  ('warp_mb', 500),
+  ('cache_mb', 2048),
+  ('num_threads', 1),
+])
+
+
+def candidates(memory_mb=None):
+  """ Values tried for each setting; cache and warp memory stay within memory_mb """
+  cpus = multiprocessing.cpu_count()
+  space = collections.OrderedDict([
+    ('blocksize', [256, 512, 600, 1024, 2048]),
+    ('warp_mb', [64, 256, 500, 1024]),
+    ('cache_mb', [128, 512, 2048]),
+    ('num_threads', sorted(set([1, 2, max(1, cpus//2), cpus]))),
+  ])
+  if memory_mb is not None:
+    space['warp_mb'] = [value for value in space['warp_mb'] if value <= memory_mb//4] or [min(space['warp_mb'])]
+    space['cache_mb'] = [value for value in space['cache_mb'] if value <= memory_mb//2] or [min(space['cache_mb'])]
+  return space
+
+
+def profile_path():
+  return os.environ.get('HMT_PROFILE') or PROFILE_PATH
+
+
+def load_profile(path=None):
+  """ The saved profile settings (a dict like DEFAULTS), or None when there is no profile """
+  path = path or profile_path()
+  if not os.path.exists(path):
+    return None
+  with open(path) as profile_fh:
+    profile = json.load(profile_fh)
+  return dict((key, profile['settings'][key]) for key in DEFAULTS if key in profile['settings'])
+
+
+def save_profile(settings, trials, sample, path=None):
+  path = path or profile_path()
+  profile = collections.OrderedDict([
+    ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+    ('host', platform.node()),
+    ('cpus', multiprocessing.cpu_count()),
+    ('sample', sample),
+    ('settings', settings),
+    ('trials', trials),
+  ])
+  with open(path, 'w') as profile_fh:
+    json.dump(profile, profile_fh, indent=2)
+  logger.info("  Saved profile to {0}".format(path))
+  return path
+
+
+def crop_sample(quad_path, sample_path, size):
+  """ Copy a size x size window from the centre of a quad (the whole quad if it is smaller) """
+  quad_fh = gdal.Open(quad_path, gdal.GA_ReadOnly)
+  cols = min(size, quad_fh.RasterXSize)
+  rows = min(size, quad_fh.RasterYSize)
+  xoff = (quad_fh.RasterXSize - cols)//2
+  yoff = (quad_fh.RasterYSize - rows)//2
+  gdal.Translate(sample_path, quad_fh, format='GTiff', srcWin=[xoff, yoff, cols, rows])
+  quad_fh = None
+  return sample_path
+
+
+def run_kernels(settings, inputs, workdir):
+  """ Run the tuned kernels once with settings in this process; returns the wall seconds """
+  import processors as hmt
+  hmt_runtime.Runtime(cache_mb=settings['cache_mb'], num_threads=settings['num_threads'], console=False).configure(force=True)
+  blocksize = (settings['blocksize'], settings['blocksize'])
+  start = time.time()
+  hmt.reproject_datasets_to_quad([inputs['tss'], inputs['hmt_navd88']], inputs['quad'],
+                                 [hmt_formats.raster_path(workdir, 'tune_tss'), hmt_formats.raster_path(workdir, 'tune_hmt')],
+                                 respample_method=gdal.GRA_Bilinear, maxmem=settings['warp_mb'])
+  hmt.convert_navd88_to_tidal_sampled(inputs['quad'], inputs['tss'], inputs['mhhw'], hmt_formats.raster_path(workdir, 'tune_lidar_in_mhhw'), blocksize=blocksize)
+  hmt.hmt_tile_binary_processor_griddedHMT(inputs['quad'], hmt_formats.raster_path(workdir, 'tune_hmt'), hmt_formats.raster_path(workdir, 'tune_binary'), blocksize=blocksize)
+  return time.time() - start
+
+
+def _trial_child(settings, inputs, workdir, result_queue):
+  logger.setLevel(logging.WARNING)
+  try:
+    result_queue.put(run_kernels(settings, inputs, workdir))
+  except Exception as e:
+    result_queue.put(e)
+
+
+class TrialFailed(Exception):
+  """ A trial process died, timed out or raised """
+
+
+def _run_trial(settings, inputs, workdir, timeout=TRIAL_TIMEOUT):
+  """ Wall seconds of one run of the kernels in a fresh process; raises TrialFailed """
+  result_queue = multiprocessing.Queue()
+  child = multiprocessing.Process(target=_trial_child, args=(settings, inputs, workdir, result_queue))
+  child.start()
+  deadline = time.time() + timeout
+  result = None
+  try:
+    while result is None:
+      try:
+        result = result_queue.get(timeout=1.0)
+      except queue.Empty:
+        if child.exitcode is not None and result_queue.empty():  # died without a result (segfault, OOM kill)
+          raise TrialFailed("trial process exited with code {0}".format(child.exitcode))
+        if time.time() > deadline:
+          raise TrialFailed("trial ran longer than {0} s".format(timeout))
+  finally:
+    if child.is_alive() and result is None:
+      child.terminate()
+    child.join()
+  if isinstance(result, Exception):
+    raise TrialFailed("trial raised {0!r}".format(result))
+  return result
+
+
+def trial(settings, inputs, workdir, repeat=1, timeout=TRIAL_TIMEOUT):
+  """ Fastest wall seconds of repeat runs of the kernels with settings, each in a fresh process; raises TrialFailed """
+  return min(_run_trial(settings, inputs, workdir, timeout=timeout) for run_n in range(repeat))
+
+
+def tune(inputs, sample_size=2048, memory_mb=None, repeat=1, path=None, workdir=None):
+  """
+  Search the settings on a sample of inputs['quad'] (with the TSS, MHHW and HMT NAVD88 grids in inputs) and save
+  the fastest as the profile; returns the settings.
+  """
+  remove_workdir = workdir is None
+  workdir = workdir or tempfile.mkdtemp(prefix='hmt_autotune_')
+  try:
+    logger.info("Auto-tuning on a {0} cell sample of {1}".format(sample_size, inputs['quad']))
+    quad_path = inputs['quad']
+    inputs = dict(inputs)
+    inputs['quad'] = crop_sample(inputs['quad'], os.path.join(workdir, 'sample.tif'), sample_size)
+    
+    space = candidates(memory_mb)
+    best = dict(DEFAULTS)
+    try:
+      logger.info("  Warm-up run with the defaults: {0:.2f} s (discarded)".format(trial(best, inputs, workdir)))  # warms the page cache
+    except TrialFailed as e:
+      logger.warn("  Warm-up run with the defaults failed, {0}; the first timings may include a cold cache".format(e))
+    trials = list()
+    measured = dict()
+    for key in space:
+      timings = dict()
+      for value in space[key]:
+        settings = dict(best)
+        settings[key] = value
+        description = ", ".join("{0}={1}".format(name, settings[name]) for name in DEFAULTS)
+        signature = tuple(settings[name] for name in DEFAULTS)
+        if signature not in measured:
+          try:
+            measured[signature] = trial(settings, inputs, workdir, repeat=repeat)
+          except TrialFailed as e:
+            measured[signature] = None
+            trials.append(dict(settings, seconds=None, failed=str(e)))
+            logger.warn("  {0}: failed, {1}".format(description, e))
+          else:
+            trials.append(dict(settings, seconds=measured[signature]))
+            logger.info("  {0}: {1:.2f} s".format(description, measured[signature]))
+        if measured[signature] is not None:
+          timings[value] = measured[signature]
+      if timings:
+        best[key] = min(timings, key=timings.get)
+      logger.info("  Best {0}: {1}".format(key, best[key]))
+    
+    settings = collections.OrderedDict((key, best[key]) for key in DEFAULTS)
+    save_profile(settings, trials, {'quad': quad_path, 'size': sample_size}, path=path)
+    return settings
+  finally:
+    if remove_workdir:
+      shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Per-block min / max / valid-pixel counts of a raster, used to skip blocks whose binary HMT result is
+provably constant. A block of elevations is entirely above HMT when its smallest valid elevation is above the
+largest threshold in the block, and entirely below when every cell is valid and its largest elevation is at or
+below the smallest threshold. Only blocks that straddle the threshold need to be read and compared.
+"""
+
+# Import core modules
+import sys
+import os
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import handles as hmt_handles
+import objectstore as hmt_store
+
+# Block classes returned by classify_block()
+ALL_ABOVE = 0   # every cell of the binary output is 0
+ALL_BELOW = 1   # every cell of the binary output is 1
+STRADDLES = None  # the block has to be computed
+
+
+class BlockIndex(object):
+  """
+  Per-block statistics of one raster band on a fixed block grid (blocks are offset (j, i) = (bj*xBlockSize, bi*yBlockSize)).
+
+  minimum / maximum are NaN for blocks without valid cells; valid_count is the number of cells that are not nodata.
+  """
+
+  def __init__(self, cols, rows, blocksize, minimum=None, maximum=None, valid_count=None):
+    self.cols = cols
+    self.rows = rows
+    self.blocksize = tuple(blocksize)
+    shape = (int(np.ceil(float(rows)/blocksize[1])), int(np.ceil(float(cols)/blocksize[0])))
+    self.minimum = np.full(shape, np.nan) if minimum is None else minimum
+    self.maximum = np.full(shape, np.nan) if maximum is None else maximum
+    self.valid_count = np.zeros(shape, dtype=np.int64) if valid_count is None else valid_count
+
+  def block_of(self, j, i):
+    """ (block row, block col) of the block at pixel offset (j, i) """
+    return (i//self.blocksize[1], j//self.blocksize[0])
+
+  def block_pixels(self, j, i):
+    """ Number of cells in the block at pixel offset (j, i); edge blocks are smaller """
+    return min(self.blocksize[0], self.cols - j)*min(self.blocksize[1], self.rows - i)
+
+  def update(self, j, i, block_np, nodata=None):
+    """ Record the statistics of the block at pixel offset (j, i) from its data """
+    bi, bj = self.block_of(j, i)
+    valid = ~np.isnan(block_np) if np.issubdtype(block_np.dtype, np.floating) else np.ones(block_np.shape, dtype=bool)
+    if nodata is not None:
+      valid &= block_np != nodata
+    count = int(np.count_nonzero(valid))
+    self.valid_count[bi, bj] = count
+    if count > 0:
+      valid_values = block_np[valid]
+      self.minimum[bi, bj] = valid_values.min()
+      self.maximum[bi, bj] = valid_values.max()
+    else:
+      self.minimum[bi, bj] = np.nan
+      self.maximum[bi, bj] = np.nan
+
+  def stats(self, j, i):
+    """ (minimum, maximum, valid_count, block_pixels) of the block at pixel offset (j, i) """
+    bi, bj = self.block_of(j, i)
+    return (self.minimum[bi, bj], self.maximum[bi, bj], int(self.valid_count[bi, bj]), self.block_pixels(j, i))
+
+  def matches(self, cols, rows, blocksize):
+    """ True when the index was built for a raster of this size with this block size """
+    return self.cols == cols and self.rows == rows and self.blocksize == tuple(blocksize)
+
+  def save(self, index_path):
+    """ Save the index as a .npz file """
+    np.savez(index_path, cols=self.cols, rows=self.rows, blocksize=np.array(self.blocksize),
+             minimum=self.minimum, maximum=self.maximum, valid_count=self.valid_count)
+    return index_path
+
+  @classmethod
+  def load(cls, index_path):
+    """ Load an index saved with save() """
+    data = np.load(index_path)
+    return cls(int(data['cols']), int(data['rows']), tuple(int(size) for size in data['blocksize']),
+               minimum=data['minimum'], maximum=data['maximum'], valid_count=data['valid_count'])
+
+
+def block_index_path(raster_path):
+  """ Default sidecar path of the block index of a raster (in the local mirror of a remote raster) """
+  return hmt_store.local_path(raster_path.rstrip(os.sep) + ".blockindex.npz")
+
+
+def build_block_index(raster_path, blocksize=(600,600), band=1):
+  """ Read a raster band block by block and build its BlockIndex """
+  raster_fh = hmt_handles.open_dataset(raster_path)
+  cols = raster_fh.RasterXSize  # Get the number of columns
+  rows = raster_fh.RasterYSize  # Get the number of rows
+  raster_band = raster_fh.GetRasterBand(band)
+  nodata = raster_band.GetNoDataValue()
+
+  # Get block size from parameters
+  xBlockSize = blocksize[0]
+  yBlockSize = blocksize[1]
+
+  index = BlockIndex(cols, rows, blocksize)
+  for i in range(0, rows, yBlockSize):  # Loop through row blocks
+    if i + yBlockSize < rows: numRows = yBlockSize
+    else: numRows = rows - i
+    for j in range(0, cols, xBlockSize):  # Loop through col blocks
+      if j + xBlockSize < cols: numCols = xBlockSize
+      else: numCols = cols - j
+      index.update(j, i, raster_band.ReadAsArray(j, i, numCols, numRows), nodata)
+
+  raster_band = None
+  raster_fh = None
+  return index
+
+
+def get_block_index(raster_path, blocksize=(600,600), band=1, index_path=None, build=True):
+  """
+  Load the block index of a raster from its sidecar file, building (and saving) it when the sidecar is missing,
+  older than the raster, or was built with another block size. Returns None if build is False and there is no
+  usable sidecar.
+  """
+  if index_path is None:
+    index_path = block_index_path(raster_path)
+  if os.path.exists(index_path) and os.path.getmtime(index_path) >= hmt_store.getmtime(raster_path):
+    index = BlockIndex.load(index_path)
+    if index.blocksize == tuple(blocksize):
+      return index
+  if build is False:
+    return None
+
+  logger.info("  Building block index for {0}...".format(raster_path))
+  index = build_block_index(raster_path, blocksize=blocksize, band=band)
+  index.save(index_path)
+  logger.info("    done.")
+  return index
+
+
+def resolve_block_index(block_index, cols, rows, blocksize):
+  """
+  Turn the block_index argument of a processor (None, a BlockIndex or the path of a saved index) into a
+  BlockIndex that matches the raster, or None when it cannot be used.
+  """
+  if block_index is None:
+    return None
+  if not isinstance(block_index, BlockIndex):
+    if not os.path.exists(block_index):
+      logger.warn("  Block index {0} does not exist, processing every block.".format(block_index))
+      return None
+    block_index = BlockIndex.load(block_index)
+  if not block_index.matches(cols, rows, blocksize):
+    logger.warn("  Block index does not match the raster or block size, processing every block.")
+    return None
+  return block_index
+
+
+def classify_block(elevation_stats, threshold_min, threshold_max, threshold_complete=True):
+  """
+  Decide whether the binary (elevation <= threshold) result of a block is constant.
+
+  elevation_stats is BlockIndex.stats() of the elevation block. threshold_min / threshold_max bound the
+  threshold over the block; threshold_complete is False when some thresholds in the block may be nodata / NaN.
+  Returns ALL_ABOVE, ALL_BELOW or STRADDLES.
+  """
+  elevation_min, elevation_max, valid_count, block_pixels = elevation_stats
+  if valid_count == 0:
+    return ALL_ABOVE  # nodata cells are never below HMT
+  if not threshold_complete or threshold_min is None or np.isnan(threshold_min) or np.isnan(threshold_max):
+    return STRADDLES
+  if elevation_min > threshold_max:
+    return ALL_ABOVE
+  if valid_count == block_pixels and elevation_max <= threshold_min:
+    return ALL_BELOW
+  return STRADDLES
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Overlap the block I/O of the processor loops with their numpy work.
+
+A BlockReader reads the windows of one or more bands on a background thread, up to depth blocks ahead of the
+loop, and a BlockWriter writes (and optionally flushes) blocks on another thread, holding at most depth blocks
+queued. While block k is computed, block k+1 is being read and block k-1 written. Blocks are read and written
+in the same order as the synchronous loop and the arrays are handed over untouched, so the output is identical.
+Each dataset is only used by one thread at a time: the reader's bands by the reader thread, the writer's band
+and dataset by the writer thread, and neither by the loop until the reader / writer is closed.
+
+  windows = list(hmt_blockio.block_windows(cols, rows, blocksize))
+  with hmt_blockio.BlockReader([lidar_band], windows) as reader, hmt_blockio.BlockWriter(output_band) as writer:
+    for (j, i, numCols, numRows), (lidar_np,) in reader:
+      writer.write(lidar_np <= hmt_value, j, i)
+
+depth=0 (or HMT_IO_DEPTH=0) does the reads and writes inline on the calling thread.
+
+The blocks are read into, and can be computed into, rings of preallocated buffers (ReadAsArray(buf_obj=...),
+BlockWriter.buffer()), with a Scratch for the temporaries, so the loops allocate no arrays per block. A ring has
+depth + 2 slots: the blocks queued, the one on the I/O thread and the one the loop holds. An array the reader
+yields is therefore only valid until the loop takes the next block, and an array from writer.buffer() must be
+handed to write() before the next buffer() call.
+"""
+
+# Import core modules
+import sys
+import os
+import threading
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal_array
+
+import tracing as hmt_trace
+
+# Blocks read ahead / queued for writing; each costs one block of arrays (see hmt_processor.memory)
+QUEUE_DEPTH = int(os.environ.get('HMT_IO_DEPTH', 2))
+
+# Seconds between checks for close() while a thread waits on its queue
+_POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+def block_windows(cols, rows, blocksize):
+  """ (j, i, numCols, numRows) of each block of a raster, row by row; edge blocks are smaller """
+  xBlockSize = blocksize[0]
+  yBlockSize = blocksize[1]
+  for i in range(0, rows, yBlockSize):  # Loop through row blocks
+    if i + yBlockSize < rows: numRows = yBlockSize
+    else: numRows = rows - i
+    for j in range(0, cols, xBlockSize):  # Loop through col blocks
+      if j + xBlockSize < cols: numCols = xBlockSize
+      else: numCols = cols - j
+      yield (j, i, numCols, numRows)
+
+
+def _view(flat, shape):
+  """ A C-contiguous (rows, cols) array over the start of a flat buffer """
+  return flat[:shape[0]*shape[1]].reshape(shape)
+
+
+class Scratch(object):
+  """ Named temporary arrays reused from block to block; each grows to the largest block it is asked for """
+
+  def __init__(self):
+    self.buffers = dict()
+
+  def array(self, name, shape, dtype):
+    """ An uninitialised array of shape and dtype; the previous contents of name are overwritten """
+    dtype = np.dtype(dtype)
+    flat = self.buffers.get(name)
+    if flat is None or flat.dtype != dtype or flat.size < shape[0]*shape[1]:
+      flat = self.buffers[name] = np.empty(shape[0]*shape[1], dtype=dtype)
+    return _view(flat, shape)
+
+
+class _Ring(object):
+  """ Preallocated block buffers handed out in turn """
+
+  def __init__(self, slots):
+    self.scratch = [Scratch() for slot in range(slots)]
+    self.slot = 0
+
+  def next(self):
+    scratch = self.scratch[self.slot]
+    self.slot = (self.slot + 1) % len(self.scratch)
+    return scratch
+
+
+class _Failure(object):
+  """ An exception raised on an I/O thread, re-raised on the loop's thread """
+
+  def __init__(self, error):
+    self.error = error
+
+
+class BlockReader(object):
+  """
+  Iterates over windows yielding (window, arrays), arrays holding ReadAsArray of each band for the window.
+  Reads run up to depth windows ahead on a background thread, into a ring of buffers (reuse=False reads into
+  new arrays that stay valid). dtypes gives the numpy type each band is read as (GDAL converts while reading),
+  the band's own type where it is None.
+  """
+
+  def __init__(self, bands, windows, depth=None, reuse=True, dtypes=None):
+    self.bands = list(bands)
+    self.windows = list(windows)
+    self.depth = QUEUE_DEPTH if depth is None else depth
+    self.ring = _Ring(self.depth + 2) if reuse else None
+    self.dtypes = [dtype or gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType) for band, dtype in zip(self.bands, dtypes or [None]*len(self.bands))]
+    self.position = 0
+    self.stopped = threading.Event()
+    self.thread = None
+    if self.depth > 0 and self.windows:
+      self.queue = queue.Queue(maxsize=self.depth)
+      self.thread = threading.Thread(target=self._run, name='hmt-block-reader')
+      self.thread.daemon = True
+      self.thread.start()
+
+  def _read(self, window):
+    j, i, numCols, numRows = window
+    lap = hmt_trace.block_spans(j, i)
+    if self.ring is None:
+      arrays = [band.ReadAsArray(j, i, numCols, numRows, buf_obj=np.empty((numRows, numCols), dtype=dtype)) for band, dtype in zip(self.bands, self.dtypes)]
+    else:
+      buffers = self.ring.next()
+      arrays = [band.ReadAsArray(j, i, numCols, numRows, buf_obj=buffers.array(band_n, (numRows, numCols), dtype))
+                for band_n, (band, dtype) in enumerate(zip(self.bands, self.dtypes))]
+    lap('read')
+    return arrays
+
+  def _put(self, item):
+    """ Queue item unless the reader is closed first; False when it was """
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=_POLL_SECONDS)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _run(self):
+    try:
+      for window in self.windows:
+        if not self._put((window, self._read(window))):
+          return
+    except Exception as error:
+      logger.exception("Block read failed")
+      self._put(_Failure(error))
+      return
+    self._put(_DONE)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.position >= len(self.windows):
+      raise StopIteration
+    if self.thread is None:
+      window = self.windows[self.position]
+      item = (window, self._read(window))
+    else:
+      item = self.queue.get()
+      if isinstance(item, _Failure):
+        self.position = len(self.windows)
+        raise item.error
+    self.position += 1
+    return item
+
+  next = __next__  # Python 2
+
+  def close(self):
+    """ Stop reading ahead and wait for the reader thread; the bands are free for other use afterwards """
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+
+class BlockWriter(object):
+  """
+  Writes blocks to band on a background thread, at most depth blocks behind the loop. With flush=True the
+  dataset is flushed after every block, as the synchronous loops did. Errors of the writer thread are raised by
+  the next write() or by close().
+  """
+
+  def __init__(self, band, dataset=None, flush=False, depth=None):
+    self.band = band
+    self.dataset = dataset
+    self.flush = flush
+    self.depth = QUEUE_DEPTH if depth is None else depth
+    self.ring = _Ring(self.depth + 2)
+    self.failure = None
+    self.thread = None
+    if self.depth > 0:
+      self.queue = queue.Queue(maxsize=self.depth)
+      self.thread = threading.Thread(target=self._run, name='hmt-block-writer')
+      self.thread.daemon = True
+      self.thread.start()
+
+  def _write(self, array, j, i):
+    lap = hmt_trace.block_spans(j, i)
+    self.band.WriteArray(array, j, i)
+    lap('write')
+    if self.flush:
+      self.dataset.FlushCache()
+      lap('flush')
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is _DONE:
+        return
+      if self.failure is not None:
+        continue  # drain what the loop queued before it saw the failure
+      try:
+        self._write(*item)
+      except Exception as error:
+        logger.exception("Block write failed")
+        self.failure = _Failure(error)
+
+  def _raise_failure(self):
+    if self.failure is not None:
+      failure, self.failure = self.failure, None
+      raise failure.error
+
+  def buffer(self, shape, dtype):
+    """ A preallocated (uninitialised) array to compute the next block into and pass to write() """
+    return self.ring.next().array('block', shape, dtype)
+
+  def write(self, array, j, i):
+    """ Write array at pixel offset (j, i); the array must not be modified afterwards """
+    if self.thread is None:
+      self._write(array, j, i)
+      return
+    self._raise_failure()
+    self.queue.put((array, j, i))
+
+  def close(self):
+    """ Write out the queued blocks and wait for the writer thread; raises the first failed write """
+    if self.thread is not None:
+      self.queue.put(_DONE)
+      self.thread.join()
+      self.thread = None
+    self._raise_failure()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    elif self.thread is not None:
+      # The loop failed; finish the thread without masking its exception
+      self.queue.put(_DONE)
+      self.thread.join()
+      self.thread = None
+    return False
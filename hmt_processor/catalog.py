@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+SQLite catalog of the raw LiDAR quads.
+
+scan() walks data/LIDAR/<block>/raw once, describes every new or changed quad on worker processes (footprint,
+resolution, nodata, data type, native block layout, size on disk and an MD5 checksum of its files) and stores the
+result in data/LIDAR/hmt_catalog.sqlite (the local mirror of a remote LIDAR directory, see objectstore.py). Later scans only describe quads whose files changed (newest mtime or
+size) and drop quads that disappeared. process_tiles.py and tabulate_areas.py take their quad lists from the
+catalog and the cost model / memory planner read quad sizes from it instead of walking the grid directories.
+An R-tree of the quad footprints answers intersecting(), which aoi.py uses to select the quads of a site.
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import hashlib
+import sqlite3
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import scheduler as hmt_scheduler
+import runtime as hmt_runtime
+import objectstore as hmt_store
+
+CATALOG_NAME = 'hmt_catalog.sqlite'
+RAW_FOLDER = 'raw'
+
+COLUMNS = ['block', 'quad', 'path', 'mtime', 'size_bytes', 'checksum', 'cols', 'rows', 'bands', 'datatype', 'nodata',
+           'origin_x', 'origin_y', 'pixel_width', 'pixel_height', 'minx', 'maxx', 'miny', 'maxy', 'projection',
+           'block_cols', 'block_rows', 'scanned_at']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quads (
+  block TEXT NOT NULL,
+  quad TEXT NOT NULL,
+  path TEXT NOT NULL,
+  mtime REAL,
+  size_bytes INTEGER,
+  checksum TEXT,
+  cols INTEGER,
+  rows INTEGER,
+  bands INTEGER,
+  datatype TEXT,
+  nodata REAL,
+  origin_x REAL,
+  origin_y REAL,
+  pixel_width REAL,
+  pixel_height REAL,
+  minx REAL,
+  maxx REAL,
+  miny REAL,
+  maxy REAL,
+  projection TEXT,
+  block_cols INTEGER,
+  block_rows INTEGER,
+  scanned_at REAL,
+  PRIMARY KEY (block, quad)
+)
+"""
+
+# Footprints of the quads table (id = rowid of the quad); rebuilt after every scan that changed the catalog
+RTREE_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS quad_footprints USING rtree(id, minx, maxx, miny, maxy)"
+
+
+def catalog_path(lidar_dir):
+  """ Default location of the catalog of a LIDAR directory (in the local mirror of a remote one) """
+  return hmt_store.local_path(os.path.join(lidar_dir, CATALOG_NAME))
+
+
+def raw_quads(raw_dir):
+  """ Names of the quads in a raw/ folder """
+  if not hmt_store.isdir(raw_dir):
+    return []
+  # ArcInfo workspaces keep an info/ folder next to the grids; GDAL leaves .aux.xml files next to them
+  return sorted(name for name in hmt_store.listdir(raw_dir) if name.lower() != 'info' and not name.startswith('.') and not name.endswith('.aux.xml'))
+
+
+def data_blocks(lidar_dir):
+  """ Names of the data blocks (folders with a raw/ folder) of a LIDAR directory """
+  if not hmt_store.isdir(lidar_dir):
+    return []
+  return sorted(name for name in hmt_store.listdir(lidar_dir) if hmt_store.isdir(os.path.join(lidar_dir, name, RAW_FOLDER)))
+
+
+def quad_files(path):
+  """ The files of a quad: the file itself, or every file of a grid directory, in a stable order """
+  if not hmt_store.isdir(path):
+    return [path]
+  return sorted(hmt_store.walk_files(path))
+
+
+def file_signature(path):
+  """ (newest mtime, total size in bytes) of a quad's files; a change in either means the quad changed """
+  files = quad_files(path)
+  mtimes = [hmt_store.getmtime(path)] + [hmt_store.getmtime(filename) for filename in files]
+  return max(mtimes), sum(hmt_store.getsize(filename) for filename in files)
+
+
+def checksum(path, chunk_bytes=1024*1024):
+  """ MD5 of the relative names and contents of a quad's files """
+  digest = hashlib.md5()
+  for filename in quad_files(path):
+    digest.update(os.path.relpath(filename, path).encode('utf-8'))
+    for chunk in hmt_store.read_chunks(filename, chunk_bytes):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def describe_quad(block, quad, path, checksums=True):
+  """ The catalog row (a dict of COLUMNS) of one quad; runs on the scan workers """
+  mtime, size_bytes = file_signature(path)
+  raster_fh = gdal.Open(path, gdal.GA_ReadOnly)
+  geotransform = raster_fh.GetGeoTransform()
+  cols = raster_fh.RasterXSize
+  rows = raster_fh.RasterYSize
+  raster_band = raster_fh.GetRasterBand(1)
+  block_cols, block_rows = raster_band.GetBlockSize()
+  corners_x = (geotransform[0], geotransform[0] + cols*geotransform[1])
+  corners_y = (geotransform[3], geotransform[3] + rows*geotransform[5])
+  entry = {
+    'block': block, 'quad': quad, 'path': path, 'mtime': mtime, 'size_bytes': size_bytes,
+    'checksum': checksum(path) if checksums else None,
+    'cols': cols, 'rows': rows, 'bands': raster_fh.RasterCount,
+    'datatype': gdal.GetDataTypeName(raster_band.DataType), 'nodata': raster_band.GetNoDataValue(),
+    'origin_x': geotransform[0], 'origin_y': geotransform[3], 'pixel_width': geotransform[1], 'pixel_height': geotransform[5],
+    'minx': min(corners_x), 'maxx': max(corners_x), 'miny': min(corners_y), 'maxy': max(corners_y),
+    'projection': raster_fh.GetProjection(), 'block_cols': block_cols, 'block_rows': block_rows,
+    'scanned_at': time.time(),
+  }
+  raster_band = None
+  raster_fh = None
+  return entry
+
+
+class Catalog(object):
+  """ The quads table of a catalog file; rows come back as dicts of COLUMNS """
+
+  def __init__(self, path):
+    self.path = path
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    self.connection = sqlite3.connect(path)
+    self.connection.row_factory = sqlite3.Row
+    with self.connection:
+      self.connection.execute(SCHEMA)
+    try:
+      with self.connection:
+        self.connection.execute(RTREE_SCHEMA)
+      self.has_rtree = True
+    except sqlite3.OperationalError:
+      logger.warn("This SQLite has no R-tree module, footprint queries scan the quads table")
+      self.has_rtree = False
+    if self.has_rtree and self._count("quad_footprints") != self._count("quads"):
+      self.index_footprints()  # a catalog written before the R-tree existed
+
+  def _count(self, table):
+    return self.connection.execute("SELECT count(*) FROM {0}".format(table)).fetchone()[0]
+
+  def close(self):
+    self.connection.close()
+
+  def scan(self, lidar_dir, blocks=None, workers=1, checksums=True, backend=None):
+    """
+    Bring the catalog up to date with the raw quads of blocks (every data block by default), describing new and
+    changed quads on workers processes. Returns {'added', 'updated', 'removed', 'unchanged'} counts.
+    """
+    if blocks is None: blocks = data_blocks(lidar_dir)
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    jobs = list()
+    for block in blocks:
+      raw_dir = os.path.join(lidar_dir, block, RAW_FOLDER)
+      known = dict((entry['quad'], entry) for entry in self.entries(block))
+      quads = raw_quads(raw_dir)
+      for quad in quads:
+        path = os.path.join(raw_dir, quad)
+        entry = known.get(quad)
+        if entry is not None and entry['path'] == path and (entry['mtime'], entry['size_bytes']) == file_signature(path) and (entry['checksum'] is not None or not checksums):
+          counts['unchanged'] += 1
+          continue
+        counts['updated' if entry is not None else 'added'] += 1
+        jobs.append((block, quad, path, checksums))
+      removed = [quad for quad in known if quad not in quads]
+      with self.connection:
+        self.connection.executemany("DELETE FROM quads WHERE block = ? AND quad = ?", [(block, quad) for quad in removed])
+      counts['removed'] += len(removed)
+    
+    if jobs:
+      logger.info("Cataloguing {0} new or changed quads...".format(len(jobs)))
+      worker_runtime = (hmt_runtime.current() or hmt_runtime.Runtime(console=False)).for_worker(workers)
+      entries = hmt_scheduler.run_jobs(describe_quad, jobs, workers=workers, backend=backend,
+                                       initializer=hmt_runtime.configure_worker, initargs=(worker_runtime,))
+      with self.connection:
+        self.connection.executemany("INSERT OR REPLACE INTO quads ({0}) VALUES ({1})".format(', '.join(COLUMNS), ', '.join('?'*len(COLUMNS))),
+                                    [[entry[column] for column in COLUMNS] for entry in entries])
+      logger.info("  done.")
+    if jobs or counts['removed']:
+      self.index_footprints()
+    logger.info("Catalog {0}: {added} added, {updated} updated, {removed} removed, {unchanged} unchanged".format(self.path, **counts))
+    return counts
+
+  def index_footprints(self):
+    """ Rebuild the R-tree of the quad footprints """
+    if not self.has_rtree:
+      return
+    with self.connection:
+      self.connection.execute("DELETE FROM quad_footprints")
+      self.connection.execute("INSERT INTO quad_footprints (id, minx, maxx, miny, maxy) SELECT rowid, minx, maxx, miny, maxy FROM quads")
+
+  def intersecting(self, minx, maxx, miny, maxy, blocks=None):
+    """ Rows of the quads (of blocks, every block by default) whose footprint intersects a bounding box """
+    if self.has_rtree:
+      rows = self.connection.execute("SELECT quads.* FROM quads JOIN quad_footprints ON quads.rowid = quad_footprints.id "
+                                     "WHERE quad_footprints.maxx >= ? AND quad_footprints.minx <= ? AND quad_footprints.maxy >= ? AND quad_footprints.miny <= ? "
+                                     "ORDER BY quads.block, quads.quad", (minx, maxx, miny, maxy))
+    else:
+      rows = self.connection.execute("SELECT * FROM quads WHERE maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ? ORDER BY block, quad", (minx, maxx, miny, maxy))
+    return [dict(row) for row in rows if blocks is None or row['block'] in blocks]
+
+  def projections(self, blocks=None):
+    """ The distinct projections (WKT) of the quads of blocks, every block by default """
+    return sorted(set(entry['projection'] for entry in self.entries() if blocks is None or entry['block'] in blocks))
+
+  def blocks(self):
+    """ Names of the catalogued data blocks """
+    return [row[0] for row in self.connection.execute("SELECT DISTINCT block FROM quads ORDER BY block")]
+
+  def quads(self, block):
+    """ Names of the catalogued quads of a data block """
+    return [row[0] for row in self.connection.execute("SELECT quad FROM quads WHERE block = ? ORDER BY quad", (block,))]
+
+  def entry(self, block, quad):
+    """ The row of one quad, None if it is not catalogued """
+    row = self.connection.execute("SELECT * FROM quads WHERE block = ? AND quad = ?", (block, quad)).fetchone()
+    return dict(row) if row is not None else None
+
+  def entries(self, block=None):
+    """ Rows of every quad, or of the quads of one data block """
+    if block is None:
+      rows = self.connection.execute("SELECT * FROM quads ORDER BY block, quad")
+    else:
+      rows = self.connection.execute("SELECT * FROM quads WHERE block = ? ORDER BY quad", (block,))
+    return [dict(row) for row in rows]
+
+
+def open_catalog(lidar_dir, path=None, scan=True, blocks=None, workers=1, checksums=True):
+  """ Open the catalog of a LIDAR directory (catalog_path() by default), first updating it with scan() """
+  catalog = Catalog(path or catalog_path(lidar_dir))
+  if scan:
+    catalog.scan(lidar_dir, blocks=blocks, workers=workers, checksums=checksums)
+  return catalog
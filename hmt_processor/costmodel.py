@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Per-quad cost model, job ordering and live progress.
+
+A quad's runtime is modelled as seconds = fixed + per_pixel*valid_pixels + per_mb*file_mb, where valid_pixels comes
+from the quad's block index (or its size when there is none yet) and file_mb from objectstore.get_size (local or remote).
+calibrate() fits the coefficients to the stage metrics of earlier runs (hmt_processor.metrics JSON lines, whose
+block_index records carry the quad's features). The scheduler runs quads longest first (lpt_order) and Progress
+publishes quads done, pixels/s and the ETA to a JSON status file and, optionally, a local HTTP endpoint.
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import threading
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import metrics as hmt_metrics
+import handles as hmt_handles
+import objectstore as hmt_store
+
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Coefficients used before any run has been recorded: about 30 minutes for a 7500 x 7500 quad
+DEFAULT_COEFFICIENTS = (30.0, 1800.0/(7500*7500), 0.0)
+
+
+def quad_features(raw_quad_path, block_index=None, entry=None):
+  """
+  {'valid_pixels', 'file_mb'} of a quad; valid_pixels is cols*rows without a block index. entry is the quad's
+  catalog row (see catalog.py), used instead of opening and walking the quad when it describes raw_quad_path.
+  """
+  if entry is not None and entry['path'] != raw_quad_path:
+    entry = None  # the catalog describes the raw grid, not the ingested copy being read
+  if block_index is not None:
+    valid_pixels = int(block_index.valid_count.sum())
+  elif entry is not None:
+    valid_pixels = entry['cols']*entry['rows']
+  else:
+    raster_fh = hmt_handles.open_dataset(raw_quad_path)
+    valid_pixels = raster_fh.RasterXSize*raster_fh.RasterYSize
+    raster_fh = None
+  if entry is not None:
+    file_mb = entry['size_bytes']/1000000.0  # MB as gm_fs.get_size() counts them
+  else:
+    file_mb = hmt_store.get_size(raw_quad_path)['MB']
+  return {'valid_pixels': valid_pixels, 'file_mb': file_mb}
+
+
+def window_features(entry, window):
+  """ quad_features() of a window of a catalogued quad: its cells, and its share of the quad's size """
+  fraction = float(window.xsize*window.ysize)/(entry['cols']*entry['rows'])
+  return {'valid_pixels': window.xsize*window.ysize, 'file_mb': entry['size_bytes']*fraction/1000000.0}
+
+
+class CostModel(object):
+  """ seconds = fixed + per_pixel*valid_pixels + per_mb*file_mb """
+
+  def __init__(self, coefficients=DEFAULT_COEFFICIENTS, samples=0):
+    self.coefficients = tuple(coefficients)
+    self.samples = samples
+
+  def predict(self, features):
+    fixed, per_pixel, per_mb = self.coefficients
+    return fixed + per_pixel*features['valid_pixels'] + per_mb*features['file_mb']
+
+  @classmethod
+  def calibrate(cls, records):
+    """
+    Fit the coefficients to stage metrics records: each (run, quad) is one sample of its total wall time. Falls
+    back to the defaults, rescaled to the observed speed, with fewer than four samples.
+    """
+    quads = dict()
+    for record in records:
+      if record.get('quad') is None: continue
+      sample = quads.setdefault((record.get('run'), record['quad']), {'seconds': 0.0})
+      sample['seconds'] += record['wall_seconds']
+      if 'valid_pixels' in record:
+        sample['valid_pixels'] = record['valid_pixels']
+        sample['file_mb'] = record['file_mb']
+    samples = [sample for sample in quads.values() if 'valid_pixels' in sample]
+    if not samples:
+      return cls()
+    seconds = np.array([sample['seconds'] for sample in samples])
+    features = np.array([[1.0, sample['valid_pixels'], sample['file_mb']] for sample in samples])
+    if len(samples) < 4:
+      default = cls()
+      scale = seconds.sum()/sum(default.predict(sample) for sample in samples)
+      return cls([coefficient*scale for coefficient in default.coefficients], samples=len(samples))
+    # Scale the columns so the pixel counts do not swamp the fit, and keep every coefficient >= 0
+    scales = np.maximum(np.abs(features).max(axis=0), 1e-12)
+    coefficients = np.linalg.lstsq(features/scales, seconds, rcond=-1)[0]/scales
+    return cls(np.maximum(coefficients, 0.0), samples=len(samples))
+
+  @classmethod
+  def from_metrics(cls, metrics_path):
+    """ A model calibrated from a metrics JSON-lines file (defaults if it does not exist) """
+    if metrics_path is None or not os.path.exists(metrics_path):
+      return cls()
+    return cls.calibrate(hmt_metrics.read_records(metrics_path))
+
+
+def lpt_order(costs):
+  """ Job indexes longest first, the longest-processing-time order that balances workers """
+  return sorted(range(len(costs)), key=lambda job_n: -costs[job_n])
+
+
+class Progress(object):
+  """
+  Tracks a run's finished jobs against their predicted costs and publishes the status as JSON to status_path
+  (written atomically) and, when http_port is set, at http://localhost:<http_port>/.
+  """
+
+  def __init__(self, name, jobs, costs, pixels, workers=1, status_path=None, http_port=None):
+    self.name = name
+    self.jobs = list(jobs)
+    self.costs = list(costs)
+    self.pixels = list(pixels)
+    self.workers = max(1, workers)
+    self.status_path = status_path
+    self.done = set()
+    self.start = time.time()
+    self.lock = threading.Lock()
+    self.server = None
+    if http_port is not None:
+      self.server = _status_server(self, http_port)
+    self.publish()
+
+  def finished(self, job_n):
+    """ Record a finished job and publish """
+    with self.lock:
+      self.done.add(job_n)
+    self.publish()
+
+  def status(self):
+    with self.lock:
+      done = sorted(self.done)
+    elapsed = time.time() - self.start
+    done_cost = sum(self.costs[job_n] for job_n in done)
+    remaining_cost = sum(self.costs) - done_cost
+    pixels_done = sum(self.pixels[job_n] for job_n in done)
+    # Remaining predicted work at the observed rate (actual / predicted seconds, spread over the workers)
+    if done_cost > 0:
+      eta = remaining_cost*(elapsed/done_cost)
+    else:
+      eta = remaining_cost/self.workers
+    return {
+      'run': self.name,
+      'quads_total': len(self.jobs),
+      'quads_done': len(done),
+      'done': [self.jobs[job_n] for job_n in done],
+      'elapsed_seconds': elapsed,
+      'pixels_done': pixels_done,
+      'pixels_per_second': pixels_done/elapsed if elapsed > 0 else 0.0,
+      'eta_seconds': eta,
+      'eta': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + eta)),
+      'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+  def publish(self):
+    status = self.status()
+    logger.info("Progress: {0}/{1} quads, {2:.2f} Mpixels/s, ETA {3}".format(status['quads_done'], status['quads_total'], status['pixels_per_second']/1e6, status['eta']))
+    if self.status_path is not None:
+      status_dir = os.path.dirname(self.status_path)
+      if status_dir and not os.path.exists(status_dir):
+        os.makedirs(status_dir)
+      temp_path = self.status_path + ".tmp"
+      with open(temp_path, 'w') as status_fh:
+        json.dump(status, status_fh, indent=2)
+      os.rename(temp_path, self.status_path)
+    return status
+
+  def close(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+
+def _status_server(progress, port):
+  """ Serve progress.status() as JSON on localhost:port from a daemon thread """
+  class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      body = json.dumps(progress.status(), indent=2).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass  # keep requests out of the processor log
+
+  server = HTTPServer(('127.0.0.1', port), StatusHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  logger.info("Serving progress at http://127.0.0.1:{0}/".format(port))
+  return server
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Data type policy of the pipeline.
+
+Surfaces (elevations, datum conversion grids, HMT grids and everything derived from them) are read, computed and
+stored as float32: the LIDAR and VDatum values carry far fewer than 7 significant digits, so float64 only doubles
+memory and I/O. Masks (the HMT binary rasters, nodata masks) are 0/1 uint8 arrays written to Byte bands, which the
+formats pack to one bit per cell where they can (see formats.creation_options). Validity is carried as such a
+mask, or as the nodata value itself, rather than as NaN-filled copies. Small integer surfaces (Byte, Int16, UInt16)
+are exact in float32 and are kept as they are where a raster is only copied or resampled.
+"""
+
+# Import core modules
+import sys
+import os
+import functools
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+SURFACE_TYPE = gdal.GDT_Float32
+MASK_TYPE = gdal.GDT_Byte
+SURFACE_DTYPE = np.float32
+MASK_DTYPE = np.uint8
+
+# Integer types a surface may keep when it is only copied or resampled
+COMPACT_INTEGER_TYPES = (gdal.GDT_Byte, gdal.GDT_Int16, gdal.GDT_UInt16)
+
+
+def surface_type(datatype):
+  """ The GDAL type a surface of datatype is carried as: itself for Float32 and small integers, else Float32 """
+  if datatype == SURFACE_TYPE or datatype in COMPACT_INTEGER_TYPES:
+    return datatype
+  return SURFACE_TYPE
+
+
+def stack_type(datatypes):
+  """
+  The type of a multi-band stack of surfaces: the smallest type that holds every band exactly (gdal.DataTypeUnion;
+  the numeric order of the GDT_ codes is not a width order), carried under the policy
+  """
+  return surface_type(functools.reduce(gdal.DataTypeUnion, datatypes))
+
+
+def read_dtype(nodata):
+  """
+  The numpy type to read a surface band whose nodata value is nodata: float32, unless float32 cannot hold nodata
+  exactly (e.g. a float64 -1e+300, which becomes -inf), then float64 so its nodata cells still compare equal to it
+  """
+  if nodata is None or not np.isfinite(nodata):
+    return SURFACE_DTYPE
+  if abs(nodata) <= float(np.finfo(SURFACE_DTYPE).max) and float(SURFACE_DTYPE(nodata)) == nodata:
+    return SURFACE_DTYPE
+  return np.float64
+
+
+def surface_nodata(nodata):
+  """ The nodata value of a float32 surface derived from a source with nodata: rounded to float32 within its range """
+  if nodata is None or not np.isfinite(nodata):
+    return nodata
+  limit = float(np.finfo(SURFACE_DTYPE).max)
+  return float(SURFACE_DTYPE(min(max(nodata, -limit), limit)))
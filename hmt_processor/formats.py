@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Output raster formats.
+
+Every raster the pipeline writes goes through create(), which picks the GDAL driver, file extension and creation
+options from a named profile: the legacy uncompressed HFA (.img), or an internally tiled GeoTIFF compressed with
+DEFLATE / ZSTD (with the predictor that suits the data type) or LERC. Single-bit masks (the HMT binary rasters and
+the VDatum nodata masks) are written with NBITS=1. The profile is a pipeline-wide setting: the HMT_OUTPUT_FORMAT
+environment variable or Runtime(output_format=...) selects it, and processors called with driver=None use it.
+"""
+
+# Import core modules
+import sys
+import os
+import glob
+import collections
+import contextlib
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import handles as hmt_handles
+import objectstore as hmt_store
+
+# name, GDAL driver, file extension, compression (None for uncompressed) and whether it is internally tiled
+Profile = collections.namedtuple('Profile', ['name', 'driver', 'extension', 'compress', 'tiled'])
+
+PROFILES = collections.OrderedDict((profile.name, profile) for profile in (
+  Profile('HFA', 'HFA', '.img', None, False),
+  Profile('GTiff', 'GTiff', '.tif', None, True),
+  Profile('GTiff-DEFLATE', 'GTiff', '.tif', 'DEFLATE', True),
+  Profile('GTiff-ZSTD', 'GTiff', '.tif', 'ZSTD', True),
+  Profile('GTiff-LERC', 'GTiff', '.tif', 'LERC_DEFLATE', True),
+))
+
+DEFAULT_PROFILE = 'HFA'
+
+# GeoTIFF tile sizes, largest first; a tile size that divides the processors' block size means no tile is
+# compressed twice when a block is flushed
+TILE_SIZES = (512, 256, 128, 64)
+DEFAULT_TILE_SIZE = 256
+
+# Compressions that take a PREDICTOR (2 = horizontal differencing for integers, 3 = floating point)
+PREDICTOR_COMPRESSIONS = ('DEFLATE', 'ZSTD', 'LZW')
+FLOAT_TYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
+
+_default = os.environ.get('HMT_OUTPUT_FORMAT', DEFAULT_PROFILE)
+
+
+def get_profile(driver=None):
+  """
+  The Profile for driver: the pipeline-wide profile when None, a profile name, or any other GDAL driver name
+  (written with that driver's default creation options)
+  """
+  if driver is None:
+    driver = _default
+  if isinstance(driver, Profile):
+    return driver
+  if driver in PROFILES:
+    return PROFILES[driver]
+  gdal_driver = gdal.GetDriverByName(driver)
+  if gdal_driver is None:
+    raise ValueError("Unknown output format {0}; use one of {1} or a GDAL driver name".format(driver, ', '.join(PROFILES.keys())))
+  extension = gdal_driver.GetMetadataItem(gdal.DMD_EXTENSION) or 'img'
+  return Profile(driver, driver, '.' + extension, None, False)
+
+
+def available(driver=None):
+  """ True when this GDAL has the driver of a format and, for compressed formats, its compression """
+  profile = get_profile(driver)
+  gdal_driver = gdal.GetDriverByName(profile.driver)
+  if gdal_driver is None:
+    return False
+  if profile.compress is None:
+    return True
+  return profile.compress in (gdal_driver.GetMetadataItem(gdal.DMD_CREATIONOPTIONLIST) or '')
+
+
+def set_default(driver):
+  """ Make driver (a profile or GDAL driver name) the pipeline-wide output format of this process """
+  global _default
+  _default = get_profile(driver).name
+  return _default
+
+
+def default():
+  """ Name of the pipeline-wide output format """
+  return _default
+
+
+def extension(driver=None):
+  """ File extension (with the dot) of a format """
+  return get_profile(driver).extension
+
+
+def raster_path(directory, stem, driver=None):
+  """ directory/stem with the extension of a format """
+  return os.path.join(directory, stem + extension(driver))
+
+
+def find_raster(directory, stem, driver=None):
+  """
+  An existing directory/stem raster, preferring the extension of driver, then any other profile's extension;
+  the path in driver's format when there is none yet
+  """
+  preferred = raster_path(directory, stem, driver)
+  if hmt_store.exists(preferred):
+    return preferred
+  for profile in PROFILES.values():
+    candidate = os.path.join(directory, stem + profile.extension)
+    if hmt_store.exists(candidate):
+      return candidate
+  return preferred
+
+
+def tile_size(blocksize=None):
+  """ The largest of TILE_SIZES that divides both sides of blocksize, DEFAULT_TILE_SIZE if none does """
+  if blocksize is None:
+    return DEFAULT_TILE_SIZE
+  for size in TILE_SIZES:
+    if blocksize[0] % size == 0 and blocksize[1] % size == 0:
+      return size
+  return DEFAULT_TILE_SIZE
+
+
+def creation_options(driver=None, datatype=gdal.GDT_Float32, mask=False, blocksize=None):
+  """
+  Creation options of a raster of datatype in a format. mask=True marks a 0/1 Byte raster, written with
+  NBITS=1 (and DEFLATE instead of LERC, which does not pack bits). blocksize is the block size the raster will be
+  written in, used to pick the tile size.
+  """
+  profile = get_profile(driver)
+  if profile.driver != 'GTiff':
+    return []
+  options = ["BIGTIFF=IF_SAFER"]
+  if profile.tiled:
+    size = tile_size(blocksize)
+    options += ["TILED=YES", "BLOCKXSIZE={0}".format(size), "BLOCKYSIZE={0}".format(size)]
+  mask = mask and datatype == gdal.GDT_Byte
+  if mask:
+    options.append("NBITS=1")
+  compress = profile.compress
+  if compress is not None and compress.startswith('LERC') and mask:
+    compress = 'DEFLATE'
+  if compress is not None:
+    options.append("COMPRESS={0}".format(compress))
+    if compress.startswith('LERC'):
+      options.append("MAX_Z_ERROR=0")  # lossless
+    elif compress in PREDICTOR_COMPRESSIONS and not mask:
+      options.append("PREDICTOR={0}".format(3 if datatype in FLOAT_TYPES else 2))
+  return options
+
+
+def create(path, cols, rows, bands=1, datatype=gdal.GDT_Float32, driver=None, mask=False, blocksize=None):
+  """ Create a raster in a format (the pipeline-wide one when driver is None), see creation_options() """
+  profile = get_profile(driver)
+  options = creation_options(profile, datatype, mask=mask, blocksize=blocksize)
+  hmt_handles.forget(path)  # a pooled handle would read the raster being replaced
+  return gdal.GetDriverByName(profile.driver).Create(path, cols, rows, bands, datatype, options)
+
+
+@contextlib.contextmanager
+def config_options(**options):
+  """ Set GDAL configuration options (None unsets one) for the duration of a with block, then restore them """
+  previous = dict((key, gdal.GetConfigOption(key)) for key in options)
+  for key, value in options.items():
+    gdal.SetConfigOption(key, value)
+  try:
+    yield
+  finally:
+    for key, value in previous.items():
+      gdal.SetConfigOption(key, value)
+
+
+def overview_options(dataset):
+  """
+  The COMPRESS_OVERVIEW and PREDICTOR_OVERVIEW configuration options that write the overviews of dataset the way
+  its full resolution is written: LERC (not offered for overviews) becomes DEFLATE, and single-bit masks get no
+  predictor. Both are None (unset) for an uncompressed raster.
+  """
+  compress = dataset.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE')
+  if dataset.GetDriver().ShortName != 'GTiff' or compress is None:
+    return {'COMPRESS_OVERVIEW': None, 'PREDICTOR_OVERVIEW': None}
+  if compress.startswith('LERC'):
+    compress = 'DEFLATE'
+  band = dataset.GetRasterBand(1)
+  predictor = None
+  if compress in PREDICTOR_COMPRESSIONS and band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE') is None:
+    predictor = '3' if band.DataType in FLOAT_TYPES else '2'
+  return {'COMPRESS_OVERVIEW': compress, 'PREDICTOR_OVERVIEW': predictor}
+
+
+def build_overviews(dataset, overviewlist, resampling='NEAREST', **options):
+  """
+  Build the overviews of a raster created by create(), compressed like the raster (see overview_options(); options
+  override those configuration options). The options only apply to this call, other rasters are unaffected.
+  """
+  overview_config = overview_options(dataset)
+  overview_config.update(options)
+  with config_options(**overview_config):
+    return dataset.BuildOverviews(resampling, overviewlist)
+
+
+def dataset_files(path):
+  """ A raster and its sidecars (.aux.xml, .rrd, .ovr, .msk) """
+  base = os.path.splitext(path)[0]
+  return [path] + sorted(set(glob.glob(path + '.*')) | set(glob.glob(base + '.rrd')))
+
+
+def dataset_bytes(path):
+  """ Size on disk of a raster including its sidecars """
+  return sum(os.path.getsize(filename) for filename in dataset_files(path) if os.path.isfile(filename))
+
+
+def delete(path):
+  """ Delete a raster with the driver it was written with """
+  raster_fh = hmt_handles.open_dataset(path)
+  raster_driver = raster_fh.GetDriver()
+  raster_fh = None
+  hmt_handles.forget(path)
+  raster_driver.Delete(path)
+
+
+def rename(path, new_path):
+  """
+  Rename a raster and its sidecars with the driver it was written with (HFA updates its .rrd reference), replacing
+  any raster at new_path. Sidecars the driver does not know about (e.g. block indexes) are renamed too.
+  """
+  if os.path.exists(new_path):
+    delete(new_path)
+  raster_fh = hmt_handles.open_dataset(path)
+  raster_driver = raster_fh.GetDriver()
+  raster_fh = None
+  hmt_handles.forget(path)
+  raster_driver.Rename(new_path, path)
+  for filename in glob.glob(path + '.*'):
+    os.rename(filename, new_path + filename[len(path):])
+  return new_path
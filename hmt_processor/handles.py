@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Pool of open read-only GDAL datasets and parsed spatial references, shared by the stages of a worker.
+
+The stages of a quad open the same rasters again and again: the raw quad for its block index, the CRS check, the
+datum conversion and the NAVD88 binary, and the statewide grids for every quad. open_dataset() returns the handle
+an earlier stage opened, with its parsed header and warm block cache, and keeps at most POOL_SIZE (HMT_POOL_SIZE)
+handles, closing the least recently used. spatial_reference() parses each WKT once.
+
+A handle is reopened when its file changed on disk since it was opened; formats.create() and formats.delete()
+drop the handle of the raster they replace. Pools are per process and per thread (a GDAL dataset must not be used
+by two threads at once), and callers must not modify a pooled dataset or SpatialReference. counters() reports the
+hits and misses, which hmt_processor.metrics records per stage.
+"""
+
+# Import core modules
+import sys
+import os
+import threading
+import collections
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import GDAL et al.
+from osgeo import gdal
+from osgeo import osr
+
+# Open datasets kept per pool
+POOL_SIZE = int(os.environ.get('HMT_POOL_SIZE', 16))
+
+_local = threading.local()
+
+
+def _file_state(path):
+  """ (mtime, size) of a file, None for paths that are not local files (e.g. /vsi paths, VRT strings) """
+  try:
+    stat = os.stat(path)
+  except (OSError, TypeError, ValueError):
+    return None
+  return (stat.st_mtime, stat.st_size)
+
+
+class DatasetPool(object):
+  """ LRU pool of up to size read-only datasets, keyed by absolute path, and of SpatialReferences keyed by WKT """
+
+  def __init__(self, size=POOL_SIZE):
+    self.size = size
+    self._datasets = collections.OrderedDict()  # path -> (dataset, file state when opened), least recently used first
+    self._srs = dict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.srs_hits = 0
+    self.srs_misses = 0
+
+  def open(self, path):
+    """ Read-only dataset of path, opened on a miss; None when GDAL cannot open it (like gdal.Open) """
+    key = _key(path)
+    entry = self._datasets.pop(key, None)
+    if entry is not None and entry[1] == _file_state(path):
+      self._datasets[key] = entry  # most recently used
+      self.hits += 1
+      return entry[0]
+    
+    self.misses += 1
+    dataset = gdal.Open(path, gdal.GA_ReadOnly)
+    if dataset is None or self.size <= 0:
+      return dataset
+    self._datasets[key] = (dataset, _file_state(path))
+    while len(self._datasets) > self.size:
+      self._datasets.popitem(last=False)
+      self.evictions += 1
+    return dataset
+
+  def spatial_reference(self, wkt):
+    """ SpatialReference parsed from wkt """
+    srs = self._srs.get(wkt)
+    if srs is not None:
+      self.srs_hits += 1
+      return srs
+    self.srs_misses += 1
+    srs = self._srs[wkt] = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    return srs
+
+  def forget(self, path):
+    """ Drop the handle of path, if pooled """
+    self._datasets.pop(_key(path), None)
+
+  def clear(self):
+    """ Close every pooled dataset """
+    self._datasets.clear()
+    self._srs.clear()
+
+  def counters(self):
+    """ Hits, misses and evictions of the datasets and SpatialReferences so far """
+    return {'handle_hits': self.hits, 'handle_misses': self.misses, 'handle_evictions': self.evictions,
+            'srs_hits': self.srs_hits, 'srs_misses': self.srs_misses}
+
+
+def _key(path):
+  if path.startswith('/vsi') or path.startswith('<'):
+    return path
+  return os.path.abspath(path)
+
+
+def pool():
+  """ The DatasetPool of this process and thread """
+  current = getattr(_local, 'pool', None)
+  if current is None or _local.pid != os.getpid():  # a forked worker starts with an empty pool
+    current = _local.pool = DatasetPool()
+    _local.pid = os.getpid()
+  return current
+
+
+def open_dataset(path):
+  """ Pooled read-only dataset of path, see DatasetPool.open() """
+  return pool().open(path)
+
+
+def spatial_reference(wkt):
+  """ Pooled SpatialReference of a WKT string """
+  return pool().spatial_reference(wkt)
+
+
+def dataset_srs(path):
+  """ Pooled SpatialReference of the projection of a dataset """
+  return pool().spatial_reference(pool().open(path).GetProjection())
+
+
+def forget(path):
+  """ Drop the handle of a raster that is about to be replaced or deleted """
+  pool().forget(path)
+
+
+def counters():
+  """ DatasetPool.counters() of this process and thread """
+  return pool().counters()
@@ -28,9 +28,6 @@ import pprint
 import logging
 logger = logging.getLogger('hmt_processor')
 
-# Import Parallel Python
-import pp
-
 # Import Numpy
 import numpy as np
 
@@ -39,221 +36,377 @@ from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 
-# Fix osgeo error reporting
-gdal.UseExceptions()
-ogr.UseExceptions()
-osr.UseExceptions()
+import gmtools.geospatial as gm_geo
 
-# Set gdal configuration parameters
-gdal.SetCacheMax(2147483648)  # 2 GB. This sets the caching max size for gdal. Bigger number can lead to faster reads / writes
-gdal.SetConfigOption('HFA_USE_RRD', 'YES')  # Configure GDAL to use blocks
+import dtypes as hmt_dtypes
+import handles as hmt_handles
+import objectstore as hmt_store
+import sharedgrids as hmt_shared
+
+
+
+# Extra source cells needed on each side of a window by each resampling kernel
+RESAMPLING_RADIUS = {
+    gdal.GRA_NearestNeighbour: 1,
+    gdal.GRA_Bilinear: 1,
+    gdal.GRA_Cubic: 2,
+    gdal.GRA_CubicSpline: 2,
+    gdal.GRA_Lanczos: 3,
+}
+
+
+def footprint_in_srs(minx, maxx, miny, maxy, footprint_wkt, target_wkt, densify=21):
+    """
+    Return the bounding box (minx, maxx, miny, maxy) of a footprint after transforming it into another SRS.
+    The footprint edges are densified so curved edges in the target SRS are still covered.
+    """
+    footprint_srs = osr.SpatialReference()
+    footprint_srs.ImportFromWkt(footprint_wkt)
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromWkt(target_wkt)
+    if footprint_srs.IsSame(target_srs):
+        return (minx, maxx, miny, maxy)
+    
+    # Keep x/y axis order regardless of the GDAL version
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        footprint_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(footprint_srs, target_srs)
+    
+    edge_x = np.linspace(minx, maxx, densify)
+    edge_y = np.linspace(miny, maxy, densify)
+    points_x = np.concatenate([edge_x, edge_x, np.repeat(minx, densify), np.repeat(maxx, densify)])
+    points_y = np.concatenate([np.repeat(miny, densify), np.repeat(maxy, densify), edge_y, edge_y])
+    transformed = np.array(transform.TransformPoints(list(zip(points_x.tolist(), points_y.tolist()))))
+    return (transformed[:, 0].min(), transformed[:, 0].max(), transformed[:, 1].min(), transformed[:, 1].max())
+
+
+def source_window_for_footprint(src_dataset, minx, maxx, miny, maxy, halo=1):
+    """
+    Compute the source pixel Window (xoff, yoff, xsize, ysize) covering a footprint given in the source SRS.
+    The window is grown by halo cells on each side for the resampling kernel and clipped to the source raster.
+    The window is empty when the footprint does not overlap the source.
+    """
+    src_geo_t = gm_geo.GeoTransform.from_gdal(src_dataset)
+    window = src_geo_t.window_for_bounds(minx, maxx, miny, maxy, snap='out')
+    return window.grown(halo).clipped(src_dataset.RasterXSize, src_dataset.RasterYSize)
+
+
+def read_source_window(src_dataset, window, bands=None):
+    """
+    Copy a pixel window (xoff, yoff, xsize, ysize) of src_dataset into a MEM dataset carrying the
+    window's geotransform, the source projection and the nodata values of the copied bands.
+    bands is a list of source band numbers, all bands by default.
+    """
+    window = gm_geo.Window(*window)
+    xoff, yoff, xsize, ysize = window
+    if bands is None:
+        bands = range(1, src_dataset.RasterCount + 1)
+    bands = list(bands)
+    src_geo_t = gm_geo.GeoTransform.from_gdal(src_dataset)
+    
+    mem_drv = gdal.GetDriverByName('MEM')
+    window_type = hmt_dtypes.stack_type([src_dataset.GetRasterBand(band_n).DataType for band_n in bands])
+    window_dataset = mem_drv.Create('', xsize, ysize, len(bands), window_type)
+    window_dataset.SetGeoTransform(src_geo_t.window_transform(window))
+    window_dataset.SetProjection(src_dataset.GetProjection())
+    for window_band_n, src_band_n in enumerate(bands, 1):
+        src_band = src_dataset.GetRasterBand(src_band_n)
+        window_band = window_dataset.GetRasterBand(window_band_n)
+        window_band.WriteArray(src_band.ReadAsArray(xoff, yoff, xsize, ysize), 0, 0)
+        if src_band.GetNoDataValue() is not None:
+            window_band.SetNoDataValue(src_band.GetNoDataValue())
+    return window_dataset
+
+
+def window_halo(src_dataset, target_cellsize, respample_method):
+    """ Number of source cells kept around a window so respample_method has its full kernel at the edges """
+    radius = RESAMPLING_RADIUS.get(respample_method, 3)
+    src_cellsize = abs(src_dataset.GetGeoTransform()[1])
+    scale = max(1, int(np.ceil(abs(target_cellsize)/src_cellsize)))  # kernels grow when downsampling
+    return radius*scale + 1
 
-import gmtools.geospatial as gm_geo
 
+def read_source_window_for_target(src_dataset, target_geotransform, target_cols, target_rows, target_wkt=None, band=None, respample_method=gdal.GRA_NearestNeighbour, src_wkt=None):
+    """
+    Read the source window that covers a target footprint (plus a resampling halo) into a MEM dataset.
+    
+    band is a single source band number or None for all bands; src_wkt overrides the source projection.
+    Returns None when the footprint does not overlap the source.
+    """
+    target_minx, target_maxx, target_miny, target_maxy = gm_geo.GeoTransform.from_gdal(target_geotransform).bounds(target_cols, target_rows)
+    if src_wkt is None:
+        src_wkt = src_dataset.GetProjection()
+    if not target_wkt:
+        target_wkt = src_wkt
+    
+    # Find the source window for the target footprint
+    minx, maxx, miny, maxy = footprint_in_srs(target_minx, target_maxx, target_miny, target_maxy, target_wkt, src_wkt)
+    halo = window_halo(src_dataset, target_geotransform[1], respample_method)
+    window = source_window_for_footprint(src_dataset, minx, maxx, miny, maxy, halo=halo)
+    logger.info("        source window: xoff={0}, yoff={1}, xsize={2}, ysize={3}".format(*window))
+    if window.is_empty:
+        logger.warn("        target footprint does not overlap the source dataset.")
+        return None
+    
+    bands = None if band is None else [band]
+    window_dataset = read_source_window(src_dataset, window, bands=bands)
+    window_dataset.SetProjection(src_wkt)
+    return window_dataset
+
+
+def warp_source_window(src_dataset, target_dataset, band=None, respample_method=gdal.GRA_NearestNeighbour, maxmem=500, src_wkt=None):
+    """
+    Warp src_dataset into target_dataset reading only the source window that covers the target footprint
+    (plus a resampling halo). Source I/O is proportional to the size of the target, not of the source.
+    
+    band is a single source band number or None for all bands; src_wkt overrides the source projection.
+    Returns False when the footprint does not overlap the source and nothing was warped.
+    """
+    target_wkt = target_dataset.GetProjection()
+    src_window_dataset = read_source_window_for_target(src_dataset, target_dataset.GetGeoTransform(), target_dataset.RasterXSize, target_dataset.RasterYSize,
+                                                       target_wkt=target_wkt, band=band, respample_method=respample_method, src_wkt=src_wkt)
+    if src_window_dataset is None:
+        return False
+    
+    # Warp the in-memory window
+    gdal.ReprojectImage(src_window_dataset, target_dataset, src_window_dataset.GetProjection(), target_wkt or src_window_dataset.GetProjection(), respample_method, maxmem)
+    src_window_dataset = None
+    return True
+
+
+def grid_signature(dataset):
+    """ Key that is equal for datasets on the same grid (geotransform, size and projection) """
+    return (tuple(dataset.GetGeoTransform()), dataset.RasterXSize, dataset.RasterYSize, dataset.GetProjection())
+
+
+def stack_datasets_as_bands(dataset_paths, band=1):
+    """
+    Stack band `band` of each dataset in dataset_paths, which must all be on the same grid, as the bands of one
+    virtual (VRT) dataset. Nothing is copied; the VRT reads from the source datasets.
+    """
+    datasets = [hmt_handles.open_dataset(dataset_path) for dataset_path in dataset_paths]
+    assert(len(set(grid_signature(dataset) for dataset in datasets)) == 1), "datasets are not on the same grid"
+    stack_dataset = gdal.BuildVRT('', list(dataset_paths), separate=True, bandList=[band])
+    
+    # Carry the nodata value of each source over to its band
+    for band_n, dataset in enumerate(datasets, 1):
+        src_nodata = dataset.GetRasterBand(band).GetNoDataValue()
+        if src_nodata is not None:
+            stack_dataset.GetRasterBand(band_n).SetNoDataValue(src_nodata)
+    datasets = None
+    return stack_dataset
 
 
 def reproject_window_offset(src_dataset, topleft_x, topleft_y, window_xrange, window_yrange, desired_cellsize_x, desired_cellsize_y, band=1, epsg_from=None, epsg_to=None, respample_method=gdal.GRA_NearestNeighbour, blocksize=500, maxmem=500 ):
     """
+    Warp the part of src_dataset that starts at world coordinate (topleft_x, topleft_y) and spans
+    window_xrange x window_yrange cells of the desired cell size into a new MEM dataset.
+    desired_cellsize_y is usually negative (north-up).
+    """
+    maxx = topleft_x + window_xrange*desired_cellsize_x
+    miny = topleft_y + window_yrange*desired_cellsize_y
+    return reproject_window(src_dataset, topleft_x, maxx, miny, topleft_y, cellsize_x=desired_cellsize_x, cellsize_y=desired_cellsize_y, band=band, epsg_from=epsg_from, epsg_to=epsg_to, respample_method=respample_method, blocksize=blocksize, maxmem=maxmem)
+
+
+def reproject_window(src_dataset, minx, maxx, miny, maxy, cellsize_x=None, cellsize_y=None, band=1, epsg_from=None, epsg_to=None, respample_method=gdal.GRA_NearestNeighbour, blocksize=500, maxmem=500 ):
+    """
+    Warp the footprint (minx, maxx, miny, maxy) of src_dataset into a new MEM dataset.
+    
+    The footprint and cell sizes are in the target SRS (epsg_to, the source SRS by default); cell sizes default to
+    the source cell size. Only the source window covering the footprint (plus a resampling halo) is read.
+    
     adapted from http://jgomezdans.github.com/gdal_notes/reprojection.html
     """
     logger.info("        setting up the metadata and window parameters...")
-    logger.info("          topleft_x={0}, topleft_y={1}, window_xrange={2}, window_yrange={3}, desired_cellsize_x={4}, desired_cellsize_y={5}".format(topleft_x, topleft_y, window_xrange, window_yrange, desired_cellsize_x, desired_cellsize_y))
-    
-    # Open the memory driver
-    mem_drv = gdal.GetDriverByName( 'MEM' )
+    logger.info("          minx={0}, maxx={1}, miny={2}, maxy={3}".format(minx, maxx, miny, maxy))
     
     # Setup the spatial refereneces
-    src_srs = osr.SpatialReference()
-    src_srs.ImportFromWkt(src_dataset.GetProjection())
-    
+    if epsg_from is not None:
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromEPSG(epsg_from)
+    else:
+        src_srs = hmt_handles.spatial_reference(src_dataset.GetProjection())
     target_srs = osr.SpatialReference()
-    target_srs = src_srs
+    if epsg_to is not None:
+        target_srs.ImportFromEPSG(epsg_to)
+    else:
+        target_srs = src_srs
     
     # Get band metadata
     data_band = src_dataset.GetRasterBand(band)
     data_band_type = data_band.DataType
-    logger.info("        data_band_type: {0}".format(data_band_type))
-    
-    # Get Projection
-    src_projection = src_dataset.GetProjection()
-    
-    # Get the Geotransform vector
-    src_geo_t = src_dataset.GetGeoTransform()  # top left x, w-e pixel res, rotation, top left y, rotation, n-s pixel res
-    src_originX = src_geo_t[0]
-    src_originY = src_geo_t[3]
-    src_pixelWidth = src_geo_t[1]
-    src_pixelHeight = src_geo_t[5]
-    src_fullsize_num_cols = src_dataset.RasterXSize # Raster xsize
-    src_fullsize_num_rows = src_dataset.RasterYSize # Raster ysize
-    
-    logger.info('        src_pixelWidth: {0}'.format(src_pixelWidth))
-    logger.info('        src_pixelHeight: {0}'.format(src_pixelHeight))
-    logger.info("        src_fullsize_num_cols: {0}".format(src_fullsize_num_cols))
-    logger.info("        src_fullsize_num_rows: {0}".format(src_fullsize_num_rows))
-    
-    # Do coordinate translations between world and pixel coordinates
-    window_xOffset_px, window_yOffset_px = gm_geo.World2PixelCoords(src_geo_t, topleft_x, topleft_y)   # Source Pixel Coodinates
-    logger.info("        window_xOffset_px: {0}".format(window_xOffset_px))
-    logger.info("        window_yOffset_px: {0}".format(window_yOffset_px))
-    
-    # Query the window
-    logger.info("        extracting window from data...")
-    window_array = data_band.ReadAsArray(window_left_x_px, window_top_y_px, window_xrange, window_yrange)
-    logger.info("          window_array_shape: {0}".format(window_array.shape))
-    logger.info("          window_array min: {0}".format(window_array.min()))
-    logger.info("          window_array max: {0}".format(window_array.max()))
-    logger.info("         done.")
-    
-    # Hold the window data in a new memory-based raster so we can reproject
-    src_window_dataset = mem_drv.Create('', window_xrange, window_yrange, 1, data_band_type)
-    new_geotransform =  [minx, pixelWidth, 0, maxy, 0, pixelHeight]
-    #logger.info('window geotransform')
-    #logger.info(new_geotransform)
-    src_window_dataset.SetGeoTransform(new_geotransform)
-    src_window_dataset.SetProjection(src_projection)
-    window_src_band = src_window_dataset.GetRasterBand(1)
-    window_src_band.WriteArray(window_array, 0, 0)
-    window_src_band.FlushCache()
-    window_src_band.ComputeStatistics(True)
-    
-    # Clean up
-    window_array = None
-    window_src_band = None
-    data_band = None
-    src_dataset = None
+    data_band_nodata = data_band.GetNoDataValue()
     
-    # Calculate the new geotransform
-    new_geo = ( minx, cellsize_x, 0, maxy, 0, cellsize_y )
-    
-    # Resampled Pixel Coodinates
-    minx_px_rs, maxy_px_rs = gm_geo.World2PixelCoords(new_geo, minx, maxy)  # Top left
-    maxx_px_rs, miny_px_rs = gm_geo.World2PixelCoords(new_geo, maxx, miny)  # Bottom right
-    window_xrange_rs = maxx_px_rs - minx_px_rs
-    window_yrange_rs = (maxy_px_rs - miny_px_rs)*-1  # *-1 because we have a negative cell size
+    # Default to the source cell size
+    src_geo_t = src_dataset.GetGeoTransform()
+    if cellsize_x is None: cellsize_x = src_geo_t[1]
+    if cellsize_y is None: cellsize_y = src_geo_t[5]
+    cellsize_y = -abs(cellsize_y)  # north-up
     
+    # Size of the target in cells
+    window_xrange_rs = int(round((maxx - minx)/cellsize_x))
+    window_yrange_rs = int(round((miny - maxy)/cellsize_y))
     logger.info("        window_xrange_rs: {0}".format(window_xrange_rs))
     logger.info("        window_yrange_rs: {0}".format(window_yrange_rs))
     
-    target_dataset = mem_drv.Create('', window_xrange_rs, window_yrange_rs, 1, data_band_type)
-    
-    # Set the geotransform
-    #logger.info('resample geotransform')
-    #logger.info(new_geo)
-    target_dataset.SetGeoTransform( new_geo )
+    # Create the target dataset
+    mem_drv = gdal.GetDriverByName( 'MEM' )
+    target_dataset = mem_drv.Create('', window_xrange_rs, window_yrange_rs, 1, hmt_dtypes.surface_type(data_band_type))
+    target_dataset.SetGeoTransform( (minx, cellsize_x, 0, maxy, 0, cellsize_y) )
     target_dataset.SetProjection ( target_srs.ExportToWkt() )
+    if data_band_nodata is not None:
+        target_dataset.GetRasterBand(1).SetNoDataValue(data_band_nodata)
+        target_dataset.GetRasterBand(1).Fill(data_band_nodata)
     
     # Perform the projection/resampling
-    logger.info("        reshaping MHHW raster to match window and cellsize...")
-    res = gdal.ReprojectImage( src_window_dataset, target_dataset, src_srs.ExportToWkt(), target_srs.ExportToWkt(), respample_method, maxmem )
+    logger.info("        warping the source window...")
+    warp_source_window(src_dataset, target_dataset, band=band, respample_method=respample_method, maxmem=maxmem, src_wkt=src_srs.ExportToWkt())
     logger.info("          done.")
     
     return target_dataset
 
 
-def reproject_window(src_dataset, minx, maxx, miny, maxy, cellsize_x=None, cellsize_y=None, band=1, epsg_from=None, epsg_to=None, respample_method=gdal.GRA_NearestNeighbour, blocksize=500, maxmem=500 ):
-    """
-    adapted from http://jgomezdans.github.com/gdal_notes/reprojection.html
+def datasets_share_crs(*dataset_paths):
+    """ Return True when every dataset in dataset_paths is in the same coordinate reference system """
+    reference_srs = None
+    for dataset_path in dataset_paths:
+        dataset_srs = hmt_handles.dataset_srs(dataset_path)
+        if reference_srs is None:
+            reference_srs = dataset_srs
+        elif not reference_srs.IsSame(dataset_srs):
+            return False
+    return True
+
+
+def read_grid_window(grid_path, template_geotransform, template_cols, template_rows, band=1, halo=1):
     """
-    logger.info("        setting up the metadata and window parameters...")
-    logger.info("          minx={0}, maxx={1}, miny={2}, maxy={3}".format(minx, maxx, miny, maxy))
+    Read the part of a (coarse) grid that covers the footprint of a template raster into memory.
     
-    # Open the memory driver
-    mem_drv = gdal.GetDriverByName( 'MEM' )
-    
-    # Setup the spatial refereneces
-    src_srs = osr.SpatialReference()
-    src_srs.ImportFromWkt(src_dataset.GetProjection())
-    
-    target_srs = osr.SpatialReference()
-    target_srs = src_srs
+    Both rasters must share a CRS and be north-up. halo is the number of extra grid cells kept around
+    the footprint so bilinear sampling at the edges of the footprint has all four neighbours.
     
-    # Get band metadata
-    data_band = src_dataset.GetRasterBand(band)
-    data_band_type = data_band.DataType
-    logger.info("        data_band_type: {0}".format(data_band_type))
-    
-    # Get Projection
-    src_projection = src_dataset.GetProjection()
-    
-    # Get the Geotransform vector
-    geo_t = src_dataset.GetGeoTransform()  # top left x, w-e pixel res, rotation, top left y, rotation, n-s pixel res
-    originX = geo_t[0]
-    originY = geo_t[3]
-    pixelWidth = geo_t[1]
-    pixelHeight = geo_t[5]
-    fullsize_num_cols = src_dataset.RasterXSize # Raster xsize
-    fullsize_num_rows = src_dataset.RasterYSize # Raster ysize
-    
-    logger.info('        pixelWidth: {0}'.format(pixelWidth))
-    logger.info('        pixelHeight: {0}'.format(pixelHeight))
-    logger.info("        fullsize_num_cols: {0}".format(fullsize_num_cols))
-    logger.info("        fullsize_num_rows: {0}".format(fullsize_num_rows))
-    
-    # Do coordinate translations between world and pixel coordinates
-    window_xOffset_px, window_yOffset_px = gm_geo.World2PixelCoords(geo_t, minx, maxy)   # Source Pixel Coodinates
-    window_left_x_px, window_top_y_px = gm_geo.World2PixelCoords(geo_t, minx, maxy)      # Top left
-    window_right_x_px, window_bottom_y_px = gm_geo.World2PixelCoords(geo_t, maxx, miny)  # Bottom right
-    window_xrange = window_right_x_px - window_left_x_px                                 # window width in pixel units
-    window_yrange = (window_top_y_px - window_bottom_y_px)*-1                            # *-1 because we have a negative cell size
-    
-    logger.info("        window_xOffset_px: {0}".format(window_xOffset_px))
-    logger.info("        window_yOffset_px: {0}".format(window_yOffset_px))
-    logger.info("        window_left_x_px: {0}".format(window_left_x_px))
-    logger.info("        window_right_x_px: {0}".format(window_right_x_px))
-    logger.info("        window_bottom_y_px: {0}".format(window_bottom_y_px))
-    logger.info("        window_top_y_px: {0}".format(window_top_y_px))
-    logger.info("        window_xrange: {0}".format(window_xrange))
-    logger.info("        window_yrange: {0}".format(window_yrange))
-    
-    # Query the window
-    logger.info("        extracting window from data...")
-    window_array = data_band.ReadAsArray(window_left_x_px, window_top_y_px, window_xrange, window_yrange)
-    logger.info("          window_array_shape: {0}".format(window_array.shape))
-    logger.info("          window_array min: {0}".format(window_array.min()))
-    logger.info("          window_array max: {0}".format(window_array.max()))
-    logger.info("         done.")
-    
-    # Hold the window data in a new memory-based raster so we can reproject
-    src_window_dataset = mem_drv.Create('', window_xrange, window_yrange, 1, data_band_type)
-    new_geotransform =  [minx, pixelWidth, 0, maxy, 0, pixelHeight]
-    #logger.info('window geotransform')
-    #logger.info(new_geotransform)
-    src_window_dataset.SetGeoTransform(new_geotransform)
-    src_window_dataset.SetProjection(src_projection)
-    window_src_band = src_window_dataset.GetRasterBand(1)
-    window_src_band.WriteArray(window_array, 0, 0)
-    window_src_band.FlushCache()
-    window_src_band.ComputeStatistics(True)
+    Returns (window_array, window_geotransform). window_array is float32 with nodata cells set to NaN. For a grid
+    published to shared memory (see sharedgrids.py) it is a read-only view of the shared copy.
+    """
+    template_geo_t = gm_geo.GeoTransform.from_gdal(template_geotransform)
+    shared = hmt_shared.lookup(grid_path, band)
+    if shared is not None:
+        shared_array, shared_geo_t = shared
+        window = template_geo_t.window_in(shared_geo_t, template_cols, template_rows).grown(halo).clipped(shared_array.shape[1], shared_array.shape[0])
+        logger.info("        shared grid window: xoff={0}, yoff={1}, xsize={2}, ysize={3}".format(*window))
+        if window.is_empty:
+            logger.warn("        template footprint does not overlap the grid.")
+            return np.empty((0, 0), dtype=np.float32), shared_geo_t.window_transform(window)
+        return shared_array[window.slices], shared_geo_t.window_transform(window)
+    
+    grid_fh = hmt_handles.open_dataset(grid_path)
+    grid_geo_t = gm_geo.GeoTransform.from_gdal(grid_fh)
+    grid_band = grid_fh.GetRasterBand(band)
+    grid_nodata = grid_band.GetNoDataValue()
+    assert(grid_geo_t.is_north_up), "rotated grids are not supported"
+    
+    # Footprint of the template in grid pixels, grown outwards by the halo and clipped to the grid
+    window = template_geo_t.window_in(grid_geo_t, template_cols, template_rows).grown(halo).clipped(grid_fh.RasterXSize, grid_fh.RasterYSize)
+    xoff, yoff, xsize, ysize = window
+    logger.info("        grid window: xoff={0}, yoff={1}, xsize={2}, ysize={3}".format(xoff, yoff, xsize, ysize))
+    
+    window_geo_t = grid_geo_t.window_transform(window)
+    if window.is_empty:
+        logger.warn("        template footprint does not overlap the grid.")
+        grid_fh = None
+        return np.empty((0, 0), dtype=np.float32), window_geo_t
+    
+    window_array = hmt_store.read_window(grid_path, band, xoff, yoff, xsize, ysize).astype(np.float32)  # remote grids through the block cache
+    if grid_nodata is not None:
+        window_array[window_array == np.float32(grid_nodata)] = np.nan
     
     # Clean up
-    window_array = None
-    window_src_band = None
-    data_band = None
-    src_dataset = None
-    
-    # Calculate the new geotransform
-    new_geo = ( minx, cellsize_x, 0, maxy, 0, cellsize_y )
-    
-    # Resampled Pixel Coodinates
-    minx_px_rs, maxy_px_rs = gm_geo.World2PixelCoords(new_geo, minx, maxy)  # Top left
-    maxx_px_rs, miny_px_rs = gm_geo.World2PixelCoords(new_geo, maxx, miny)  # Bottom right
-    window_xrange_rs = maxx_px_rs - minx_px_rs
-    window_yrange_rs = (maxy_px_rs - miny_px_rs)*-1  # *-1 because we have a negative cell size
+    grid_band = None
+    grid_fh = None
     
-    logger.info("        window_xrange_rs: {0}".format(window_xrange_rs))
-    logger.info("        window_yrange_rs: {0}".format(window_yrange_rs))
-    
-    target_dataset = mem_drv.Create('', window_xrange_rs, window_yrange_rs, 1, data_band_type)
+    return window_array, window_geo_t
+
+
+def bilinear_sample(grid_array, grid_geotransform, target_geotransform, xoff, yoff, cols, rows):
+    """
+    Bilinearly sample an in-memory grid at the cell centres of a block of a target raster.
     
-    # Set the geotransform
-    #logger.info('resample geotransform')
-    #logger.info(new_geo)
-    target_dataset.SetGeoTransform( new_geo )
-    target_dataset.SetProjection ( target_srs.ExportToWkt() )
+    The grid and target must share a CRS and be north-up, so the mapping between them is pure affine
+    index math. NaN grid cells are left out of the weighted average (like GDAL's warper does with nodata);
+    target cells outside the grid or without a valid neighbour come back as NaN.
     
-    # Perform the projection/resampling
-    logger.info("        reshaping MHHW raster to match window and cellsize...")
-    res = gdal.ReprojectImage( src_window_dataset, target_dataset, src_srs.ExportToWkt(), target_srs.ExportToWkt(), respample_method, maxmem )
-    logger.info("          done.")
+    Returns a float32 array of shape (rows, cols).
+    """
+    grid_rows, grid_cols = grid_array.shape
+    if grid_rows == 0 or grid_cols == 0:
+        return np.full((rows, cols), np.nan, dtype=np.float32)
+    
+    # Target cell centres in world coordinates. Rows and cols are separable because nothing is rotated.
+    world_x, world_y = gm_geo.GeoTransform.from_gdal(target_geotransform).cell_centers(gm_geo.Window(xoff, yoff, cols, rows))
+    
+    # Fractional grid coordinates measured from the centre of the first grid cell
+    grid_geo_t = gm_geo.GeoTransform.from_gdal(grid_geotransform)
+    assert(grid_geo_t.is_north_up), "rotated grids are not supported"
+    grid_x = grid_geo_t.inverse(world_x, np.repeat(grid_geo_t.origin_y, cols))[0] - 0.5
+    grid_y = grid_geo_t.inverse(np.repeat(grid_geo_t.origin_x, rows), world_y)[1] - 0.5
+    outside_x = (grid_x < -0.5) | (grid_x > grid_cols - 0.5)
+    outside_y = (grid_y < -0.5) | (grid_y > grid_rows - 0.5)
+    
+    # Neighbouring grid cells and weights; clamp to the edge cells within the outer half cell of the grid
+    x0 = np.clip(np.floor(grid_x).astype(np.intp), 0, grid_cols - 1)
+    y0 = np.clip(np.floor(grid_y).astype(np.intp), 0, grid_rows - 1)
+    x1 = np.minimum(x0 + 1, grid_cols - 1)
+    y1 = np.minimum(y0 + 1, grid_rows - 1)
+    wx = np.clip(grid_x - x0, 0.0, 1.0).astype(np.float32)[np.newaxis, :]
+    wy = np.clip(grid_y - y0, 0.0, 1.0).astype(np.float32)[:, np.newaxis]
+    
+    value_sum = np.zeros((rows, cols), dtype=np.float32)
+    weight_sum = np.zeros((rows, cols), dtype=np.float32)
+    for row_idx, row_weight in ((y0, 1 - wy), (y1, wy)):
+        for col_idx, col_weight in ((x0, 1 - wx), (x1, wx)):
+            corner = grid_array[row_idx[:, np.newaxis], col_idx[np.newaxis, :]]
+            weight = row_weight*col_weight
+            weight = np.where(np.isnan(corner), np.float32(0), weight)
+            value_sum += np.where(np.isnan(corner), np.float32(0), corner)*weight
+            weight_sum += weight
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sampled = value_sum/weight_sum
+    sampled[weight_sum <= 0] = np.nan
+    sampled[outside_y, :] = np.nan
+    sampled[:, outside_x] = np.nan
+    return sampled
+
+
+def bilinear_sample_bounds(grid_array, grid_geotransform, target_geotransform, xoff, yoff, cols, rows):
+    """
+    Bound the values bilinear_sample() would return for a block of a target raster without sampling it.
     
-    return target_dataset
+    Bilinear values are weighted averages of neighbouring grid cells, so they lie between the smallest and
+    largest grid cell the block touches. Returns (minimum, maximum, complete); complete is False when some
+    sampled values could be NaN (nodata grid cells or cells outside the grid), in which case the bounds are NaN.
+    """
+    grid_rows, grid_cols = grid_array.shape
+    if grid_rows == 0 or grid_cols == 0:
+        return (np.nan, np.nan, False)
+    
+    # Fractional grid coordinates of the first and last cell centres of the block
+    target_geo_t = gm_geo.GeoTransform.from_gdal(target_geotransform)
+    grid_geo_t = gm_geo.GeoTransform.from_gdal(grid_geotransform)
+    corner_x, corner_y = target_geo_t.forward([xoff + 0.5, xoff + cols - 0.5], [yoff + 0.5, yoff + rows - 0.5])
+    grid_x, grid_y = grid_geo_t.inverse(corner_x, corner_y)
+    grid_x = grid_x - 0.5
+    grid_y = grid_y - 0.5
+    if grid_x.min() < -0.5 or grid_x.max() > grid_cols - 0.5 or grid_y.min() < -0.5 or grid_y.max() > grid_rows - 0.5:
+        return (np.nan, np.nan, False)
+    
+    # Every grid cell that takes part in the sampling
+    x_lo = int(np.clip(np.floor(grid_x.min()), 0, grid_cols - 1))
+    y_lo = int(np.clip(np.floor(grid_y.min()), 0, grid_rows - 1))
+    x_hi = min(int(np.clip(np.floor(grid_x.max()), 0, grid_cols - 1)) + 1, grid_cols - 1)
+    y_hi = min(int(np.clip(np.floor(grid_y.max()), 0, grid_rows - 1)) + 1, grid_rows - 1)
+    touched = grid_array[y_lo:y_hi + 1, x_lo:x_hi + 1]
+    if np.isnan(touched).any():
+        return (np.nan, np.nan, False)
+    return (float(touched.min()), float(touched.max()), True)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+One-time ingest of the raw LiDAR quads.
+
+The raw quads (data/LIDAR/<block>/raw/<quad>) are ArcInfo grid directories, which are slow to read in windows.
+ingest_quad() converts a quad to an internally tiled, predictor-compressed GeoTIFF (or a Cloud Optimized GeoTIFF)
+in data/LIDAR/<block>/ingested/<quad>.tif, builds its overviews and the block index the processors prune with.
+source_path() returns the ingested copy when it is up to date with the raw grid, so the pipeline reads it
+without any other change.
+"""
+
+# Import core modules
+import sys
+import os
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import block_index as hmt_blocks
+import scheduler as hmt_scheduler
+import runtime as hmt_runtime
+import catalog as hmt_catalog
+import dtypes as hmt_dtypes
+import objectstore as hmt_store
+import formats as hmt_formats
+
+INGESTED_FOLDER = 'ingested'
+TILE_SIZE = 256
+OVERVIEWS = [2, 4, 8, 16, 32, 64, 128]
+
+
+def ingested_path(raw_quad_path):
+  """ data/LIDAR/<block>/ingested/<quad>.tif for data/LIDAR/<block>/raw/<quad> (in the local mirror of a remote block) """
+  raw_quad_path = raw_quad_path.rstrip(os.sep)
+  block_dir = os.path.dirname(os.path.dirname(raw_quad_path))
+  return hmt_store.local_path(os.path.join(block_dir, INGESTED_FOLDER, os.path.basename(raw_quad_path) + ".tif"))
+
+
+def newest_mtime(path):
+  """ Latest modification time of a file, or of any file in a grid directory """
+  if not hmt_store.isdir(path):
+    return hmt_store.getmtime(path)
+  return max([hmt_store.getmtime(path)] + [hmt_store.getmtime(filename) for filename in hmt_store.walk_files(path)])
+
+
+def source_path(raw_quad_path):
+  """ The ingested copy of a raw quad if it exists and is newer than the raw grid, else the raw quad """
+  ingested = ingested_path(raw_quad_path)
+  if os.path.exists(ingested) and os.path.getmtime(ingested) >= newest_mtime(raw_quad_path):
+    return ingested
+  return raw_quad_path
+
+
+def creation_options(cog=False, compress='DEFLATE', predictor=3, tile_size=TILE_SIZE):
+  """ GeoTIFF / COG creation options; predictor 3 is the floating point predictor """
+  options = ["COMPRESS={0}".format(compress), "PREDICTOR={0}".format(predictor), "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS"]
+  if cog:
+    return options + ["BLOCKSIZE={0}".format(tile_size), "OVERVIEWS=AUTO"]
+  return options + ["TILED=YES", "BLOCKXSIZE={0}".format(tile_size), "BLOCKYSIZE={0}".format(tile_size)]
+
+
+def ingest_quad(raw_quad_path, output_path=None, index_path=None, index_blocksize=(600,600), cog=False, compress='DEFLATE', predictor=3):
+  """
+  Convert a raw quad to a tiled, compressed GeoTIFF (a COG when cog=True and GDAL has the COG driver) with
+  overviews, and build its block index at index_path (the sidecar of the GeoTIFF by default). Returns the path.
+  """
+  if output_path is None: output_path = ingested_path(raw_quad_path)
+  if not os.path.exists(os.path.dirname(output_path)):
+    os.makedirs(os.path.dirname(output_path))
+  if cog and gdal.GetDriverByName('COG') is None:
+    logger.warn("  This GDAL has no COG driver, writing a tiled GeoTIFF")
+    cog = False
+  
+  logger.info("  Ingesting {0} to {1}...".format(raw_quad_path, output_path))
+  raw_quad_fh = gdal.Open(raw_quad_path, gdal.GA_ReadOnly)
+  output_type = hmt_dtypes.surface_type(raw_quad_fh.GetRasterBand(1).DataType)  # float64 grids are stored as float32
+  raw_quad_fh = None
+  if cog:
+    # The COG driver writes its own overviews
+    gdal.Translate(output_path, raw_quad_path, format='COG', outputType=output_type, creationOptions=creation_options(True, compress, predictor))
+  else:
+    output_fh = gdal.Translate(output_path, raw_quad_path, format='GTiff', outputType=output_type, creationOptions=creation_options(False, compress, predictor))
+    hmt_formats.build_overviews(output_fh, OVERVIEWS, 'AVERAGE', COMPRESS_OVERVIEW=compress, PREDICTOR_OVERVIEW=str(predictor))
+    output_fh = None
+  logger.info("    done.")
+  
+  if index_path is not None and not os.path.exists(os.path.dirname(index_path)):
+    os.makedirs(os.path.dirname(index_path))
+  hmt_blocks.get_block_index(output_path, blocksize=index_blocksize, index_path=index_path)
+  return output_path
+
+
+def ingest_block(lidar_dir, data_block, quads=None, workers=1, cog=False, index_blocksize=(600,600), force=False):
+  """
+  Ingest the quads (all quads in raw/ by default) of a data block on workers processes; quads already up to date
+  are skipped unless force is True. Returns the ingested paths.
+  """
+  raw_dir = os.path.join(lidar_dir, data_block, 'raw')
+  if quads is None:
+    quads = hmt_catalog.raw_quads(raw_dir)
+  jobs = list()
+  for quad in quads:
+    raw_quad_path = os.path.join(raw_dir, quad)
+    if force or source_path(raw_quad_path) == raw_quad_path:
+      index_path = os.path.join(lidar_dir, data_block, 'processed', "{0}_raw.blockindex.npz".format(quad))
+      jobs.append((raw_quad_path, None, index_path, index_blocksize, cog))
+  logger.info("Ingesting {0} of {1} quads of {2}".format(len(jobs), len(quads), data_block))
+  worker_runtime = (hmt_runtime.current() or hmt_runtime.Runtime(console=False)).for_worker(workers)
+  hmt_scheduler.run_jobs(ingest_quad, jobs, workers=workers, initializer=hmt_runtime.configure_worker, initargs=(worker_runtime,))
+  return [ingested_path(os.path.join(raw_dir, quad)) for quad in quads]
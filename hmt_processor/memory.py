@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+One memory budget for a run, split across its workers.
+
+A MemoryBudget is the total memory (MB) the run may use: HMT_MEMORY_MB, or half the physical memory by default.
+plan() divides it between the worker processes and, within a worker's share, between the GDAL block cache (set by
+hmt_processor.runtime in each worker), the warp buffer (ReprojectImage maxmem) and the numpy block buffers, which
+sets the block size. When a share would be smaller than MIN_WORKER_MB the worker count is reduced instead. The scheduler also throttles job admission so the
+projected memory of the jobs in flight (estimate_job_mb) stays within the budget.
+"""
+
+# Import core modules
+import sys
+import os
+import collections
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Geomatics Research helpers
+from gmtools import filesystem as gm_fs
+
+import blockio as hmt_blockio
+
+# Fractions of a worker's share
+CACHE_FRACTION = 0.4  # GDAL block cache
+WARP_FRACTION = 0.25  # ReprojectImage working buffer
+BLOCK_FRACTION = 0.15  # numpy arrays of the block in flight; the rest is headroom for Python, GDAL and the OS
+
+# Bounds of the settings derived from a share
+MIN_WORKER_MB = 256
+MIN_BLOCKSIZE = 256
+MAX_BLOCKSIZE = 2048
+BLOCK_ALIGN = 64  # HFA blocks are 64 x 64
+
+# Bytes held per cell of a block by the heaviest processor loop (the three float32 inputs, two float32
+# temporaries and the float32 output of convert_navd88_to_tidal, see hmt_processor.dtypes), plus the inputs and
+# output of each further block held by the read-ahead / write-behind buffer rings of hmt_processor.blockio
+IO_BYTES_PER_CELL = 16
+BLOCK_BYTES_PER_CELL = 24 + (hmt_blockio.QUEUE_DEPTH + 1)*IO_BYTES_PER_CELL
+
+# Raster sizes on disk count this much towards a job's projected memory (overviews, statistics and
+# polygonize scale with the quad)
+RASTER_OVERHEAD = 0.1
+
+MemoryPlan = collections.namedtuple('MemoryPlan', ['total_mb', 'workers', 'worker_mb', 'cache_mb', 'warp_mb', 'blocksize'])
+
+
+def physical_memory_mb():
+  """ Physical memory of the node in MB, or None where it cannot be read """
+  try:
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')//(1024*1024)
+  except (ValueError, OSError, AttributeError):
+    return None
+
+
+class MemoryBudget(object):
+  """ The memory (MB) a run may use; see the module docstring """
+
+  def __init__(self, total_mb=None):
+    if total_mb is None and os.environ.get('HMT_MEMORY_MB'):
+      total_mb = int(os.environ['HMT_MEMORY_MB'])
+    if total_mb is None:
+      total_mb = (physical_memory_mb() or 4096)//2
+    self.total_mb = int(total_mb)
+
+  def max_workers(self):
+    """ The most workers that each get at least MIN_WORKER_MB """
+    return max(1, self.total_mb//MIN_WORKER_MB)
+
+  def plan(self, workers=1, profile=None):
+    """
+    MemoryPlan for running workers processes (fewer if the budget cannot hold them). profile (see
+    hmt_processor.autotune.load_profile) replaces the derived block size, cache and warp memory wherever it
+    asks for no more than the worker's share allows.
+    """
+    workers = max(1, min(workers, self.max_workers()))
+    worker_mb = self.total_mb//workers
+    block_cells = (worker_mb*BLOCK_FRACTION*1024*1024)/BLOCK_BYTES_PER_CELL
+    side = int(block_cells**0.5)//BLOCK_ALIGN*BLOCK_ALIGN
+    side = max(MIN_BLOCKSIZE, min(MAX_BLOCKSIZE, side))
+    cache_mb = int(worker_mb*CACHE_FRACTION)
+    warp_mb = max(16, int(worker_mb*WARP_FRACTION))
+    if profile:
+      side = min(side, profile.get('blocksize', side))
+      cache_mb = min(cache_mb, profile.get('cache_mb', cache_mb))
+      warp_mb = min(warp_mb, profile.get('warp_mb', warp_mb))
+    return MemoryPlan(total_mb=self.total_mb, workers=workers, worker_mb=worker_mb, cache_mb=cache_mb, warp_mb=warp_mb,
+                      blocksize=(side, side))
+
+
+def estimate_job_mb(plan, raster_paths=(), raster_bytes=0):
+  """
+  Projected peak memory (MB) of one quad job: the worker's cache, warp buffer and block buffers plus
+  RASTER_OVERHEAD of the size of its input rasters (raster_paths, plus raster_bytes already known e.g. from the catalog)
+  """
+  block_mb = plan.blocksize[0]*plan.blocksize[1]*BLOCK_BYTES_PER_CELL/(1024.0*1024.0)
+  raster_mb = (raster_bytes + sum(gm_fs.get_size(raster_path)['bytes'] for raster_path in raster_paths if os.path.exists(raster_path)))/(1024.0*1024.0)
+  return plan.cache_mb + plan.warp_mb + block_mb + raster_mb*RASTER_OVERHEAD
+
+
+def describe(plan):
+  """ One line summary for the log """
+  return "{0} MB budget: {1} workers x {2} MB (GDAL cache {3} MB, warp {4} MB, blocks {5}x{6})".format(
+    plan.total_mb, plan.workers, plan.worker_mb, plan.cache_mb, plan.warp_mb, plan.blocksize[0], plan.blocksize[1])
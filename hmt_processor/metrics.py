@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Per-stage metrics of the processing chain. A StageTimer collects one record per stage and quad with the wall and
+CPU time, the peak resident memory of the process, the bytes it read and wrote (all GDAL I/O goes through the
+process, so /proc/self/io counts it), the dataset handle pool hits and misses (see hmt_processor.handles) and the
+size of the stage's outputs. Records can be appended to a JSON-lines
+file as they are taken and summarised as a table at the end of a run.
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import contextlib
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+try:
+  import resource
+except ImportError:
+  resource = None  # Windows
+
+# Import Geomatics Research helpers
+from gmtools import filesystem as gm_fs
+
+import tracing as hmt_trace
+import handles as hmt_handles
+
+
+def cpu_seconds():
+  """ User + system CPU time of this process """
+  times = os.times()
+  return times[0] + times[1]
+
+
+def peak_rss_mb():
+  """ Peak resident set size of this process in MB, or None (ru_maxrss is KB on Linux, bytes on OS X) """
+  if resource is None:
+    return None
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return max_rss/(1024.0*1024.0)
+  return max_rss/1024.0
+
+
+def io_bytes():
+  """ (bytes read, bytes written) by this process so far, from /proc/self/io; (None, None) where unavailable """
+  try:
+    counters = dict()
+    with open('/proc/self/io') as io_fh:
+      for line in io_fh:
+        key, value = line.split(':')
+        counters[key.strip()] = int(value)
+    return (counters['rchar'], counters['wchar'])
+  except (IOError, OSError, KeyError, ValueError):
+    return (None, None)
+
+
+def output_bytes(path):
+  """ Size of an output on disk; a shapefile includes its .shx / .dbf / .prj sidecars """
+  if not os.path.exists(path):
+    return 0
+  if os.path.splitext(path)[1].lower() == '.shp':
+    base = os.path.splitext(path)[0]
+    return sum(os.path.getsize(base + extension) for extension in ('.shp', '.shx', '.dbf', '.prj') if os.path.exists(base + extension))
+  return gm_fs.get_size(path)['bytes']
+
+
+def _difference(end, start):
+  if end is None or start is None:
+    return None
+  return end - start
+
+
+class StageTimer(object):
+  """
+  Collects metrics of named stages, optionally tagged with the quad they ran for. When log_path is set each record
+  is also appended to that JSON-lines file as soon as its stage ends.
+  """
+
+  def __init__(self, quad=None, log_path=None, run=None):
+    self.quad = quad
+    self.log_path = log_path
+    self.run = run
+    self.records = list()
+
+  @contextlib.contextmanager
+  def stage(self, name, quad=None, outputs=None):
+    """
+    Measure the body of a with block as stage name. Yields the record; outputs (paths) can be passed up front or
+    appended to record['outputs'] inside the block, their sizes are taken when the stage ends.
+    """
+    record = {'run': self.run, 'quad': quad or self.quad, 'stage': name, 'pid': os.getpid(), 'outputs': list(outputs or [])}
+    rss_start = peak_rss_mb()
+    read_start, written_start = io_bytes()
+    handles_start = hmt_handles.counters()
+    cpu_start = cpu_seconds()
+    wall_start = time.time()
+    hmt_trace.set_context(quad=record['quad'], stage=name)  # tags the block spans of the stage
+    try:
+      yield record
+    finally:
+      hmt_trace.set_context(stage=None)
+      if hmt_trace.enabled(): hmt_trace.record(name, wall_start*1e6, hmt_trace.now_us(), category='stage')
+      record['wall_seconds'] = time.time() - wall_start
+      record['cpu_seconds'] = cpu_seconds() - cpu_start
+      record['peak_rss_mb'] = peak_rss_mb()
+      record['peak_rss_growth_mb'] = _difference(record['peak_rss_mb'], rss_start)
+      read_end, written_end = io_bytes()
+      record['bytes_read'] = _difference(read_end, read_start)
+      record['bytes_written'] = _difference(written_end, written_start)
+      for counter, value in hmt_handles.counters().items():
+        record[counter] = value - handles_start[counter]
+      record['output_bytes'] = sum(output_bytes(path) for path in record['outputs'] if path)
+      record['finished'] = time.time()
+      self.records.append(record)
+      if self.log_path is not None:
+        write_records([record], self.log_path)
+
+  def totals(self):
+    """ Total wall seconds per stage """
+    return stage_totals(self.records)
+
+
+def write_records(records, log_path):
+  """ Append records to a JSON-lines file (one record per line) """
+  log_dir = os.path.dirname(log_path)
+  if log_dir and not os.path.exists(log_dir):
+    os.makedirs(log_dir)
+  log_fh = open(log_path, 'a')
+  try:
+    for record in records:
+      log_fh.write(json.dumps(record, sort_keys=True) + "\n")
+  finally:
+    log_fh.close()
+  return log_path
+
+
+def read_records(log_path, run=None):
+  """ Records from a JSON-lines file, optionally only those of one run """
+  with open(log_path) as log_fh:
+    records = [json.loads(line) for line in log_fh if line.strip()]
+  if run is not None:
+    records = [record for record in records if record.get('run') == run]
+  return records
+
+
+def stage_totals(records, key='wall_seconds'):
+  """ Total of key (wall seconds by default) per stage over a list of stage records (e.g. from several quads) """
+  totals = dict()
+  for record in records:
+    totals[record['stage']] = totals.get(record['stage'], 0.0) + (record.get(key) or 0)
+  return totals
+
+
+def bottleneck(records):
+  """ (stage, seconds) of the stage with the largest total wall time, or (None, 0) """
+  totals = stage_totals(records)
+  if not totals:
+    return (None, 0.0)
+  stage = max(totals, key=totals.get)
+  return (stage, totals[stage])
+
+
+def summary_table(records):
+  """ Lines of a per-stage summary: quads, wall / CPU seconds, peak RSS and MB read / written / output """
+  stages = list()
+  for record in records:
+    if record['stage'] not in stages: stages.append(record['stage'])  # first-seen order follows the chain
+  lines = ["{0:<16} {1:>5} {2:>10} {3:>10} {4:>9} {5:>10} {6:>10} {7:>10}".format('stage', 'quads', 'wall s', 'cpu s', 'peak MB', 'read MB', 'write MB', 'output MB')]
+  megabyte = float(1000000)
+  for stage in stages:
+    stage_records = [record for record in records if record['stage'] == stage]
+    peaks = [record['peak_rss_mb'] for record in stage_records if record.get('peak_rss_mb') is not None]
+    lines.append("{0:<16} {1:>5} {2:>10.1f} {3:>10.1f} {4:>9.1f} {5:>10.1f} {6:>10.1f} {7:>10.1f}".format(
+      stage, len(set(record['quad'] for record in stage_records)),
+      sum(record['wall_seconds'] for record in stage_records),
+      sum(record.get('cpu_seconds') or 0 for record in stage_records),
+      max(peaks) if peaks else 0,
+      sum(record.get('bytes_read') or 0 for record in stage_records)/megabyte,
+      sum(record.get('bytes_written') or 0 for record in stage_records)/megabyte,
+      sum(record.get('output_bytes') or 0 for record in stage_records)/megabyte))
+  return lines
+
+
+def log_summary(records, title="Stage summary:"):
+  """ Log summary_table() of the records """
+  logger.info(title)
+  for line in summary_table(records):
+    logger.info("  " + line)
+  hits = sum(record.get('handle_hits') or 0 for record in records)
+  misses = sum(record.get('handle_misses') or 0 for record in records)
+  if hits or misses:
+    logger.info("  Dataset handles: {0} reused, {1} opened ({2:.0%} reused)".format(hits, misses, float(hits)/(hits + misses)))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Inputs in an S3-compatible object store.
+
+Data directories and rasters can be given as s3://bucket/key URIs (or GDAL /vsis3/bucket/key paths); vsi_path()
+turns them into the /vsis3/ paths GDAL opens with HTTP range requests. The file helpers below (exists, isdir,
+listdir, walk_files, getmtime, get_size, read_chunks) work on local and /vsi paths alike through GDAL's VSI layer,
+and local_path() maps a remote path to a local mirror (HMT_STORE_DIR) for the outputs, block indexes and catalog
+that are written next to the inputs on a local tree. Credentials and the endpoint come from GDAL's usual AWS_*
+settings, e.g. for a local MinIO:
+
+  AWS_S3_ENDPOINT=localhost:9000 AWS_HTTPS=NO AWS_VIRTUAL_HOSTING=FALSE AWS_ACCESS_KEY_ID=... AWS_SECRET_ACCESS_KEY=...
+
+read_window() reads windows of remote rasters through a BlockCache: a persistent cache of fixed tiles of the
+raster on local disk (HMT_BLOCK_CACHE, at most HMT_BLOCK_CACHE_MB, least recently used tiles evicted first), so
+the statewide grid windows every quad reads are fetched once. Missing tiles are fetched on FETCH_WORKERS threads,
+each with its own handle, i.e. as parallel range requests.
+"""
+
+# Import core modules
+import sys
+import os
+import stat
+import hashlib
+import tempfile
+import threading
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+# Import Geomatics Research helpers
+from gmtools import filesystem as gm_fs
+
+import handles as hmt_handles
+
+# Local mirror of remote directories for the files written next to the inputs
+STORE_DIR = os.environ.get('HMT_STORE_DIR') or os.path.join(tempfile.gettempdir(), 'hmt_store')
+
+# Persistent tile cache of remote rasters
+CACHE_DIR = os.environ.get('HMT_BLOCK_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'hmt_blocks')
+CACHE_MB = int(os.environ.get('HMT_BLOCK_CACHE_MB', 4096))
+
+# Smallest side of a cached tile in cells (tiles are whole native blocks)
+CACHE_TILE = 512
+
+# Threads fetching missing tiles of a window
+FETCH_WORKERS = int(os.environ.get('HMT_FETCH_WORKERS', 8))
+
+# GDAL prefixes of remote file systems
+REMOTE_PREFIXES = ('/vsis3/', '/vsigs/', '/vsiaz/', '/vsicurl/')
+
+
+def vsi_path(path):
+  """ The GDAL path of path: s3://bucket/key becomes /vsis3/bucket/key, anything else is returned unchanged """
+  if path is not None and path.startswith('s3://'):
+    return '/vsis3/' + path[len('s3://'):]
+  return path
+
+
+def is_remote(path):
+  """ True for s3:// URIs and GDAL network paths """
+  return path is not None and (path.startswith('s3://') or path.startswith(REMOTE_PREFIXES))
+
+
+def local_path(path):
+  """ path itself when it is local, else its place in the local mirror (STORE_DIR); parent folders are created """
+  if not is_remote(path):
+    return path
+  mirrored = os.path.join(STORE_DIR, *[part for part in vsi_path(path).split('/')[2:] if part])
+  if not os.path.exists(os.path.dirname(mirrored)):
+    os.makedirs(os.path.dirname(mirrored))
+  return mirrored
+
+
+def _stat(path):
+  """ gdal.VSIStatL() result of a remote path, None when it does not exist """
+  return gdal.VSIStatL(vsi_path(path), gdal.VSI_STAT_EXISTS_FLAG | gdal.VSI_STAT_NATURE_FLAG | gdal.VSI_STAT_SIZE_FLAG)
+
+
+def exists(path):
+  if not is_remote(path):
+    return os.path.exists(path)
+  return _stat(path) is not None
+
+
+def isdir(path):
+  if not is_remote(path):
+    return os.path.isdir(path)
+  path_stat = _stat(path)
+  return path_stat is not None and stat.S_ISDIR(path_stat.mode)
+
+
+def listdir(path):
+  """ Names in a directory; an object store lists the keys under the prefix path/ """
+  if not is_remote(path):
+    return os.listdir(path)
+  return [name for name in (gdal.ReadDir(vsi_path(path)) or []) if name not in ('.', '..')]
+
+
+def walk_files(path):
+  """ The files under a directory, recursively """
+  if not is_remote(path):
+    return [os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(path) for filename in filenames]
+  return [vsi_path(path).rstrip('/') + '/' + name for name in (gdal.ReadDirRecursive(vsi_path(path)) or []) if not name.endswith('/')]
+
+
+def getmtime(path):
+  if not is_remote(path):
+    return os.path.getmtime(path)
+  return _stat(path).mtime
+
+
+def getsize(path):
+  if not is_remote(path):
+    return os.path.getsize(path)
+  return _stat(path).size
+
+
+def get_size(path):
+  """ gmtools.filesystem.get_size() of a local or remote file or grid directory """
+  if not is_remote(path):
+    return gm_fs.get_size(path)
+  assert(exists(path)), "The path {0} does not exist!:".format(path)
+  file_size = sum(getsize(filename) for filename in walk_files(path)) if isdir(path) else getsize(path)
+  filesize_mb = float(file_size)/float(1000000)
+  return {'bytes': file_size, 'MB': filesize_mb, 'GB': filesize_mb/float(1024)}
+
+
+def read_chunks(path, chunk_bytes=1024*1024):
+  """ The contents of a local or remote file, chunk_bytes at a time """
+  if not is_remote(path):
+    with open(path, 'rb') as local_file:
+      for chunk in iter(lambda: local_file.read(chunk_bytes), b''):
+        yield chunk
+    return
+  remote_file = gdal.VSIFOpenL(vsi_path(path), 'rb')
+  try:
+    while True:
+      chunk = gdal.VSIFReadL(1, chunk_bytes, remote_file)
+      if not chunk:
+        break
+      yield chunk
+  finally:
+    gdal.VSIFCloseL(remote_file)
+
+
+class BlockCache(object):
+  """
+  Tiles of remote rasters kept as .npy files in directory, at most max_mb in total. A tile is keyed by the path,
+  size and modification time of the raster, the band and the tile position, so a changed object is fetched again.
+  """
+
+  def __init__(self, directory=CACHE_DIR, max_mb=CACHE_MB, workers=FETCH_WORKERS):
+    self.directory = directory
+    self.max_bytes = max_mb*1024*1024
+    self.workers = workers
+    self.hits = 0
+    self.misses = 0
+    self._stored_bytes = None  # bytes stored since the last eviction pass; None forces one
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def tile_size(self, raster_band):
+    """ (cols, rows) of the tiles of a band: whole native blocks, at least CACHE_TILE cells a side """
+    block_cols, block_rows = raster_band.GetBlockSize()
+    return (block_cols*max(1, -(-CACHE_TILE//block_cols)), block_rows*max(1, -(-CACHE_TILE//block_rows)))
+
+  def _tile_path(self, signature, band, tile):
+    key = "{0}|{1}|{2}|{3}".format(signature, band, tile[0], tile[1])
+    return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+  def _load(self, tile_path):
+    try:
+      array = np.load(tile_path)
+    except (IOError, OSError, ValueError):
+      return None  # not cached, or evicted by another process meanwhile
+    try:
+      os.utime(tile_path, None)  # most recently used
+    except OSError:
+      pass
+    return array
+
+  def _store(self, tile_path, array):
+    """ Write a tile atomically (another process may be reading the cache) """
+    tmp_fh, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    with os.fdopen(tmp_fh, 'wb') as tile_file:
+      np.save(tile_file, array)
+    os.rename(tmp_path, tile_path)
+    self._stored_bytes = (self._stored_bytes or 0) + array.nbytes
+
+  def _fetch(self, path, band, tiles):
+    """ Read tiles (tile col, tile row, xoff, yoff, xsize, ysize) on self.workers threads; yields arrays in order """
+    from multiprocessing.pool import ThreadPool
+    handles = threading.local()
+    
+    def read(tile):
+      if getattr(handles, 'band', None) is None:
+        handles.dataset = gdal.Open(vsi_path(path), gdal.GA_ReadOnly)
+        handles.band = handles.dataset.GetRasterBand(band)
+      return handles.band.ReadAsArray(*tile[2:])
+    
+    if self.workers <= 1 or len(tiles) <= 1:
+      for tile in tiles:
+        yield read(tile)
+      return
+    pool = ThreadPool(min(self.workers, len(tiles)))
+    try:
+      for array in pool.imap(read, tiles):
+        yield array
+    finally:
+      pool.close()
+      pool.join()
+
+  def read(self, path, band, xoff, yoff, xsize, ysize):
+    """ The window (xoff, yoff, xsize, ysize) of a band of a remote raster, from cached tiles where possible """
+    raster_fh = hmt_handles.open_dataset(vsi_path(path))
+    raster_band = raster_fh.GetRasterBand(band)
+    cols, rows = raster_fh.RasterXSize, raster_fh.RasterYSize
+    tile_cols, tile_rows = self.tile_size(raster_band)
+    path_stat = _stat(path)
+    signature = "{0}|{1}|{2}".format(vsi_path(path), path_stat.size, path_stat.mtime)
+    
+    tiles = dict()  # (tile col, tile row) -> array
+    missing = list()
+    for tile_row in range(yoff//tile_rows, (yoff + ysize - 1)//tile_rows + 1):
+      for tile_col in range(xoff//tile_cols, (xoff + xsize - 1)//tile_cols + 1):
+        tile_path = self._tile_path(signature, band, (tile_col, tile_row))
+        array = self._load(tile_path)
+        if array is None:
+          tile_xoff, tile_yoff = tile_col*tile_cols, tile_row*tile_rows
+          missing.append((tile_col, tile_row, tile_xoff, tile_yoff, min(tile_cols, cols - tile_xoff), min(tile_rows, rows - tile_yoff)))
+        else:
+          tiles[(tile_col, tile_row)] = array
+    self.hits += len(tiles)
+    self.misses += len(missing)
+    for tile, array in zip(missing, self._fetch(path, band, missing)):
+      self._store(self._tile_path(signature, band, tile[:2]), array)
+      tiles[tile[:2]] = array
+    
+    # Assemble the window from the tiles it overlaps
+    window_array = None
+    for (tile_col, tile_row), array in tiles.items():
+      if window_array is None:
+        window_array = np.empty((ysize, xsize), dtype=array.dtype)
+      tile_xoff, tile_yoff = tile_col*tile_cols, tile_row*tile_rows
+      x0, x1 = max(xoff, tile_xoff), min(xoff + xsize, tile_xoff + array.shape[1])
+      y0, y1 = max(yoff, tile_yoff), min(yoff + ysize, tile_yoff + array.shape[0])
+      window_array[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = array[y0 - tile_yoff:y1 - tile_yoff, x0 - tile_xoff:x1 - tile_xoff]
+    
+    if missing:
+      self.evict()
+    return window_array
+
+  def evict(self):
+    """ Delete the least recently used tiles until the cache is under max_mb; scans once per 1/16 of max_mb stored """
+    if self._stored_bytes is not None and self._stored_bytes < self.max_bytes//16:
+      return
+    self._stored_bytes = 0
+    entries = list()
+    for name in os.listdir(self.directory):
+      if not name.endswith('.npy'):
+        continue
+      try:
+        entry_stat = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      entries.append((entry_stat.st_mtime, entry_stat.st_size, name))
+    total = sum(entry[1] for entry in entries)
+    if total <= self.max_bytes:
+      return
+    evicted = 0
+    for mtime, size, name in sorted(entries):
+      if total <= self.max_bytes*0.9:  # leave headroom so the next tiles do not trigger another pass
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
+      evicted += 1
+    logger.info("    Evicted {0} tiles from the block cache {1}".format(evicted, self.directory))
+
+
+_caches = dict()  # pid -> BlockCache
+
+
+def block_cache():
+  """ The BlockCache of this process """
+  if os.getpid() not in _caches:
+    _caches[os.getpid()] = BlockCache()
+  return _caches[os.getpid()]
+
+
+def read_window(path, band, xoff, yoff, xsize, ysize):
+  """ Read a window of a band; remote rasters are read through the block cache, local ones directly """
+  if not is_remote(path):
+    raster_fh = hmt_handles.open_dataset(path)
+    return raster_fh.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+  return block_cache().read(path, band, xoff, yoff, xsize, ysize)
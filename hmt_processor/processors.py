@@ -28,9 +28,6 @@ import pprint
 import logging
 logger = logging.getLogger('hmt_processor')
 
-# Import Parallel Python
-import pp
-
 # Import Numpy
 import numpy as np
 
@@ -39,30 +36,30 @@ from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 
-# Fix osgeo error reporting
-gdal.UseExceptions()
-ogr.UseExceptions()
-osr.UseExceptions()
-
-# Set gdal configuration parameters
-gdal.SetCacheMax(2147483648)  # 2 GB. This sets the caching max size for gdal. Bigger number can lead to faster reads / writes
-gdal.SetConfigOption('HFA_USE_RRD', 'YES')  # Configure GDAL to use blocks
-
 import hmt_gdal
+import block_index as hmt_blocks
+import tracing as hmt_trace
+import blockio as hmt_blockio
+import formats as hmt_formats
+import dtypes as hmt_dtypes
+import handles as hmt_handles
+import gmtools.geospatial as gm_geo
 
-def reproject_dataset_to_quad(src_dataset_path, template_dataset_path, destination_dataset_path, band=1, respample_method=gdal.GRA_NearestNeighbour, maxmem=500, output_driver="HFA"):
+# US survey feet per meter, as a float32 so the unit conversions stay in float32 (see dtypes.py)
+SURVEY_FEET_PER_METER = hmt_dtypes.SURFACE_DTYPE(3.280833333)
+
+def reproject_dataset_to_quad(src_dataset_path, template_dataset_path, destination_dataset_path, band=1, respample_method=gdal.GRA_NearestNeighbour, maxmem=500, output_driver=None):
   """
   Resample / Reproject a dataset to match the spatial extent and cell size of a template dataset.
+  Only the window of the source that covers the template (plus a resampling halo) is read.
+  output_driver is an output format (see formats.py), the pipeline-wide one when None.
   """
   logger.info("    Warping src dataset (using template) to dest dataset...")
-  # Open the output driver
-  output_drv = gdal.GetDriverByName( output_driver )
   
   # Setup the spatial refereneces
-  src_dataset = gdal.Open(src_dataset_path, gdal.GA_ReadOnly)
+  src_dataset = hmt_handles.open_dataset(src_dataset_path)
   src_dataset_driver = src_dataset.GetDriver()
-  src_srs = osr.SpatialReference()
-  src_srs.ImportFromWkt(src_dataset.GetProjection())
+  src_srs = hmt_handles.spatial_reference(src_dataset.GetProjection())
   target_srs = osr.SpatialReference()
   target_srs = src_srs
     
@@ -88,7 +85,7 @@ def reproject_dataset_to_quad(src_dataset_path, template_dataset_path, destinati
   
   # Get template dataset
   # Open the binary tile as read-only and get the driver GDAL is using to access the data
-  template_fh = gdal.Open(template_dataset_path, gdal.GA_ReadOnly)
+  template_fh = hmt_handles.open_dataset(template_dataset_path)
   remplate_driver = template_fh.GetDriver()
   
   # Pull Metadata associated with the template tile so we can create the output raster later
@@ -98,16 +95,19 @@ def reproject_dataset_to_quad(src_dataset_path, template_dataset_path, destinati
   template_rows = template_fh.RasterYSize  # Get the number of rows
   #template_nodata = template_fh.GetNoDataValue()  # Get the NoData value so we can set our mask
     
-  # Hold the window data in a new memory-based raster so we can reproject
+  # Create the output raster on the template grid
   logger.info("      creating new dataset...")
-  outut_mhhw_dataset = output_drv.Create(destination_dataset_path, template_cols, template_rows, 1, data_band_type)
+  outut_mhhw_dataset = hmt_formats.create(destination_dataset_path, template_cols, template_rows, 1, hmt_dtypes.surface_type(data_band_type), driver=output_driver)
   outut_mhhw_dataset.SetGeoTransform(template_geotransform)
   outut_mhhw_dataset.SetProjection(tempalte_projection)
+  if data_band.GetNoDataValue() is not None:
+    outut_mhhw_dataset.GetRasterBand(1).SetNoDataValue(data_band.GetNoDataValue())
+    outut_mhhw_dataset.GetRasterBand(1).Fill(data_band.GetNoDataValue())
   logger.info("        done.")
 
-  # Perform the projection/resampling
+  # Perform the projection/resampling, reading only the part of the source that covers the template
   logger.info("      reshaping data raster to match template raster...")
-  res = gdal.ReprojectImage( src_dataset, outut_mhhw_dataset, src_srs.ExportToWkt(), target_srs.ExportToWkt(), respample_method, maxmem )
+  hmt_gdal.warp_source_window(src_dataset, outut_mhhw_dataset, band=band, respample_method=respample_method, maxmem=maxmem)
   logger.info("        done.")
   
   logger.info("  Computing stats...")
@@ -118,7 +118,7 @@ def reproject_dataset_to_quad(src_dataset_path, template_dataset_path, destinati
   logger.info("    done.")
   
   logger.info("  Building blocks...")
-  outut_mhhw_dataset.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(outut_mhhw_dataset, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -135,12 +135,138 @@ def reproject_dataset_to_quad(src_dataset_path, template_dataset_path, destinati
   
   return destination_dataset_path
 
-def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_in_tidal_datum_path, band=1, blocksize=(600,600), driver="HFA"):
+def reproject_datasets_to_quad(src_dataset_paths, template_dataset_path, destination_dataset_paths, band=1, respample_method=gdal.GRA_NearestNeighbour, maxmem=500, output_driver=None):
+  """
+  Resample / Reproject several datasets to match the spatial extent and cell size of a template dataset in one pass.
+  
+  Sources that share a grid are stacked as the bands of one virtual dataset and warped together, so the template is
+  opened once and each group of sources needs a single source-window read and transformer per chunk of rows.
+  destination_dataset_paths is either one path (a multi-band raster, one band per source, in order) or a list
+  of paths (one single-band raster per source). output_driver is an output format (see formats.py), the
+  pipeline-wide one when None.
+  """
+  logger.info("    Warping {0} src datasets (using template) to dest dataset(s)...".format(len(src_dataset_paths)))
+  separate_outputs = isinstance(destination_dataset_paths, (list, tuple))
+  if separate_outputs:
+    assert(len(destination_dataset_paths) == len(src_dataset_paths)), "need one destination path per source dataset"
+  
+  # Get template dataset metadata
+  template_fh = hmt_handles.open_dataset(template_dataset_path)
+  template_geotransform = template_fh.GetGeoTransform()
+  tempalte_projection = template_fh.GetProjection()
+  template_cols = template_fh.RasterXSize  # Get the number of columns
+  template_rows = template_fh.RasterYSize  # Get the number of rows
+  template_fh = None
+  
+  # Group the sources by grid, keeping the position of each source so outputs come back in order
+  src_groups = dict()
+  src_types = list()
+  src_nodatas = list()
+  for src_n, src_dataset_path in enumerate(src_dataset_paths):
+    src_dataset = hmt_handles.open_dataset(src_dataset_path)
+    src_types.append(hmt_dtypes.surface_type(src_dataset.GetRasterBand(band).DataType))
+    src_nodatas.append(src_dataset.GetRasterBand(band).GetNoDataValue())
+    src_groups.setdefault(hmt_gdal.grid_signature(src_dataset), list()).append(src_n)
+    src_dataset = None
+  logger.info("      {0} source grid(s)".format(len(src_groups)))
+  
+  # Create the output raster(s) on the template grid
+  logger.info("      creating new dataset(s)...")
+  output_datasets = list()
+  output_bands = list()  # (dataset, band number) for each source
+  if separate_outputs:
+    for src_n, destination_dataset_path in enumerate(destination_dataset_paths):
+      output_dataset = hmt_formats.create(destination_dataset_path, template_cols, template_rows, 1, src_types[src_n], driver=output_driver)
+      output_datasets.append(output_dataset)
+      output_bands.append((output_dataset, 1))
+  else:
+    output_dataset = hmt_formats.create(destination_dataset_paths, template_cols, template_rows, len(src_dataset_paths), hmt_dtypes.stack_type(src_types), driver=output_driver)
+    output_datasets.append(output_dataset)
+    output_bands = [(output_dataset, src_n + 1) for src_n in range(len(src_dataset_paths))]
+  for output_dataset in output_datasets:
+    output_dataset.SetGeoTransform(template_geotransform)
+    output_dataset.SetProjection(tempalte_projection)
+  for src_n, (output_dataset, output_band_n) in enumerate(output_bands):
+    if src_nodatas[src_n] is not None:
+      output_dataset.GetRasterBand(output_band_n).SetNoDataValue(src_nodatas[src_n])
+      output_dataset.GetRasterBand(output_band_n).Fill(src_nodatas[src_n])
+  logger.info("        done.")
+  
+  mem_drv = gdal.GetDriverByName('MEM')
+  for src_ns in src_groups.values():
+    # Stack the group and hold the window that covers the template in memory
+    logger.info("      reshaping {0} stacked source(s) to match template raster...".format(len(src_ns)))
+    stack_dataset = hmt_gdal.stack_datasets_as_bands([src_dataset_paths[src_n] for src_n in src_ns], band=band)
+    window_dataset = hmt_gdal.read_source_window_for_target(stack_dataset, template_geotransform, template_cols, template_rows,
+                                                            target_wkt=tempalte_projection, respample_method=respample_method)
+    stack_dataset = None
+    if window_dataset is None:
+      continue
+    window_projection = window_dataset.GetProjection()
+    stack_type = window_dataset.GetRasterBand(1).DataType
+    
+    # Warp all bands at once, a chunk of template rows at a time so the chunk fits in maxmem (MB)
+    bytes_per_row = template_cols*len(src_ns)*gdal.GetDataTypeSize(stack_type)//8
+    chunk_rows = max(1, min(template_rows, (maxmem*1024*1024)//max(bytes_per_row, 1)))
+    for i in range(0, template_rows, chunk_rows):
+      numRows = min(chunk_rows, template_rows - i)
+      lap = hmt_trace.block_spans(0, i)
+      chunk_dataset = mem_drv.Create('', template_cols, numRows, len(src_ns), stack_type)
+      chunk_dataset.SetGeoTransform(gm_geo.GeoTransform.from_gdal(template_geotransform).offset(0, i))
+      chunk_dataset.SetProjection(tempalte_projection or window_projection)
+      for chunk_band_n, src_n in enumerate(src_ns, 1):
+        if src_nodatas[src_n] is not None:
+          chunk_dataset.GetRasterBand(chunk_band_n).SetNoDataValue(src_nodatas[src_n])
+          chunk_dataset.GetRasterBand(chunk_band_n).Fill(src_nodatas[src_n])
+      gdal.ReprojectImage(window_dataset, chunk_dataset, window_projection, tempalte_projection or window_projection, respample_method, maxmem)
+      lap('warp')
+      
+      # Write each band of the chunk to its output
+      for chunk_band_n, src_n in enumerate(src_ns, 1):
+        output_dataset, output_band_n = output_bands[src_n]
+        output_dataset.GetRasterBand(output_band_n).WriteArray(chunk_dataset.GetRasterBand(chunk_band_n).ReadAsArray(), 0, i)
+      lap('write')
+      chunk_dataset = None
+    window_dataset = None
+    logger.info("        done.")
+  
+  logger.info("  Computing stats...")
+  for output_dataset, output_band_n in output_bands:
+    try:
+      output_dataset.GetRasterBand(output_band_n).ComputeStatistics(False)
+    except RuntimeError:
+      logger.warn("    Cannot compute statistics.")
+  logger.info("    done.")
+  
+  logger.info("  Building blocks...")
+  for output_dataset in output_datasets:
+    hmt_formats.build_overviews(output_dataset, [2,4,8,16,32,64,128])
+  logger.info("    done.")
+  
+  logger.info("  Flushing the cache...")
+  for output_dataset in output_datasets:
+    output_dataset.FlushCache()
+  logger.info("    done.")
+  
+  # Clean up
+  logger.info("      cleaning up / closing datasets...")
+  output_bands = None
+  output_dataset = None
+  output_datasets = None
+  logger.info("        done.")
+  logger.info("    done.")
+  
+  return destination_dataset_paths
+
+def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_in_tidal_datum_path, band=1, blocksize=(600,600), driver=None, block_index_path=None):
   """
   Convert the lidar tile (NAVD88) to TSS to Tidal vertical datum
+  
+  If block_index_path is given, the block index (see block_index.py) of the output is recorded while it is
+  written and saved there.
   """
   # Open the LIDAR tile as read-only and get the metadata
-  lidar_tile_fh = gdal.Open(lidar_path, gdal.GA_ReadOnly)
+  lidar_tile_fh = hmt_handles.open_dataset(lidar_path)
   input_driver = lidar_tile_fh.GetDriver()
   lidar_geotransform = lidar_tile_fh.GetGeoTransform()
   lidar_projection = lidar_tile_fh.GetProjection()
@@ -157,7 +283,7 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
   lidar_pixelHeight = lidar_geotransform[5]
   
   # Open the NAVD88 - TSS conversion dataset as read-only and get metadata
-  tss_conversion_fh = gdal.Open(tss_path, gdal.GA_ReadOnly)
+  tss_conversion_fh = hmt_handles.open_dataset(tss_path)
   tss_conversion_driver = tss_conversion_fh.GetDriver()
   tss_conversion_geotransform = tss_conversion_fh.GetGeoTransform()
   tss_conversion_projection = tss_conversion_fh.GetProjection()
@@ -174,7 +300,7 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
   tss_conversion_pixelHeight = tss_conversion_geotransform[5]
   
   # Open the TSS to Tidal Datum conversion tile and get metadata
-  tidal_conversion_fh = gdal.Open(tidal_conversion_path, gdal.GA_ReadOnly)
+  tidal_conversion_fh = hmt_handles.open_dataset(tidal_conversion_path)
   tidal_conversion_driver = tidal_conversion_fh.GetDriver()
   tidal_conversion_geotransform = tidal_conversion_fh.GetGeoTransform()
   tidal_conversion_projection = tidal_conversion_fh.GetProjection()
@@ -215,31 +341,28 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
   
   # Create a copy of the data using in the input tile as an example.
   logger.info("    Creating new raster...")
-  output_driver = gdal.GetDriverByName(driver)  # Setup the output driver
-  lidar_in_tidal_fh = output_driver.Create(lidar_in_tidal_datum_path, lidar_cols, lidar_rows, 1, lidar_datatype)
+  lidar_in_tidal_fh = hmt_formats.create(lidar_in_tidal_datum_path, lidar_cols, lidar_rows, 1, hmt_dtypes.SURFACE_TYPE, driver=driver, blocksize=blocksize)
   lidar_in_tidal_fh.SetGeoTransform(lidar_geotransform)
   lidar_in_tidal_fh.SetProjection(lidar_projection)
   lidar_in_tidal_band = lidar_in_tidal_fh.GetRasterBand(1)
-  lidar_in_tidal_band.SetNoDataValue(lidar_nodata)
+  output_nodata = hmt_dtypes.surface_nodata(lidar_nodata)  # the nearest nodata value float32 holds
+  if output_nodata is not None: lidar_in_tidal_band.SetNoDataValue(output_nodata)
+  output_index = None if block_index_path is None else hmt_blocks.BlockIndex(cols, rows, blocksize)
   logger.info("      done.")
   
   logger.info("    Processing data...")
   
-  #  Building Jobs
-  job_n = 0
-  for i in range(0, rows, yBlockSize):  # Loop through row blocks
-    if i + yBlockSize < rows: numRows = yBlockSize
-    else: numRows = rows - i
-    for j in range(0, cols, xBlockSize):  # Loop through col blocks
-      if j + xBlockSize < cols: numCols = xBlockSize
-      else: numCols = cols - j
-      # Build job here
+  # Blocks are read ahead and written behind on I/O threads while this loop computes (see blockio.py)
+  windows = list(hmt_blockio.block_windows(cols, rows, blocksize))
+  scratch = hmt_blockio.Scratch()  # temporaries reused by every block
+  # lidar is read as float64 if float32 cannot hold its nodata value (see dtypes.read_dtype)
+  with hmt_blockio.BlockReader([lidar_band, tss_conversion_band, tidal_conversion_band], windows,
+                               dtypes=[hmt_dtypes.read_dtype(lidar_nodata)] + [hmt_dtypes.SURFACE_DTYPE]*2) as reader, \
+       hmt_blockio.BlockWriter(lidar_in_tidal_band, dataset=lidar_in_tidal_fh, flush=True) as writer:
+    for (j, i, numCols, numRows), (lidar_np, tss_conversion_np, tidal_conversion_np) in reader:
       #logger.info("      Working on block offset ({0},{1}); cols {2}; rows: {3}...".format(j,i, numCols, numRows))
-      
-      # Read data
-      lidar_np = lidar_band.ReadAsArray(j, i, numCols, numRows)
-      tss_conversion_np = tss_conversion_band.ReadAsArray(j, i, numCols, numRows)
-      tidal_conversion_np = tidal_conversion_band.ReadAsArray(j, i, numCols, numRows)
+      lap = hmt_trace.block_spans(j, i)
+      lap('read_wait')
       
       ##
       # Convert conversion grids to Survey Feet
@@ -253,8 +376,9 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
       #
       # Tidal conversion unit = meters
       # tidal_conversion_surveyft = tss_conversion*3.280833333
-      tss_conversion_np_ft = tss_conversion_np*3.280833333
-      tidal_conversion_np_ft = tidal_conversion_np*3.280833333
+      block_shape = (numRows, numCols)
+      tss_conversion_np_ft = np.multiply(tss_conversion_np, SURVEY_FEET_PER_METER, out=scratch.array('tss_ft', block_shape, hmt_dtypes.SURFACE_DTYPE))
+      tidal_conversion_np_ft = np.multiply(tidal_conversion_np, SURVEY_FEET_PER_METER, out=scratch.array('tidal_ft', block_shape, hmt_dtypes.SURFACE_DTYPE))
       
       ##
       # Convert NAVD88 to TSS to Tidal Datum
@@ -264,20 +388,28 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
       # 
       # Therefore, ELEV_tidal = ELEV_navd + TSS conversion - Tidal conversion
       # 
-      lidar_in_tidal = lidar_np+tss_conversion_np_ft-tidal_conversion_np_ft
+      # computed in place, in the same order as lidar_np+tss_conversion_np_ft-tidal_conversion_np_ft
+      lidar_in_tidal = writer.buffer(block_shape, hmt_dtypes.SURFACE_DTYPE)
+      np.add(lidar_np, tss_conversion_np_ft, out=lidar_in_tidal)
+      np.subtract(lidar_in_tidal, tidal_conversion_np_ft, out=lidar_in_tidal)
+      if lidar_nodata is not None:
+        np.copyto(lidar_in_tidal, output_nodata, where=np.equal(lidar_np, lidar_nodata, out=scratch.array('nodata', block_shape, np.bool_)))
+      if output_index is not None: output_index.update(j, i, lidar_in_tidal, output_nodata)
+      lap('compute')
       
-      # Write the array to the raster
-      lidar_in_tidal_band.WriteArray(lidar_in_tidal, j, i)
+      # Queue the array for writing (the writer flushes after each block)
+      writer.write(lidar_in_tidal, j, i)
+      lap('write_wait')
       
       # Clean Up
       lidar_np = None
       tss_conversion_np = None
       tidal_conversion_np = None
       lidar_in_tidal = None
-      lidar_in_tidal_fh.FlushCache()
       
   # Done looping through blocks
   logger.info("   done.")
+  if output_index is not None: output_index.save(block_index_path)
   
   # Compute Statistics before closing out the dataset
   logger.info("  Computing stats...")
@@ -288,7 +420,7 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
   logger.info("    done.")
   
   logger.info("  Building blocks...")
-  lidar_in_tidal_fh.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(lidar_in_tidal_fh, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -306,11 +438,119 @@ def convert_navd88_to_tidal(lidar_path, tss_path, tidal_conversion_path, lidar_i
   #logger.info("  Done.")
   return lidar_in_tidal_datum_path
 
+def convert_navd88_to_tidal_sampled(lidar_path, tss_path, tidal_conversion_path, lidar_in_tidal_datum_path, band=1, blocksize=(600,600), driver=None, block_index_path=None):
+  """
+  Convert the lidar tile (NAVD88) to TSS to Tidal vertical datum, sampling the conversion grids on the fly
+  
+  This is the same-CRS fast path of convert_navd88_to_tidal. tss_path and tidal_conversion_path are the coarse
+  (statewide) conversion grids rather than copies warped to the lidar tile. Only the part of each grid that covers
+  the tile is held in memory and each block's bilinear values are computed from it directly, so no full
+  resolution resampled raster is ever written.
+  
+  If block_index_path is given, the block index of the output is recorded while it is written and saved there.
+  """
+  # Open the LIDAR tile as read-only and get the metadata
+  lidar_tile_fh = hmt_handles.open_dataset(lidar_path)
+  lidar_geotransform = lidar_tile_fh.GetGeoTransform()
+  lidar_projection = lidar_tile_fh.GetProjection()
+  lidar_cols = lidar_tile_fh.RasterXSize  # Get the number of columns
+  lidar_rows = lidar_tile_fh.RasterYSize  # Get the number of rows
+  logger.info("    lidar_cols: {0}".format(lidar_cols))
+  logger.info("    lidar_rows: {0}".format(lidar_rows))
+  lidar_band = lidar_tile_fh.GetRasterBand(band)  # Get the raster band
+  lidar_nodata = lidar_band.GetNoDataValue()  # Get the NoData value so we can set our mask
+  
+  # Hold the part of the conversion grids that covers the tile in memory
+  logger.info("    Reading TSS conversion grid window...")
+  tss_window, tss_window_geotransform = hmt_gdal.read_grid_window(tss_path, lidar_geotransform, lidar_cols, lidar_rows)
+  logger.info("      done.")
+  logger.info("    Reading tidal conversion grid window...")
+  tidal_window, tidal_window_geotransform = hmt_gdal.read_grid_window(tidal_conversion_path, lidar_geotransform, lidar_cols, lidar_rows)
+  logger.info("      done.")
+  
+  # Create a copy of the data using in the input tile as an example.
+  logger.info("    Creating new raster...")
+  lidar_in_tidal_fh = hmt_formats.create(lidar_in_tidal_datum_path, lidar_cols, lidar_rows, 1, hmt_dtypes.SURFACE_TYPE, driver=driver, blocksize=blocksize)
+  lidar_in_tidal_fh.SetGeoTransform(lidar_geotransform)
+  lidar_in_tidal_fh.SetProjection(lidar_projection)
+  lidar_in_tidal_band = lidar_in_tidal_fh.GetRasterBand(1)
+  output_nodata = hmt_dtypes.surface_nodata(lidar_nodata)  # the nearest nodata value float32 holds
+  if output_nodata is not None: lidar_in_tidal_band.SetNoDataValue(output_nodata)
+  output_index = None if block_index_path is None else hmt_blocks.BlockIndex(lidar_cols, lidar_rows, blocksize)
+  logger.info("      done.")
+  
+  logger.info("    Processing data...")
+  windows = list(hmt_blockio.block_windows(lidar_cols, lidar_rows, blocksize))
+  scratch = hmt_blockio.Scratch()  # temporaries reused by every block
+  with hmt_blockio.BlockReader([lidar_band], windows, dtypes=[hmt_dtypes.read_dtype(lidar_nodata)]) as reader, hmt_blockio.BlockWriter(lidar_in_tidal_band) as writer:
+    for (j, i, numCols, numRows), (lidar_np,) in reader:
+      
+      # Sample the conversion grids (in meters) at the lidar cell centres of the prefetched block
+      lap = hmt_trace.block_spans(j, i)
+      lap('read_wait')
+      tss_conversion_np = hmt_gdal.bilinear_sample(tss_window, tss_window_geotransform, lidar_geotransform, j, i, numCols, numRows)
+      tidal_conversion_np = hmt_gdal.bilinear_sample(tidal_window, tidal_window_geotransform, lidar_geotransform, j, i, numCols, numRows)
+      
+      # ELEV_tidal = ELEV_navd + TSS conversion - Tidal conversion, see convert_navd88_to_tidal for the units
+      block_shape = (numRows, numCols)
+      conversion_ft = np.subtract(tss_conversion_np, tidal_conversion_np, out=tss_conversion_np)
+      conversion_ft *= SURVEY_FEET_PER_METER
+      lidar_in_tidal = writer.buffer(block_shape, hmt_dtypes.SURFACE_DTYPE)
+      np.add(lidar_np, conversion_ft, out=lidar_in_tidal)
+      
+      # Cells without lidar data or outside the conversion grids become nodata
+      if lidar_nodata is not None:
+        invalid = np.isnan(lidar_in_tidal, out=scratch.array('invalid', block_shape, np.bool_))
+        invalid |= np.equal(lidar_np, lidar_nodata, out=scratch.array('nodata', block_shape, np.bool_))
+        np.copyto(lidar_in_tidal, output_nodata, where=invalid)
+      if output_index is not None: output_index.update(j, i, lidar_in_tidal, output_nodata)
+      lap('compute')
+      
+      # Queue the array for writing
+      writer.write(lidar_in_tidal, j, i)
+      lap('write_wait')
+      
+      # Clean Up
+      lidar_np = None
+      tss_conversion_np = None
+      tidal_conversion_np = None
+      lidar_in_tidal = None
+  # Done looping through blocks
+  logger.info("   done.")
+  if output_index is not None: output_index.save(block_index_path)
+  
+  # Compute Statistics before closing out the dataset
+  logger.info("  Computing stats...")
+  try:
+    lidar_in_tidal_band.ComputeStatistics(False)
+  except RuntimeError:
+    logger.warn("    Cannot compute statistics.")
+  logger.info("    done.")
+  
+  logger.info("  Building blocks...")
+  hmt_formats.build_overviews(lidar_in_tidal_fh, [2,4,8,16,32,64,128])
+  logger.info("    done.")
+  
+  logger.info("  Flushing the cache...")
+  lidar_in_tidal_fh.FlushCache()
+  logger.info("    done.")
+  
+  # Clean up the dataset file handlers
+  logger.info("  Closing the dataset...")
+  lidar_in_tidal_band = None
+  lidar_in_tidal_fh = None
+  lidar_tile_fh = None
+  tss_window = None
+  tidal_window = None
+  logger.info("    done.")
+  
+  return lidar_in_tidal_datum_path
+
 def binary_raster_to_vector(binary_raster_path, output_vector_path, driver="ESRI Shapefile"):
   """ Convert a binary raster to a vector """
   
   # Open the binary tile as read-only and get the driver GDAL is using to access the data
-  binary_tile_fh = gdal.Open(binary_raster_path, gdal.GA_ReadOnly)
+  binary_tile_fh = hmt_handles.open_dataset(binary_raster_path)
   input_raster_driver = binary_tile_fh.GetDriver()
   
   # Pull Metadata associated with the binary tile so we can create the output raster later
@@ -322,8 +562,7 @@ def binary_raster_to_vector(binary_raster_path, output_vector_path, driver="ESRI
   binary_nodata = binary_tile.GetNoDataValue()  # Get the NoData value so we can set our mask
   
   # Create the spatial ref for the output vector
-  osr_ref = osr.SpatialReference()
-  osr_ref.ImportFromWkt(raster_projection)
+  osr_ref = hmt_handles.spatial_reference(raster_projection)
   
   # Create a memory OGR datasource to put results in.
   vect_driver = ogr.GetDriverByName(driver)
@@ -351,15 +590,17 @@ def binary_raster_to_vector(binary_raster_path, output_vector_path, driver="ESRI
   logger.info("      done.")
   return output_vector_path
 
-def hmt_tile_binary_processor(tile_path, hmt_value, output_path, driver="HFA", noData=0, blocksize=(600,600)):
+def hmt_tile_binary_processor(tile_path, hmt_value, output_path, driver=None, noData=0, blocksize=(600,600), block_index=None):
   """
   Open the tile, get info about it, create a binary raster marking areas below HMT as a value of 1
   
   hmt_value is a HMT threshold applied to every cell in the raster.
+  block_index (a BlockIndex of the tile or the path of a saved one) lets blocks that are entirely above or
+  below hmt_value be written without reading them.
   """
 
   # Open the LIDAR tile as read-only and get the driver GDAL is using to access the data
-  lidar_tile_fh = gdal.Open(tile_path, gdal.GA_ReadOnly)
+  lidar_tile_fh = hmt_handles.open_dataset(tile_path)
   input_driver = lidar_tile_fh.GetDriver()
 
   # Pull Metadata associated with the LIDAR tile so we can create the output raster later
@@ -384,39 +625,60 @@ def hmt_tile_binary_processor(tile_path, hmt_value, output_path, driver="HFA", n
   
   # Create a copy of the data using in the input tile as an example.
   logger.info("  Creating new raster...")
-  output_driver = gdal.GetDriverByName(driver)  # Setup the output driver
-  HMT_output_fh = output_driver.Create(output_path, cols, rows, 1, gdal.GDT_Byte)
+  HMT_output_fh = hmt_formats.create(output_path, cols, rows, 1, hmt_dtypes.MASK_TYPE, driver=driver, mask=True, blocksize=blocksize)
   HMT_output_fh.SetGeoTransform(tile_geotransform)
   HMT_output_fh.SetProjection(tile_projection)
   HMT_output_band = HMT_output_fh.GetRasterBand(1)
   HMT_output_band.SetNoDataValue(noData)
+  lidar_index = hmt_blocks.resolve_block_index(block_index, cols, rows, blocksize)
+  pruned_blocks = 0
   logger.info("    done.")
   
   logger.info("  Processing data...")
   
-  #  Building Jobs
-  job_n = 0
-  for i in range(0, rows, yBlockSize):  # Loop through row blocks
-    if i + yBlockSize < rows: numRows = yBlockSize
-    else: numRows = rows - i
-    for j in range(0, cols, xBlockSize):  # Loop through col blocks
-      if j + xBlockSize < cols: numCols = xBlockSize
-      else: numCols = cols - j
-      # Build job here
+  # Classify the blocks up front so only the ones that straddle HMT are read (ahead, on the reader thread)
+  windows = list(hmt_blockio.block_windows(cols, rows, blocksize))
+  if lidar_index is not None:
+    block_classes = [hmt_blocks.classify_block(lidar_index.stats(j, i), hmt_value, hmt_value) for j, i, numCols, numRows in windows]
+  else:
+    block_classes = [hmt_blocks.STRADDLES]*len(windows)
+  read_windows = [window for window, block_class in zip(windows, block_classes) if block_class is hmt_blocks.STRADDLES]
+  
+  scratch = hmt_blockio.Scratch()  # temporaries reused by every block
+  with hmt_blockio.BlockReader([tile_lidar], read_windows, dtypes=[hmt_dtypes.read_dtype(tile_nodata)]) as reader, \
+       hmt_blockio.BlockWriter(HMT_output_band, dataset=HMT_output_fh, flush=True) as writer:
+    for (j, i, numCols, numRows), block_class in zip(windows, block_classes):
       #logger.info("    Working on block offset ({0},{1}); cols {2}; rows: {3}...".format(j,i, numCols, numRows))
-      lidar_np = tile_lidar.ReadAsArray(j, i, numCols, numRows)
-      lidar_hmt_masked_below_hmt = np.ma.masked_equal(lidar_np, tile_nodata, copy=False).filled(np.nan) <= hmt_value  # Create the mask
       
-      # Write the array to the raster
-      HMT_output_band.WriteArray(lidar_hmt_masked_below_hmt.astype(np.int), j, i)
+      # Write blocks that are entirely above / below HMT without reading them
+      lap = hmt_trace.block_spans(j, i)
+      if block_class is not hmt_blocks.STRADDLES:
+        constant_block = writer.buffer((numRows, numCols), hmt_dtypes.MASK_DTYPE)
+        constant_block.fill(block_class)
+        writer.write(constant_block, j, i)
+        pruned_blocks += 1
+        lap('write_pruned')
+        continue
+      
+      window, (lidar_np,) = next(reader)
+      lap('read_wait')
+      # 1 where the elevation is at or below HMT, 0 elsewhere and for nodata / NaN cells, straight into a Byte block
+      lidar_hmt_masked_below_hmt = np.less_equal(lidar_np, hmt_value, out=writer.buffer((numRows, numCols), hmt_dtypes.MASK_DTYPE))
+      if tile_nodata is not None:
+        lidar_hmt_masked_below_hmt &= np.not_equal(lidar_np, tile_nodata, out=scratch.array('valid', (numRows, numCols), np.bool_))
+      lap('compute')
+      
+      # Queue the array for writing (the writer flushes after each block)
+      writer.write(lidar_hmt_masked_below_hmt, j, i)
+      lap('write_wait')
       
       # Clean Up
-      HMT_output_fh.FlushCache()
       lidar_hmt_masked_below_hmt = None
       lidar_np = None
   # Done looping through blocks
   
   logger.info("   done.")
+  if lidar_index is not None: logger.info("  {0} blocks written from the block index".format(pruned_blocks))
   
   # Compute Statistics before closing out the dataset
   logger.info("  Computing stats...")
@@ -427,7 +689,7 @@ def hmt_tile_binary_processor(tile_path, hmt_value, output_path, driver="HFA", n
   logger.info("    done.")
   
   logger.info("  Building blocks...")
-  HMT_output_fh.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(HMT_output_fh, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -445,17 +707,21 @@ def hmt_tile_binary_processor(tile_path, hmt_value, output_path, driver="HFA", n
   #logger.info("  Done.")
   return output_path
 
-def hmt_tile_binary_processor_griddedHMT(tile_path, hmt_incriment_tile_path, output_path, driver="HFA", noData=0, blocksize=(600,600)):
+def hmt_tile_binary_processor_griddedHMT(tile_path, hmt_incriment_tile_path, output_path, driver=None, noData=0, blocksize=(600,600), block_index=None, hmt_block_index=None):
   """
   Open the tile, get info about it, create a binary raster marking areas below HMT as a value of 1
   
   This variant of the processor uses a HMT grid of the same dimension, extent, and cell position as the source elevation data.
   Doing so allows this processor to respect site-specific HMT thresholds (i.e., each cell has a unique HMT).
+  
+  block_index and hmt_block_index (BlockIndex objects or paths of saved ones) of the tile and the HMT grid let
+  blocks that are entirely above or below HMT be written without reading them. Without hmt_block_index only
+  blocks without lidar data are skipped.
   """
 
   # Open the LIDAR tile as read-only, get the driver GDAL is using to access the data,
   # and pull Metadata associated with the LIDAR tile so we can create the output raster later.
-  lidar_tile_fh = gdal.Open(tile_path, gdal.GA_ReadOnly)
+  lidar_tile_fh = hmt_handles.open_dataset(tile_path)
   input_driver = lidar_tile_fh.GetDriver()
   tile_geotransform = lidar_tile_fh.GetGeoTransform()
   tile_projection = lidar_tile_fh.GetProjection()
@@ -468,7 +734,7 @@ def hmt_tile_binary_processor_griddedHMT(tile_path, hmt_incriment_tile_path, out
   
   # Open the LIDAR tile as read-only, get the driver GDAL is using to access the data,
   # and pull Metadata associated with the LIDAR tile so we can create the output raster later.
-  hmt_tile_fh = gdal.Open(hmt_incriment_tile_path, gdal.GA_ReadOnly)
+  hmt_tile_fh = hmt_handles.open_dataset(hmt_incriment_tile_path)
   hmt_driver = hmt_tile_fh.GetDriver()
   tile_hmt_geotransform = hmt_tile_fh.GetGeoTransform()
   tile_hmt_projection = hmt_tile_fh.GetProjection()
@@ -491,44 +757,68 @@ def hmt_tile_binary_processor_griddedHMT(tile_path, hmt_incriment_tile_path, out
   
   # Create a copy of the data using in the input tile as an example.
   logger.info("  Creating new raster...")
-  output_driver = gdal.GetDriverByName(driver)  # Setup the output driver
-  HMT_output_fh = output_driver.Create(output_path, cols, rows, 1, gdal.GDT_Byte)
+  HMT_output_fh = hmt_formats.create(output_path, cols, rows, 1, hmt_dtypes.MASK_TYPE, driver=driver, mask=True, blocksize=blocksize)
   HMT_output_fh.SetGeoTransform(tile_geotransform)
   HMT_output_fh.SetProjection(tile_projection)
   HMT_output_band = HMT_output_fh.GetRasterBand(1)
   HMT_output_band.SetNoDataValue(noData)
+  lidar_index = hmt_blocks.resolve_block_index(block_index, cols, rows, blocksize)
+  hmt_index = hmt_blocks.resolve_block_index(hmt_block_index, cols, rows, blocksize)
+  pruned_blocks = 0
   logger.info("    done.")
   
   logger.info("  Processing data...")
   
-  #  Building Jobs
-  job_n = 0
-  for i in range(0, rows, yBlockSize):  # Loop through row blocks
-    if i + yBlockSize < rows: numRows = yBlockSize
-    else: numRows = rows - i
-    for j in range(0, cols, xBlockSize):  # Loop through col blocks
-      if j + xBlockSize < cols: numCols = xBlockSize
-      else: numCols = cols - j
-      # Build job here
+  # Classify the blocks up front so only the ones that straddle HMT are read (ahead, on the reader thread)
+  windows = list(hmt_blockio.block_windows(cols, rows, blocksize))
+  block_classes = list()
+  for j, i, numCols, numRows in windows:
+    if lidar_index is None:
+      block_classes.append(hmt_blocks.STRADDLES)
+    elif hmt_index is not None:
+      hmt_min, hmt_max, hmt_valid, hmt_pixels = hmt_index.stats(j, i)
+      block_classes.append(hmt_blocks.classify_block(lidar_index.stats(j, i), hmt_min, hmt_max, threshold_complete=(hmt_valid == hmt_pixels)))
+    else:
+      block_classes.append(hmt_blocks.classify_block(lidar_index.stats(j, i), None, None, threshold_complete=False))
+  read_windows = [window for window, block_class in zip(windows, block_classes) if block_class is hmt_blocks.STRADDLES]
+  
+  scratch = hmt_blockio.Scratch()  # temporaries reused by every block
+  with hmt_blockio.BlockReader([tile_lidar, tile_hmt], read_windows, dtypes=[hmt_dtypes.read_dtype(tile_nodata), hmt_dtypes.SURFACE_DTYPE]) as reader, \
+       hmt_blockio.BlockWriter(HMT_output_band, dataset=HMT_output_fh, flush=True) as writer:
+    for (j, i, numCols, numRows), block_class in zip(windows, block_classes):
       #logger.info("    Working on block offset ({0},{1}); cols {2}; rows: {3}...".format(j,i, numCols, numRows))
       
-      lidar_np = tile_lidar.ReadAsArray(j, i, numCols, numRows)
-      hmt_np = tile_hmt.ReadAsArray(j, i, numCols, numRows)
+      # Write blocks that are entirely above / below HMT without reading them
+      lap = hmt_trace.block_spans(j, i)
+      if block_class is not hmt_blocks.STRADDLES:
+        constant_block = writer.buffer((numRows, numCols), hmt_dtypes.MASK_DTYPE)
+        constant_block.fill(block_class)
+        writer.write(constant_block, j, i)
+        pruned_blocks += 1
+        lap('write_pruned')
+        continue
       
-      lidar_hmt_masked_below_hmt = np.ma.masked_equal(lidar_np, tile_nodata, copy=True).filled(np.nan)  # Create the mask
-      binary_rast = lidar_hmt_masked_below_hmt <= hmt_np
+      window, (lidar_np, hmt_np) = next(reader)
+      lap('read_wait')
       
-      # Write the array to the raster
-      HMT_output_band.WriteArray(binary_rast.astype(np.int), j, i)
+      # 1 where the elevation is at or below the cell's HMT, 0 elsewhere and for nodata / NaN cells
+      binary_rast = np.less_equal(lidar_np, hmt_np, out=writer.buffer((numRows, numCols), hmt_dtypes.MASK_DTYPE))
+      if tile_nodata is not None:
+        binary_rast &= np.not_equal(lidar_np, tile_nodata, out=scratch.array('valid', (numRows, numCols), np.bool_))
+      lap('compute')
+      
+      # Queue the array for writing (the writer flushes after each block)
+      writer.write(binary_rast, j, i)
+      lap('write_wait')
       
       # Clean Up
-      HMT_output_fh.FlushCache()
-      lidar_hmt_masked_below_hmt = None
+      binary_rast = None
       lidar_np = None
       hmt_np = None
   # Done looping through blocks
   
   logger.info("   done.")
+  if lidar_index is not None: logger.info("  {0} blocks written from the block index".format(pruned_blocks))
   
   # Compute Statistics before closing out the dataset
   logger.info("  Computing stats...")
@@ -539,7 +829,7 @@ def hmt_tile_binary_processor_griddedHMT(tile_path, hmt_incriment_tile_path, out
   logger.info("    done.")
   
   logger.info("  Building blocks...")
-  HMT_output_fh.BuildOverviews(overviewlist=[2,4,8,16,32,64,128])
+  hmt_formats.build_overviews(HMT_output_fh, [2,4,8,16,32,64,128])
   logger.info("    done.")
   
   logger.info("  Flushing the cache...")
@@ -556,4 +846,115 @@ def hmt_tile_binary_processor_griddedHMT(tile_path, hmt_incriment_tile_path, out
   
   # We're done!
   #logger.info("  Done.")
-  return output_path
\ No newline at end of file
+  return output_path
+
+
+def hmt_tile_binary_processor_sampledHMT(tile_path, hmt_grid_path, output_path, driver=None, noData=0, blocksize=(600,600), block_index=None):
+  """
+  Open the tile, get info about it, create a binary raster marking areas below HMT as a value of 1
+  
+  This is the same-CRS fast path of hmt_tile_binary_processor_griddedHMT. hmt_grid_path is the coarse HMT grid
+  itself rather than a copy warped to the tile; each block's HMT thresholds are bilinearly sampled from the
+  part of the grid that covers the tile, which is held in memory.
+  
+  block_index (a BlockIndex of the tile or the path of a saved one) lets blocks that are entirely above or below
+  HMT be written without reading them; the HMT bounds of each block come from the grid cells it samples.
+  """
+
+  # Open the LIDAR tile as read-only and pull Metadata associated with it so we can create the output raster later.
+  lidar_tile_fh = hmt_handles.open_dataset(tile_path)
+  tile_geotransform = lidar_tile_fh.GetGeoTransform()
+  tile_projection = lidar_tile_fh.GetProjection()
+  cols = lidar_tile_fh.RasterXSize  # Get the number of columns
+  rows = lidar_tile_fh.RasterYSize  # Get the number of rows
+  logger.info("  cols: {0}".format(cols))
+  logger.info("  rows: {0}".format(rows))
+  tile_lidar = lidar_tile_fh.GetRasterBand(1)  # Get the raster band
+  tile_nodata = tile_lidar.GetNoDataValue()  # Get the NoData value so we can set our mask
+  
+  # Hold the part of the HMT grid that covers the tile in memory
+  logger.info("  Reading HMT grid window...")
+  hmt_window, hmt_window_geotransform = hmt_gdal.read_grid_window(hmt_grid_path, tile_geotransform, cols, rows)
+  logger.info("    done.")
+  
+  # Create a copy of the data using in the input tile as an example.
+  logger.info("  Creating new raster...")
+  HMT_output_fh = hmt_formats.create(output_path, cols, rows, 1, hmt_dtypes.MASK_TYPE, driver=driver, mask=True, blocksize=blocksize)
+  HMT_output_fh.SetGeoTransform(tile_geotransform)
+  HMT_output_fh.SetProjection(tile_projection)
+  HMT_output_band = HMT_output_fh.GetRasterBand(1)
+  HMT_output_band.SetNoDataValue(noData)
+  lidar_index = hmt_blocks.resolve_block_index(block_index, cols, rows, blocksize)
+  pruned_blocks = 0
+  logger.info("    done.")
+  
+  logger.info("  Processing data...")
+  # Classify the blocks up front so only the ones that straddle HMT are read (ahead, on the reader thread)
+  windows = list(hmt_blockio.block_windows(cols, rows, blocksize))
+  block_classes = list()
+  for j, i, numCols, numRows in windows:
+    if lidar_index is None:
+      block_classes.append(hmt_blocks.STRADDLES)
+    else:
+      hmt_min, hmt_max, hmt_complete = hmt_gdal.bilinear_sample_bounds(hmt_window, hmt_window_geotransform, tile_geotransform, j, i, numCols, numRows)
+      block_classes.append(hmt_blocks.classify_block(lidar_index.stats(j, i), hmt_min, hmt_max, threshold_complete=hmt_complete))
+  read_windows = [window for window, block_class in zip(windows, block_classes) if block_class is hmt_blocks.STRADDLES]
+  
+  scratch = hmt_blockio.Scratch()  # temporaries reused by every block
+  with hmt_blockio.BlockReader([tile_lidar], read_windows, dtypes=[hmt_dtypes.read_dtype(tile_nodata)]) as reader, hmt_blockio.BlockWriter(HMT_output_band) as writer:
+    for (j, i, numCols, numRows), block_class in zip(windows, block_classes):
+      
+      # Write blocks that are entirely above / below HMT without reading them
+      lap = hmt_trace.block_spans(j, i)
+      if block_class is not hmt_blocks.STRADDLES:
+        constant_block = writer.buffer((numRows, numCols), hmt_dtypes.MASK_DTYPE)
+        constant_block.fill(block_class)
+        writer.write(constant_block, j, i)
+        pruned_blocks += 1
+        lap('write_pruned')
+        continue
+      
+      window, (lidar_np,) = next(reader)
+      lap('read_wait')
+      hmt_np = hmt_gdal.bilinear_sample(hmt_window, hmt_window_geotransform, tile_geotransform, j, i, numCols, numRows)
+      
+      # 1 where the elevation is at or below the sampled HMT, 0 elsewhere and for nodata / NaN cells
+      binary_rast = np.less_equal(lidar_np, hmt_np, out=writer.buffer((numRows, numCols), hmt_dtypes.MASK_DTYPE))
+      if tile_nodata is not None:
+        binary_rast &= np.not_equal(lidar_np, tile_nodata, out=scratch.array('valid', (numRows, numCols), np.bool_))
+      lap('compute')
+      
+      # Queue the array for writing
+      writer.write(binary_rast, j, i)
+      lap('write_wait')
+      
+      # Clean Up
+      binary_rast = None
+      lidar_np = None
+      hmt_np = None
+  # Done looping through blocks
+  
+  logger.info("   done.")
+  if lidar_index is not None: logger.info("  {0} blocks written from the block index".format(pruned_blocks))
+  
+  # Compute Statistics before closing out the dataset
+  logger.info("  Computing stats...")
+  try:
+    HMT_output_band.ComputeStatistics(False)
+  except RuntimeError:
+    logger.warn("    Cannot compute statistics. This probably means that there were no pixels that met the HMT definition and are therefore null values.")
+  logger.info("    done.")
+  
+  logger.info("  Building blocks...")
+  hmt_formats.build_overviews(HMT_output_fh, [2,4,8,16,32,64,128])
+  logger.info("    done.")
+  
+  # Clean up the dataset file handlers
+  logger.info("  Closing the dataset...")
+  HMT_output_band = None
+  lidar_tile_fh = None
+  HMT_output_fh = None
+  hmt_window = None
+  logger.info("    done.")
+  
+  return output_path
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Per-process runtime configuration.
+
+Importing the hmt_processor modules or the scripts changes no global state. A Runtime describes how a process
+should be set up (GDAL exceptions, block cache, GDAL_NUM_THREADS and other config options, output format, log handlers) and
+configure() applies it once per process. Entry points configure the main process; data_processor hands each
+worker a Runtime sized for its share of the machine (for_worker) through the pool initializer. Optional
+backends such as Parallel Python are imported only when they are used (optional_import).
+"""
+
+# Import core modules
+import sys
+import os
+import copy
+import importlib
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# GDAL config options every process gets
+DEFAULT_CONFIG_OPTIONS = {
+  'HFA_USE_RRD': 'YES',  # Configure GDAL to use blocks
+  # Object store inputs (see objectstore.py): 512 KB range requests, merged when consecutive and multiplexed over
+  # HTTP/2, with an in-memory cache of recently read ranges
+  'CPL_VSIL_CURL_CHUNK_SIZE': '524288',
+  'CPL_VSIL_CURL_CACHE_SIZE': '268435456',
+  'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+  'GDAL_HTTP_MULTIPLEX': 'YES',
+  'GDAL_HTTP_MAX_RETRY': '3',
+  'GDAL_HTTP_RETRY_DELAY': '1',
+}
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+LOG_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+# pid -> Runtime applied in that process
+_configured = dict()
+
+
+class Runtime(object):
+  """
+  How to set up a process. cache_mb is the GDAL block cache (2 GB by default), num_threads sets
+  GDAL_NUM_THREADS (GDAL's default when None), config_options are extra GDAL config options, and log_path /
+  log_level add a file handler (and a console handler when console=True) to the 'hmt_processor' logger.
+  output_format is the pipeline-wide output format (see hmt_processor.formats; HMT_OUTPUT_FORMAT when None).
+  shared_grids are grids published to shared memory by the parent (see hmt_processor.sharedgrids).
+  """
+
+  def __init__(self, cache_mb=2048, num_threads=None, config_options=None, log_path=None, log_level=logging.DEBUG, console=True, output_format=None, shared_grids=()):
+    self.cache_mb = cache_mb
+    self.num_threads = num_threads
+    self.output_format = output_format
+    self.shared_grids = tuple(shared_grids)
+    self.config_options = dict(DEFAULT_CONFIG_OPTIONS)
+    self.config_options.update(config_options or {})
+    self.log_path = log_path
+    self.log_level = log_level
+    self.console = console
+
+  def for_worker(self, workers, cache_mb=None, num_threads=None):
+    """
+    A copy for one of workers worker processes: GDAL threads up to an equal share of the cores (num_threads,
+    e.g. from a tuned profile, if it is smaller), the given cache (e.g. from a hmt_processor.memory.MemoryPlan)
+    and no log handlers of its own (forked workers inherit them)
+    """
+    worker = copy.copy(self)
+    worker.config_options = dict(self.config_options)
+    worker.num_threads = max(1, multiprocessing.cpu_count()//max(1, workers))
+    if num_threads is not None: worker.num_threads = min(worker.num_threads, num_threads)
+    if cache_mb is not None: worker.cache_mb = cache_mb
+    worker.log_path = None
+    worker.console = False
+    return worker
+
+  def configure(self, force=False):
+    """ Apply to this process; does nothing if this process is already configured, unless force is True """
+    if os.getpid() in _configured and not force:
+      return _configured[os.getpid()]
+    from osgeo import gdal
+    from osgeo import ogr
+    from osgeo import osr
+    
+    # Fix osgeo error reporting
+    gdal.UseExceptions()
+    ogr.UseExceptions()
+    osr.UseExceptions()
+    
+    # Set gdal configuration parameters
+    gdal.SetCacheMax(int(self.cache_mb)*1024*1024)
+    for key, value in self.config_options.items():
+      gdal.SetConfigOption(key, value)
+    if self.num_threads is not None:
+      gdal.SetConfigOption('GDAL_NUM_THREADS', str(self.num_threads))
+    if self.output_format is not None:
+      import formats as hmt_formats
+      hmt_formats.set_default(self.output_format)
+    if self.shared_grids:
+      import sharedgrids as hmt_shared
+      hmt_shared.register(self.shared_grids)
+    
+    self.configure_logging()
+    _configured[os.getpid()] = self
+    return self
+
+  def configure_logging(self):
+    """ Attach the console / file handlers to the 'hmt_processor' logger (once per handler) """
+    if self.log_path is None and not self.console:
+      return
+    logger.setLevel(self.log_level)
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+    if self.console and not any(type(handler) is logging.StreamHandler for handler in logger.handlers):
+      ch = logging.StreamHandler()
+      ch.setLevel(self.log_level)
+      ch.setFormatter(formatter)
+      logger.addHandler(ch)
+    if self.log_path is not None and not any(getattr(handler, 'baseFilename', None) == os.path.abspath(self.log_path) for handler in logger.handlers):
+      log_dir = os.path.dirname(self.log_path)
+      if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+      fhnd = logging.FileHandler(self.log_path)
+      fhnd.setLevel(self.log_level)
+      fhnd.setFormatter(formatter)
+      logger.addHandler(fhnd)
+
+
+def configure(runtime=None):
+  """ Configure this process with runtime (a default Runtime without log handlers if None) """
+  if runtime is None:
+    runtime = Runtime(console=False)
+  return runtime.configure()
+
+
+def configure_worker(runtime):
+  """ Pool initializer: configure a worker process (also applied over the main process's setup for serial runs) """
+  return runtime.configure(force=True)
+
+
+def current():
+  """ The Runtime this process was configured with, or None """
+  return _configured.get(os.getpid())
+
+
+def optional_import(module_name, purpose):
+  """ Import an optional dependency when it is first needed; purpose goes into the error message """
+  try:
+    return importlib.import_module(module_name)
+  except ImportError:
+    raise ImportError("{0} requires the optional '{1}' package, which is not installed".format(purpose, module_name))
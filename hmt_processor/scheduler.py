@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Runs independent jobs (one per quad) serially, in local worker processes, on Parallel Python nodes, or through a
+durable SQLite work queue (hmt_processor.workqueue) that workers on other hosts can also pull from.
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+import runtime as hmt_runtime
+
+
+def run_jobs(function, jobs, workers=1, backend=None, pp_secret="TheEagleHasLanded", pp_modules=(), job_mb=None, memory_mb=None, initializer=None, initargs=(), on_done=None, queue_path=None, queue_name=None):
+  """
+  Call function(*args) for each args tuple in jobs and return the results in job order.
+  
+  backend is 'serial', 'multiprocessing' (workers local processes) or 'pp' (a Parallel Python server using
+  workers CPUs plus any active remote nodes) or 'queue' (jobs are submitted, in order of priority, to the work
+  queue at queue_path under queue_name and run by workers local worker processes plus any hmt_worker.py
+  processes polling the same queue on other hosts). By default jobs run serially for workers=1 and in local
+  processes otherwise.
+  
+  job_mb is the projected memory of each job (see hmt_processor.memory.estimate_job_mb). With memory_mb set,
+  a job is only started while the projected memory of the jobs in flight stays within memory_mb (one job is
+  always allowed). initializer(*initargs) runs once in each local worker process, or here for serial runs.
+  on_done(job_n, result) is called in this process as each job finishes.
+  """
+  jobs = list(jobs)
+  if backend is None:
+    backend = 'serial' if workers <= 1 or len(jobs) <= 1 else 'multiprocessing'
+  logger.info("Running {0} jobs with the {1} backend ({2} workers)".format(len(jobs), backend, workers))
+  job_mb = job_mb or [0]*len(jobs)
+  if on_done is None: on_done = lambda job_n, result: None
+  
+  if backend == 'serial':
+    if initializer is not None: initializer(*initargs)
+    results = list()
+    for job_n, args in enumerate(jobs):
+      results.append(function(*args))
+      on_done(job_n, results[-1])
+    return results
+  
+  if backend == 'multiprocessing':
+    pool = multiprocessing.Pool(processes=workers, initializer=initializer, initargs=initargs)
+    try:
+      pending = list()
+      admission = Admission(memory_mb, job_mb, lambda job_n: pending[job_n].ready())
+      for job_n, args in enumerate(jobs):
+        admission.admit(job_n)
+        pending.append(pool.apply_async(function, args, callback=_job_callback(on_done, job_n)))
+      results = [job.get() for job in pending]
+    finally:
+      pool.close()
+      pool.join()
+    return results
+  
+  if backend == 'pp':
+    return _run_jobs_pp(function, jobs, workers, pp_secret, pp_modules, job_mb, memory_mb, on_done)
+  
+  if backend == 'queue':
+    return _run_jobs_queue(function, jobs, workers, initializer, initargs, on_done, queue_path, queue_name)
+  
+  raise ValueError("unknown backend: {0}".format(backend))
+
+
+class Admission(object):
+  """
+  Holds back job submission while the projected memory of the jobs in flight would exceed memory_mb.
+  done(job_n) tells whether a submitted job has finished (successfully or not).
+  """
+  
+  def __init__(self, memory_mb, job_mb, done):
+    self.memory_mb = memory_mb
+    self.job_mb = list(job_mb)
+    self.done = done
+    self.in_flight = dict()
+  
+  def projected_mb(self):
+    """ Projected memory of the jobs still running """
+    for job_n in [job_n for job_n in self.in_flight if self.done(job_n)]:
+      del self.in_flight[job_n]
+    return sum(self.in_flight.values())
+  
+  def admit(self, job_n):
+    """ Wait until job_n fits, then count it as in flight """
+    if self.memory_mb is not None and self.projected_mb() + self.job_mb[job_n] > self.memory_mb and self.in_flight:
+      logger.info("  Holding job {0} ({1:.0f} MB projected, {2:.0f} MB in flight)".format(job_n, self.job_mb[job_n], self.projected_mb()))
+      while self.projected_mb() + self.job_mb[job_n] > self.memory_mb and self.in_flight:
+        time.sleep(0.5)
+    self.in_flight[job_n] = self.job_mb[job_n]
+
+
+def _job_callback(on_done, job_n):
+  """ A result callback that reports job_n to on_done """
+  def callback(result):
+    on_done(job_n, result)
+  return callback
+
+
+def _run_jobs_pp(function, jobs, workers, pp_secret, pp_modules, job_mb, memory_mb, on_done):
+  """ Run the jobs on a Parallel Python server """
+  pp = hmt_runtime.optional_import('pp', "The 'pp' scheduler backend")
+  
+  # Set up the parallel python server
+  ppserver = pp.Server(secret=pp_secret)
+  ppserver.set_ncpus(workers)
+  logger.info("Using {0} CPUs".format(ppserver.get_ncpus()))
+  logger.info("Active PP nodes: {0}".format(ppserver.get_active_nodes()))
+  
+  ppjobs = list()
+  admission = Admission(memory_mb, job_mb, lambda job_n: ppjobs[job_n].finished)
+  for job_n, args in enumerate(jobs):
+    admission.admit(job_n)
+    ppjobs.append(ppserver.submit(function, args, modules=tuple(pp_modules), callback=_job_callback(on_done, job_n)))
+  
+  # wait for jobs to complete
+  ppserver.wait()
+  
+  # Print out the stats from parallel python
+  logger.info("Parallel Python Stats")
+  job_stats = ppserver.get_stats()  # get stats as dict
+  for src in job_stats.keys():
+    logger.info("  {0} - {1}: {2}".format(src, 'ncpus', job_stats[src].ncpus))
+    logger.info("  {0} - {1}: {2}".format(src, 'njobs', job_stats[src].njobs))
+    logger.info("  {0} - {1}: {2}".format(src, 'rworker', job_stats[src].rworker))
+    logger.info("  {0} - {1}: {2}".format(src, 'time', job_stats[src].time))
+  
+  # Get results from the jobs and close out of the Parallel Python server
+  results = [jobresult() for jobresult in ppjobs]
+  ppserver.destroy()
+  return results
+
+
+def _run_jobs_queue(function, jobs, workers, initializer, initargs, on_done, queue_path, queue_name):
+  """
+  Run the jobs through the SQLite work queue. Each worker holds one job at a time, so memory admission is left
+  to the number of workers per host.
+  """
+  import workqueue as hmt_workqueue
+  
+  queue_name = queue_name or "{0}-{1}".format(function.__name__, time.strftime('%Y%m%d-%H%M%S'))
+  queue = hmt_workqueue.WorkQueue(queue_path)
+  # Earlier jobs get the higher priority, so workers take them in the order they were planned
+  job_ids = queue.submit(queue_name, function, jobs, priorities=[len(jobs) - job_n for job_n in range(len(jobs))],
+                         initializer=initializer, initargs=initargs)
+  logger.info("Submitted {0} jobs to queue {1} in {2}".format(len(job_ids), queue_name, queue.path))
+  
+  processes = list()
+  for worker_n in range(workers):
+    process = multiprocessing.Process(target=hmt_workqueue.work, kwargs={'path': queue.path, 'queues': [queue_name]})
+    process.start()
+    processes.append(process)
+  try:
+    results = queue.wait(job_ids, on_done=on_done)
+  except hmt_workqueue.JobFailed:
+    queue.cancel(queue_name)
+    raise
+  finally:
+    for process in processes:
+      process.join()
+    queue.close()
+  return results
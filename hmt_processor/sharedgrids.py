@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Statewide grids shared by the worker processes through memory-mapped files.
+
+Every quad of the same-CRS fast path samples windows of the same statewide TSS, MHHW and HMT increment grids.
+publish() reads each grid once in the parent process (only the window covering the run's quads when bounds is
+given) as float32 with nodata set to NaN, the form read_grid_window returns, into a file in /dev/shm (HMT_SHM_DIR,
+or the temp directory where there is no /dev/shm). The SharedGrid descriptions travel to the workers with their
+Runtime; register() makes hmt_gdal.read_grid_window hand out read-only numpy views of the mapped files instead of
+decoding the grid again through each worker's GDAL cache, so the grids are in memory once however many workers
+run. A worker that cannot see the file (e.g. a queue worker on another host) reads the grid as before.
+"""
+
+# Import core modules
+import sys
+import os
+import tempfile
+import collections
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import Numpy
+import numpy as np
+
+# Import GDAL et al.
+from osgeo import gdal
+
+import gmtools.geospatial as gm_geo
+
+import objectstore as hmt_store
+import dtypes as hmt_dtypes
+
+SHM_DIR = os.environ.get('HMT_SHM_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+# Extra grid cells published around the bounds, at least read_grid_window's halo
+HALO = 2
+
+# grid_path and band of the source, the float32 file holding the window, its size and its geotransform
+SharedGrid = collections.namedtuple('SharedGrid', ['grid_path', 'band', 'data_path', 'rows', 'cols', 'geotransform'])
+
+_registry = dict()  # (grid path, band) -> SharedGrid registered in this process
+_arrays = dict()  # data_path -> memmap of this process
+
+
+def _key(grid_path, band):
+  return (os.path.abspath(grid_path), band)
+
+
+def publish(grid_paths, bounds=None, band=1, directory=None, halo=HALO):
+  """
+  Load grids into shared files and register them in this process. bounds (minx, maxx, miny, maxy, in the grids'
+  CRS) limits each grid to the window that covers it plus halo cells. Returns the SharedGrids for release().
+  """
+  directory = directory or SHM_DIR
+  shared = list()
+  data_path = None
+  try:
+    for grid_n, grid_path in enumerate(grid_paths):
+      data_path = None
+      grid_fh = gdal.Open(grid_path, gdal.GA_ReadOnly)
+      grid_geo_t = gm_geo.GeoTransform.from_gdal(grid_fh)
+      grid_band = grid_fh.GetRasterBand(band)
+      grid_nodata = grid_band.GetNoDataValue()
+      window = gm_geo.Window(0, 0, grid_fh.RasterXSize, grid_fh.RasterYSize)
+      if bounds is not None:
+        window = grid_geo_t.window_for_bounds(*bounds).grown(halo).clipped(grid_fh.RasterXSize, grid_fh.RasterYSize)
+      if window.is_empty:
+        logger.warn("  {0} does not cover the quads, not sharing it".format(grid_path))
+        continue
+      
+      data_path = os.path.join(directory, "hmt_grid_{0}_{1}_{2}.f32".format(os.getpid(), grid_n, os.path.splitext(os.path.basename(grid_path))[0]))
+      array = np.memmap(data_path, dtype=np.float32, mode='w+', shape=(window.ysize, window.xsize))
+      for strip in gm_geo.copy_chunks(window.xsize, window.ysize, [grid_band.GetBlockSize()[1]], window.xsize*4):
+        target = array[strip.yoff:strip.yoff + strip.ysize]
+        if hmt_store.is_remote(grid_path):
+          target[...] = hmt_store.read_window(grid_path, band, window.xoff, window.yoff + strip.yoff, window.xsize, strip.ysize)
+        elif hmt_dtypes.read_dtype(grid_nodata) is not hmt_dtypes.SURFACE_DTYPE:
+          # numpy converts the nodata cells the way it converts np.float32(grid_nodata) below
+          target[...] = grid_band.ReadAsArray(window.xoff, window.yoff + strip.yoff, window.xsize, strip.ysize)
+        else:
+          grid_band.ReadAsArray(window.xoff, window.yoff + strip.yoff, window.xsize, strip.ysize, buf_obj=target)
+        if grid_nodata is not None:
+          target[target == np.float32(grid_nodata)] = np.nan
+      array.flush()
+      array = None
+      grid_band = None
+      grid_fh = None
+      
+      shared.append(SharedGrid(grid_path, band, data_path, window.ysize, window.xsize, grid_geo_t.window_transform(window)))
+      logger.info("  Shared {0} window {1} ({2:.0f} MB) at {3}".format(grid_path, window, window.xsize*window.ysize*4/(1024.0*1024.0), data_path))
+  except BaseException:
+    # Leave nothing behind in shared memory: the grids already published and the one being written
+    array = None
+    release(shared)
+    if data_path is not None and os.path.exists(data_path):
+      os.remove(data_path)
+    raise
+  register(shared)
+  return shared
+
+
+def size_mb(shared_grids):
+  """ MB of memory the files of these SharedGrids take (tmpfs files are memory, not disk) """
+  return sum(shared_grid.rows*shared_grid.cols*4 for shared_grid in shared_grids or ())/(1024.0*1024.0)
+
+
+def register(shared_grids):
+  """ Serve these SharedGrids to read_grid_window in this process """
+  for shared_grid in shared_grids or ():
+    _registry[_key(shared_grid.grid_path, shared_grid.band)] = shared_grid
+
+
+def lookup(grid_path, band=1):
+  """ (read-only float32 array, GeoTransform) of a registered grid, or None when it is not shared here """
+  shared_grid = _registry.get(_key(grid_path, band))
+  if shared_grid is None or not os.path.exists(shared_grid.data_path):
+    return None
+  array = _arrays.get(shared_grid.data_path)
+  if array is None:
+    array = _arrays[shared_grid.data_path] = np.memmap(shared_grid.data_path, dtype=np.float32, mode='r', shape=(shared_grid.rows, shared_grid.cols))
+  return array, shared_grid.geotransform
+
+
+def release(shared_grids):
+  """ Unregister SharedGrids and delete their files (the workers' mappings stay valid until they exit) """
+  for shared_grid in shared_grids or ():
+    _registry.pop(_key(shared_grid.grid_path, shared_grid.band), None)
+    _arrays.pop(shared_grid.data_path, None)
+    if os.path.exists(shared_grid.data_path):
+      os.remove(shared_grid.data_path)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Opt-in timeline tracing of the block loops, in Chrome trace-event format (chrome://tracing, Perfetto).
+
+Tracing is off unless enable() is called or the HMT_TRACE environment variable names an events file. When it is
+off, block_spans() and span() return a shared object whose methods do nothing, so the block loops pay one
+function call per lap. When it is on, each process buffers complete ("X") events tagged with the current quad,
+stage and worker and appends them to the events file (one JSON event per line) on flush(); write_chrome_trace()
+turns that file into a trace the viewers load. Gaps between a block's spans are time spent outside the loop
+body, e.g. waiting on a lock.
+
+  lap = hmt_trace.block_spans(j, i)
+  lidar_np = band.ReadAsArray(j, i, numCols, numRows)
+  lap('read')
+  ...
+  lap('compute')
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import json
+import atexit
+import threading
+import contextlib
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Events are flushed to the events file when this many are buffered
+FLUSH_EVENTS = 10000
+
+_state = {'path': None, 'events': list(), 'context': dict(), 'pid': os.getpid()}
+_lock = threading.Lock()
+
+
+def now_us():
+  """ Wall clock in microseconds; shared by all processes on a node so their timelines line up """
+  return time.time()*1e6
+
+
+def enable(events_path):
+  """ Start tracing to events_path (also exported as HMT_TRACE so worker processes pick it up) """
+  _state['path'] = events_path
+  os.environ['HMT_TRACE'] = events_path
+  return events_path
+
+
+def disable():
+  """ Flush and stop tracing """
+  flush()
+  _state['path'] = None
+  os.environ.pop('HMT_TRACE', None)
+
+
+def enabled():
+  return _state['path'] is not None
+
+
+def set_context(**context):
+  """ Tag the events recorded from now on in this process (quad=..., stage=...); None removes a tag """
+  for key, value in context.items():
+    if value is None: _state['context'].pop(key, None)
+    else: _state['context'][key] = value
+
+
+def record(name, start_us, end_us, category='block', **args):
+  """ Buffer one complete event """
+  args.update(_state['context'])
+  args['worker'] = multiprocessing.current_process().name
+  if _state.get('pid') != os.getpid():
+    _state['pid'] = os.getpid()
+    _state['events'] = list()  # a forked worker does not inherit the parent's buffer
+  event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start_us, 'dur': end_us - start_us,
+           'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args}
+  with _lock:
+    _state['events'].append(event)
+    full = len(_state['events']) >= FLUSH_EVENTS
+  if full: flush()
+
+
+def flush():
+  """ Append the buffered events of this process to the events file """
+  with _lock:
+    events, _state['events'] = _state['events'], list()
+  if not events or _state['path'] is None:
+    return
+  events_fh = open(_state['path'], 'a')
+  try:
+    events_fh.write(''.join(json.dumps(event) + "\n" for event in events))
+  finally:
+    events_fh.close()
+
+
+class _NullTrace(object):
+  """ What span() and block_spans() return when tracing is off """
+
+  def __call__(self, name):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+_NULL_TRACE = _NullTrace()
+
+
+class _BlockSpans(object):
+  """ Consecutive spans of one block: each call closes the span that began at the previous call """
+
+  def __init__(self, args):
+    self.args = args
+    self.start = now_us()
+
+  def __call__(self, name):
+    end = now_us()
+    record(name, self.start, end, **self.args)
+    self.start = end
+
+
+def block_spans(j, i, **args):
+  """ Lap recorder for the block at pixel offset (j, i); call it with the name of each part as it finishes """
+  if _state['path'] is None:
+    return _NULL_TRACE
+  args.update(j=j, i=i)
+  return _BlockSpans(args)
+
+
+@contextlib.contextmanager
+def _span(name, category, args):
+  start = now_us()
+  try:
+    yield
+  finally:
+    record(name, start, now_us(), category=category, **args)
+
+
+def span(name, category='stage', **args):
+  """ Context manager recording its body as one event """
+  if _state['path'] is None:
+    return _NULL_TRACE
+  return _span(name, category, args)
+
+
+def write_chrome_trace(events_path, trace_path):
+  """ Convert an events file into a Chrome trace-event JSON file; returns trace_path """
+  with open(events_path) as events_fh:
+    events = [json.loads(line) for line in events_fh if line.strip()]
+  # Name each process after its worker so the viewer's rows read "PoolWorker-3" rather than a pid
+  workers = dict()
+  for event in events:
+    workers.setdefault(event['pid'], event['args'].get('worker'))
+  metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': "{0} ({1})".format(worker, pid)}} for pid, worker in workers.items()]
+  with open(trace_path, 'w') as trace_fh:
+    json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, trace_fh)
+  logger.info("  Wrote {0} trace events to {1}".format(len(events), trace_path))
+  return trace_path
+
+
+if os.environ.get('HMT_TRACE'):
+  _state['path'] = os.environ['HMT_TRACE']
+atexit.register(flush)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Durable SQLite work queue for running quad jobs on several hosts that share a filesystem.
+
+submit() writes the jobs of a named queue (the importable function, its pickled arguments, a priority and a
+key unique within the queue) to an SQLite file. Any number of worker processes, on any host that can reach the
+file, run work(): claim() hands the highest priority pending job to one worker under a lease, a heartbeat thread
+extends the lease while the job runs, and the result (or the error) is recorded when it finishes. A job whose
+lease runs out (its worker died or lost the filesystem) goes back to pending and is retried by another worker,
+up to max_attempts. Commits are fenced by attempt: complete() and fail() only succeed for the worker and attempt
+that hold the lease, so a worker that outlived its lease cannot overwrite the result of the retry, and
+re-submitting a key that already exists leaves the job (and a finished result) as it is.
+
+Outputs are fenced the same way. A running job finds its JobContext with current_job(), writes its outputs under
+names tagged with the attempt (JobContext.tag), calls check_lease() before its final writes and registers the
+renames into place with on_commit(). complete() runs them inside its write transaction, only when the attempt
+still holds the lease, so two attempts never write the same files and only the attempt whose result is recorded
+publishes its outputs.
+
+SQLite file locking has to work on the shared filesystem (local disks and NFS with working locks do; the WAL
+journal is not used because it does not work across hosts).
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import socket
+import pickle
+import sqlite3
+import importlib
+import threading
+import traceback
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Default queue file; set HMT_QUEUE to a path every host can reach
+QUEUE_PATH = os.environ.get('HMT_QUEUE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'hmt_queue.sqlite'))
+
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+POLL_SECONDS = 1.0
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+SCHEMA = [
+  """
+  CREATE TABLE IF NOT EXISTS queues (
+    name TEXT PRIMARY KEY,
+    initializer TEXT,
+    initargs BLOB,
+    created_at REAL
+  )
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    key TEXT NOT NULL,
+    function TEXT NOT NULL,
+    args BLOB NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    lease_expires REAL,
+    heartbeat_at REAL,
+    result BLOB,
+    error TEXT,
+    submitted_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    UNIQUE (queue, key)
+  )
+  """,
+  "CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority)",
+]
+
+
+def worker_name():
+  """ host:pid of this process """
+  return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+def function_name(function):
+  """ 'module:name' of a module level function, importable by a worker on another host """
+  module = function.__module__
+  if module == '__main__':
+    # A script's functions are imported by the workers under the script's module name
+    module = os.path.splitext(os.path.basename(sys.modules['__main__'].__file__))[0]
+  return "{0}:{1}".format(module, function.__name__)
+
+
+def resolve_function(name):
+  """ The function of a function_name() """
+  module, function = name.split(':')
+  return getattr(importlib.import_module(module), function)
+
+
+def _dumps(value):
+  return sqlite3.Binary(pickle.dumps(value, 2))
+
+
+def _loads(blob):
+  return pickle.loads(bytes(blob))
+
+
+class JobFailed(Exception):
+  """ A job of the queue failed on every attempt """
+
+
+class LeaseLost(Exception):
+  """ The running attempt of a job no longer holds its lease; a retry owns the job """
+
+
+class WorkQueue(object):
+  """ A connection to a queue file """
+
+  def __init__(self, path=None, timeout=60):
+    self.path = path or QUEUE_PATH
+    if os.path.dirname(self.path) and not os.path.exists(os.path.dirname(self.path)):
+      os.makedirs(os.path.dirname(self.path))
+    self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)  # transactions are explicit
+    self.connection.row_factory = sqlite3.Row
+    self._write(lambda: [self.connection.execute(statement) for statement in SCHEMA])
+
+  def close(self):
+    self.connection.close()
+
+  def _write(self, function):
+    """ Run function inside a write transaction (BEGIN IMMEDIATE takes the write lock up front) """
+    self.connection.execute("BEGIN IMMEDIATE")
+    try:
+      result = function()
+    except Exception:
+      self.connection.execute("ROLLBACK")
+      raise
+    self.connection.execute("COMMIT")
+    return result
+
+  def submit(self, queue, function, jobs, keys=None, priorities=None, max_attempts=3, initializer=None, initargs=()):
+    """
+    Add the jobs (args tuples for function) to a queue and return their ids in order. keys default to the job
+    numbers; a key already in the queue keeps its job. initializer(*initargs) is run by each worker before its
+    first job of this queue.
+    """
+    jobs = list(jobs)
+    keys = [str(key) for key in (keys or range(len(jobs)))]
+    priorities = priorities or [0]*len(jobs)
+    now = time.time()
+    def insert():
+      self.connection.execute("INSERT OR IGNORE INTO queues (name, initializer, initargs, created_at) VALUES (?, ?, ?, ?)",
+                              (queue, function_name(initializer) if initializer is not None else None, _dumps(tuple(initargs)), now))
+      self.connection.executemany("INSERT OR IGNORE INTO jobs (queue, key, function, args, priority, max_attempts, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(queue, key, function_name(function), _dumps(tuple(args)), priority, max_attempts, now)
+                                   for key, args, priority in zip(keys, jobs, priorities)])
+      return [self.connection.execute("SELECT id FROM jobs WHERE queue = ? AND key = ?", (queue, key)).fetchone()[0] for key in keys]
+    return self._write(insert)
+
+  def _expire_leases(self, now):
+    """ Put running jobs whose lease ran out back to pending, or fail them after max_attempts (inside a transaction) """
+    for row in self.connection.execute("SELECT id, attempts, max_attempts, worker FROM jobs WHERE status = ? AND lease_expires < ?", (RUNNING, now)).fetchall():
+      logger.warn("  Lease of job {0} held by {1} expired (attempt {2} of {3})".format(row['id'], row['worker'], row['attempts'], row['max_attempts']))
+      if row['attempts'] >= row['max_attempts']:
+        self.connection.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                                (FAILED, "lease expired on attempt {0} ({1})".format(row['attempts'], row['worker']), now, row['id']))
+      else:
+        self.connection.execute("UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL WHERE id = ?", (PENDING, row['id']))
+
+  def claim(self, worker, queues=None, lease_seconds=LEASE_SECONDS):
+    """
+    Lease the highest priority pending job (of queues, any queue by default) to worker. Returns a dict with id,
+    queue, attempt, function, args, initializer and initargs, or None when there is nothing to do.
+    """
+    def take():
+      now = time.time()
+      self._expire_leases(now)
+      query = "SELECT * FROM jobs WHERE status = ?"
+      params = [PENDING]
+      if queues:
+        query += " AND queue IN ({0})".format(', '.join('?'*len(queues)))
+        params += list(queues)
+      row = self.connection.execute(query + " ORDER BY priority DESC, id LIMIT 1", params).fetchone()
+      if row is None:
+        return None
+      self.connection.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, lease_expires = ?, heartbeat_at = ?, started_at = ? WHERE id = ?",
+                              (RUNNING, worker, now + lease_seconds, now, now, row['id']))
+      setup = self.connection.execute("SELECT initializer, initargs FROM queues WHERE name = ?", (row['queue'],)).fetchone()
+      return {'id': row['id'], 'queue': row['queue'], 'key': row['key'], 'attempt': row['attempts'] + 1, 'function': row['function'], 'args': _loads(row['args']),
+              'initializer': setup['initializer'] if setup else None, 'initargs': _loads(setup['initargs']) if setup else ()}
+    return self._write(take)
+
+  def heartbeat(self, job_id, worker, attempt, lease_seconds=LEASE_SECONDS):
+    """ Extend the lease of a job; False when worker no longer holds it """
+    def beat():
+      now = time.time()
+      return self.connection.execute("UPDATE jobs SET lease_expires = ?, heartbeat_at = ? WHERE id = ? AND status = ? AND worker = ? AND attempts = ?",
+                                     (now + lease_seconds, now, job_id, RUNNING, worker, attempt)).rowcount == 1
+    return self._write(beat)
+
+  def complete(self, job_id, worker, attempt, result, on_commit=()):
+    """
+    Record the result of a job; False (and nothing recorded) when worker no longer holds its lease. The on_commit
+    callables (e.g. renaming outputs into place) run inside the transaction once the attempt is known to hold the
+    lease; if one raises, nothing is recorded and the exception propagates.
+    """
+    def commit():
+      if self.connection.execute("UPDATE jobs SET status = ?, result = ?, error = NULL, lease_expires = NULL, finished_at = ? WHERE id = ? AND status = ? AND worker = ? AND attempts = ?",
+                                 (DONE, _dumps(result), time.time(), job_id, RUNNING, worker, attempt)).rowcount != 1:
+        return False
+      for callback in on_commit:
+        callback()
+      return True
+    return self._write(commit)
+
+  def fail(self, job_id, worker, attempt, error):
+    """ Record a failed attempt: back to pending while attempts remain, else failed. False if the lease was lost. """
+    def commit():
+      row = self.connection.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND status = ? AND worker = ? AND attempts = ?",
+                                    (job_id, RUNNING, worker, attempt)).fetchone()
+      if row is None:
+        return False
+      status = FAILED if row['attempts'] >= row['max_attempts'] else PENDING
+      self.connection.execute("UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_expires = NULL, finished_at = ? WHERE id = ?",
+                              (status, error, time.time() if status == FAILED else None, job_id))
+      return True
+    return self._write(commit)
+
+  def cancel(self, queue):
+    """ Cancel the pending jobs of a queue """
+    return self._write(lambda: self.connection.execute("UPDATE jobs SET status = ? WHERE queue = ? AND status = ?", (CANCELLED, queue, PENDING)).rowcount)
+
+  def jobs(self, job_ids):
+    """ id -> (status, result, error) of jobs """
+    self._write(lambda: self._expire_leases(time.time()))
+    rows = self.connection.execute("SELECT id, status, result, error FROM jobs WHERE id IN ({0})".format(', '.join('?'*len(job_ids))), list(job_ids)).fetchall()
+    return dict((row['id'], (row['status'], _loads(row['result']) if row['result'] is not None else None, row['error'])) for row in rows)
+
+  def counts(self, queue=None):
+    """ status -> number of jobs (of one queue, or all) """
+    if queue is None:
+      rows = self.connection.execute("SELECT status, count(*) FROM jobs GROUP BY status")
+    else:
+      rows = self.connection.execute("SELECT status, count(*) FROM jobs WHERE queue = ? GROUP BY status", (queue,))
+    return dict((row[0], row[1]) for row in rows)
+
+  def idle(self, queues=None):
+    """ True when the queues (every queue by default) have no pending or running jobs """
+    query = "SELECT count(*) FROM jobs WHERE status IN (?, ?)"
+    params = [PENDING, RUNNING]
+    if queues:
+      query += " AND queue IN ({0})".format(', '.join('?'*len(queues)))
+      params += list(queues)
+    return self.connection.execute(query, params).fetchone()[0] == 0
+
+  def wait(self, job_ids, on_done=None, poll_seconds=POLL_SECONDS):
+    """
+    Wait for the jobs and return their results in order; on_done(n, result) is called as the n-th job finishes.
+    Raises JobFailed as soon as one of them has failed on every attempt.
+    """
+    job_ids = list(job_ids)
+    reported = set()
+    while True:
+      states = self.jobs(job_ids)
+      for job_n, job_id in enumerate(job_ids):
+        status, result, error = states[job_id]
+        if status in (FAILED, CANCELLED):
+          raise JobFailed("Job {0} {1}: {2}".format(job_id, status, error))
+        if status == DONE and job_n not in reported:
+          reported.add(job_n)
+          if on_done is not None: on_done(job_n, result)
+      if len(reported) == len(job_ids):
+        return [states[job_id][1] for job_id in job_ids]
+      time.sleep(poll_seconds)
+
+
+class Heartbeat(threading.Thread):
+  """ Extends the lease of a running job every heartbeat_seconds, on its own connection """
+
+  def __init__(self, path, job_id, worker, attempt, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.path = path
+    self.job_id = job_id
+    self.worker = worker
+    self.attempt = attempt
+    self.lease_seconds = lease_seconds
+    self.heartbeat_seconds = heartbeat_seconds
+    self.stopped = threading.Event()
+    self.lost = threading.Event()  # set once a heartbeat found the lease taken over
+
+  def run(self):
+    queue = WorkQueue(self.path)
+    try:
+      while not self.stopped.wait(self.heartbeat_seconds):
+        if not queue.heartbeat(self.job_id, self.worker, self.attempt, self.lease_seconds):
+          logger.warn("  Lost the lease of job {0}".format(self.job_id))
+          self.lost.set()
+          return
+    finally:
+      queue.close()
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+
+
+class JobContext(object):
+  """ The attempt of a job running in this process, see current_job() """
+
+  def __init__(self, path, job_id, worker, attempt, lease_seconds=LEASE_SECONDS, heartbeat=None):
+    self.path = path
+    self.job_id = job_id
+    self.worker = worker
+    self.attempt = attempt
+    self.lease_seconds = lease_seconds
+    self.heartbeat = heartbeat
+    self.callbacks = list()
+
+  @property
+  def tag(self):
+    """ Name suffix of the outputs of this attempt, unique across attempts of every job """
+    return "job{0}a{1}".format(self.job_id, self.attempt)
+
+  def check_lease(self):
+    """ Extend the lease, or raise LeaseLost when another attempt owns the job (call before the final writes) """
+    if self.heartbeat is not None and self.heartbeat.lost.is_set():
+      raise LeaseLost("job {0} attempt {1}".format(self.job_id, self.attempt))
+    queue = WorkQueue(self.path)
+    try:
+      if not queue.heartbeat(self.job_id, self.worker, self.attempt, self.lease_seconds):
+        raise LeaseLost("job {0} attempt {1}".format(self.job_id, self.attempt))
+    finally:
+      queue.close()
+
+  def on_commit(self, function, *args):
+    """ Call function(*args) when complete() records this attempt's result, and only then """
+    self.callbacks.append(lambda: function(*args))
+
+
+_current = threading.local()
+
+
+def current_job():
+  """ The JobContext of the queue job running in this thread, None outside work() """
+  return getattr(_current, 'job', None)
+
+
+def work(path=None, queues=None, worker=None, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, exit_when_idle=True, poll_seconds=POLL_SECONDS, max_jobs=None):
+  """
+  Worker loop: claim a job, run it while a heartbeat keeps its lease, record the result or error, repeat.
+  Returns the number of jobs run once the queues have no pending or running jobs left (exit_when_idle) or after
+  max_jobs; otherwise polls forever.
+  """
+  queue = WorkQueue(path)
+  worker = worker or worker_name()
+  initialized = set()
+  jobs_run = 0
+  logger.info("Worker {0} polling {1}".format(worker, queue.path))
+  try:
+    while max_jobs is None or jobs_run < max_jobs:
+      job = queue.claim(worker, queues=queues, lease_seconds=lease_seconds)
+      if job is None:
+        if exit_when_idle and queue.idle(queues):
+          break
+        time.sleep(poll_seconds)
+        continue
+      
+      logger.info("Worker {0} running job {1} ({2} {3}, attempt {4})".format(worker, job['id'], job['queue'], job['key'], job['attempt']))
+      heartbeat = Heartbeat(queue.path, job['id'], worker, job['attempt'], lease_seconds, heartbeat_seconds)
+      heartbeat.start()
+      _current.job = context = JobContext(queue.path, job['id'], worker, job['attempt'], lease_seconds, heartbeat)
+      try:
+        if job['initializer'] is not None and job['queue'] not in initialized:
+          resolve_function(job['initializer'])(*job['initargs'])
+          initialized.add(job['queue'])
+        result = resolve_function(job['function'])(*job['args'])
+      except LeaseLost:
+        heartbeat.stop()
+        logger.warn("Job {0} attempt {1} stopped after its lease was lost; the retry owns it".format(job['id'], job['attempt']))
+      except Exception:
+        heartbeat.stop()
+        error = traceback.format_exc()
+        logger.error("Job {0} failed on attempt {1}:\n{2}".format(job['id'], job['attempt'], error))
+        queue.fail(job['id'], worker, job['attempt'], error)
+      else:
+        heartbeat.stop()
+        try:
+          if not queue.complete(job['id'], worker, job['attempt'], result, on_commit=context.callbacks):
+            logger.warn("Job {0} finished after its lease was lost; the result of the retry stands".format(job['id']))
+        except Exception:
+          error = traceback.format_exc()
+          logger.error("Job {0} could not publish its outputs on attempt {1}:\n{2}".format(job['id'], job['attempt'], error))
+          queue.fail(job['id'], worker, job['attempt'], error)
+      finally:
+        _current.job = None
+      jobs_run += 1
+  finally:
+    queue.close()
+  return jobs_run
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Pull quad jobs from the shared SQLite work queue (see hmt_processor/workqueue.py) and run them. Start it on any
+host that mounts the project directory while a run uses backend='queue', as many processes per host as it has
+memory and cores for:
+
+  HMT_QUEUE=/shared/hmt/logs/hmt_queue.sqlite python hmt_worker.py
+  python hmt_worker.py --queue /shared/hmt/logs/hmt_queue.sqlite --wait
+  python hmt_worker.py --status
+"""
+
+# Import core modules
+import sys
+import os
+import argparse
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import HMT specific packages
+from hmt_processor import workqueue as hmt_workqueue
+from hmt_processor import runtime as hmt_runtime
+
+# get a reference to the path that holds this file
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Log file of the workers
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'hmt_worker.log')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Run jobs from the HMT work queue.")
+  parser.add_argument('--queue', default=None, help="queue file (default HMT_QUEUE or logs/hmt_queue.sqlite)")
+  parser.add_argument('--queues', nargs='*', default=None, help="only take jobs of these queues (runs)")
+  parser.add_argument('--lease', type=float, default=hmt_workqueue.LEASE_SECONDS, help="seconds a job is leased for between heartbeats")
+  parser.add_argument('--heartbeat', type=float, default=hmt_workqueue.HEARTBEAT_SECONDS, help="seconds between heartbeats")
+  parser.add_argument('--wait', action='store_true', help="keep polling when the queue is empty instead of exiting")
+  parser.add_argument('--status', action='store_true', help="print the number of jobs by status and exit")
+  args = parser.parse_args(argv)
+  
+  if args.status:
+    queue = hmt_workqueue.WorkQueue(args.queue)
+    for status, count in sorted(queue.counts().items()):
+      print("{0:<10} {1:>6}".format(status, count))
+    queue.close()
+    return 0
+  
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
+  sys.path.insert(0, PROJECT_DIR)  # jobs of the top level scripts (process_tiles.py) are imported from here
+  jobs_run = hmt_workqueue.work(args.queue, queues=args.queues, lease_seconds=args.lease, heartbeat_seconds=args.heartbeat, exit_when_idle=not args.wait)
+  logger.info("Worker ran {0} jobs".format(jobs_run))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+
+Convert the raw ArcInfo grid quads of a LIDAR data block to tiled, compressed GeoTIFFs (data/LIDAR/<block>/ingested)
+with overviews and block indexes. process_tiles.py reads the ingested copies automatically. Run once per block,
+or again after raw quads change (up to date quads are skipped):
+
+  python ingest_lidar.py SSNERR_LIDAR --workers 4
+"""
+
+# Import core modules
+import sys
+import os
+import argparse
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import HMT specific packages
+from hmt_processor import ingest as hmt_ingest
+from hmt_processor import runtime as hmt_runtime
+from hmt_processor import memory as hmt_memory
+from hmt_processor import autotune as hmt_autotune
+import process_tiles
+
+# get a reference to the path that holds this file
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Log file of the ingest
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'ingest_lidar.log')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Ingest raw LIDAR quads as tiled, compressed GeoTIFFs.")
+  parser.add_argument('data_blocks', nargs='+', help="LIDAR data blocks, e.g. SSNERR_LIDAR")
+  parser.add_argument('--quads', nargs='*', default=None, help="quads to ingest (default every quad in raw/)")
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--cog', action='store_true', help="write Cloud Optimized GeoTIFFs (GDAL >= 3.1)")
+  parser.add_argument('--index-blocksize', type=int, default=None, help="block size of the block indexes (default the block size of a parallel process_tiles run)")
+  parser.add_argument('--force', action='store_true', help="ingest quads that are already up to date")
+  parser.add_argument('--data-dir', default=None, help="data directory (default PROJECT_DIR/data)")
+  args = parser.parse_args(argv)
+  
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
+  lidar_dir = process_tiles.data_paths(args.data_dir)[0]
+  if args.index_blocksize is None:
+    index_blocksize = hmt_memory.MemoryBudget().plan(multiprocessing.cpu_count(), profile=hmt_autotune.load_profile()).blocksize
+  else:
+    index_blocksize = (args.index_blocksize, args.index_blocksize)
+  for data_block in args.data_blocks:
+    hmt_ingest.ingest_block(lidar_dir, data_block, quads=args.quads, workers=args.workers, cog=args.cog,
+                            index_blocksize=index_blocksize, force=args.force)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Run the HMT pipeline for an area of interest only: the quads whose footprint intersects the AOI (found through the
+quad catalog's R-tree) are processed, each clipped to the window covering its part of the AOI, and the below HMT
+areas inside the AOI are tabulated. The AOI is a bounding box in the CRS of the quads (EPSG:2992) or a polygon file:
+
+  python process_aoi.py 1350000,340000,1356000,345000 --name netarts_site --blocks Till_LIDAR
+  python process_aoi.py sites/salmon_river.shp --workers 4
+"""
+
+# Import core modules
+import sys
+import os
+import argparse
+import multiprocessing
+
+# Import and configure logging
+import logging
+logger = logging.getLogger('hmt_processor')
+
+# Import HMT specific packages
+from hmt_processor import aoi as hmt_aoi
+from hmt_processor import catalog as hmt_catalog
+from hmt_processor import runtime as hmt_runtime
+import process_tiles
+import tabulate_areas
+
+# get a reference to the path that holds this file
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Log file of the AOI runs
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'process_aoi.log')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Process and tabulate the HMT areas of an area of interest.")
+  parser.add_argument('aoi', help="'minx,miny,maxx,maxy' in the CRS of the quads, or a polygon file")
+  parser.add_argument('--name', default=None, help="name of the AOI, added to the output names (default the file name, or 'aoi')")
+  parser.add_argument('--blocks', nargs='*', default=None, help="LIDAR data blocks to search (default every catalogued block)")
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--project-dir', default=PROJECT_DIR, help="reads <project dir>/data and writes <project dir>/output (default this folder)")
+  args = parser.parse_args(argv)
+  
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
+  aoi = hmt_aoi.parse(args.aoi, name=args.name)
+  data_dir = os.path.join(args.project_dir, 'data')
+  lidar_dir = process_tiles.data_paths(data_dir)[0]
+  catalog = hmt_catalog.open_catalog(lidar_dir, blocks=args.blocks, workers=args.workers)
+  blocks = sorted(set(entry['block'] for entry in aoi.select(catalog, blocks=args.blocks)))
+  catalog.close()
+  if not blocks:
+    logger.warn("No catalogued quad intersects AOI {0}".format(aoi.name))
+    return 1
+  
+  for block in blocks:
+    name = "{0}_{1}".format(aoi.name, block)
+    process_tiles.data_processor(name, block, parallel=args.workers > 1, workers=args.workers, data_dir=data_dir, aoi=aoi)
+    tabulate_areas.data_area_tabulator(name, "{0}_areas.csv".format(name), block, project_dir=args.project_dir, aoi=aoi)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
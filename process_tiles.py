@@ -23,23 +23,14 @@ IN THE SOFTWARE.
 import sys
 import os
 import pprint
+import time
+import math
+import multiprocessing
+import glob
 
 # Import and configure logging
 import logging
 logger = logging.getLogger('hmt_processor')
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-fhnd = logging.FileHandler('logs/hmt_processor.log')
-fhnd.setLevel(logging.DEBUG)
-fhnd.setFormatter(formatter)
-logger.addHandler(fhnd)
-
-# Import Parallel Python
-import pp
 
 # Import Numpy
 import numpy as np
@@ -49,25 +40,31 @@ from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 
-# Import Geomatics Research helpers
-from gmtools import filesystem as gm_fs
-
 # Import HMT specific packages
 from hmt_processor import processors as hmt
 from hmt_processor import hmt_gdal
-
-# Fix osgeo error reporting
-gdal.UseExceptions()
-ogr.UseExceptions()
-osr.UseExceptions()
-
-# Set gdal configuration parameters
-gdal.SetCacheMax(2147483648)  # 2 GB. This sets the caching max size for gdal. Bigger number can lead to faster reads / writes
-gdal.SetConfigOption('HFA_USE_RRD', 'YES')  # Configure GDAL to use blocks
+from hmt_processor import block_index as hmt_blocks
+from hmt_processor import metrics as hmt_metrics
+from hmt_processor import scheduler as hmt_scheduler
+from hmt_processor import memory as hmt_memory
+from hmt_processor import tracing as hmt_trace
+from hmt_processor import runtime as hmt_runtime
+from hmt_processor import autotune as hmt_autotune
+from hmt_processor import costmodel as hmt_costs
+from hmt_processor import ingest as hmt_ingest
+from hmt_processor import formats as hmt_formats
+from hmt_processor import catalog as hmt_catalog
+from hmt_processor import aoi as hmt_aoi
+from hmt_processor import sharedgrids as hmt_shared
+from hmt_processor import objectstore as hmt_store
+from hmt_processor import workqueue as hmt_workqueue
 
 # get a reference to the path that holds this file
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Data directory of the __main__ runs, a local path or an s3:// URI (PROJECT_DIR/data when not set)
+DATA_DIR = os.environ.get('HMT_DATA_DIR')
+
 # Path to the LIDAR datasets
 LIDAR_DIR = os.path.join(PROJECT_DIR, 'data', 'LIDAR')
 
@@ -77,99 +74,145 @@ TIDALDATUMS_DIR = os.path.join(PROJECT_DIR, 'data', 'tidal_datums')
 # Path to the Tidal Incriment datasets
 TIDALINCRIMENT_DIR = os.path.join(PROJECT_DIR, 'data', 'hmt_incriment')
 
+# Log file of the processor
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'hmt_processor.log')
+
+# Stage metrics of every run (JSON lines, see hmt_processor.metrics)
+METRICS_PATH = os.path.join(PROJECT_DIR, 'logs', 'hmt_metrics.jsonl')
+
+# Live progress of the current run (see hmt_processor.costmodel)
+STATUS_PATH = os.path.join(PROJECT_DIR, 'logs', 'status.json')
+
 # File folders that break up LIDAR tiles
 SITE_BLOCKS = ['Neh_LIDAR', 'SSNERR_LIDAR', 'Till_LIDAR']
 
 
-def tile_job(raw_quad_path, hmt_value, processed_quad_path):
-  pass
+def data_paths(data_dir=None):
+  """
+  (LIDAR, tidal datum, HMT incriment) directories under data_dir, PROJECT_DIR/data by default. data_dir may be
+  an s3:// URI; the directories are then GDAL /vsis3/ paths (see hmt_processor.objectstore).
+  """
+  if data_dir is None:
+    return (LIDAR_DIR, TIDALDATUMS_DIR, TIDALINCRIMENT_DIR)
+  data_dir = hmt_store.vsi_path(data_dir)
+  return (os.path.join(data_dir, 'LIDAR'), os.path.join(data_dir, 'tidal_datums'), os.path.join(data_dir, 'hmt_incriment'))
+
+def source_grid_paths(data_dir=None):
+  """ The statewide TSS, MHHW, HMT increment (MHHW) and HMT increment (NAVD88) grids every quad samples """
+  lidar_dir, tidaldatums_dir, tidalincriment_dir = data_paths(data_dir)
+  return (hmt_formats.find_raster(tidaldatums_dir, "tss_merged_epsg2992_filled_invdist"),  # TSS source grid
+          hmt_formats.find_raster(tidaldatums_dir, "mhhw_merged_epsg2992_filled_invdist"),  # MHHW source grid
+          os.path.join(tidalincriment_dir, 'dlcd_hmt_mhhw_invdist.img'),
+          os.path.join(tidalincriment_dir, 'dlcd_hmt_mhhw_nearest.img'))
 
-def data_processor(name, data_block, lidar_quads, small=False, parallel=False):
-  """ Process data for the estuary """
+
+def rename_shapefile(path, new_path):
+  """ Rename a shapefile and its sidecars, replacing any shapefile at new_path """
+  if os.path.exists(new_path): ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(new_path)
+  for filename in glob.glob(os.path.splitext(path)[0] + '.*'):
+    os.rename(filename, os.path.splitext(new_path)[0] + os.path.splitext(filename)[1])
+  return new_path
+
+
+def remove_attempt_outputs(directories, stem, job_id):
+  """ Delete what earlier attempts of a queue job left under their attempt names (<stem>_job<id>a<attempt>) """
+  for directory in directories:
+    for filename in glob.glob(os.path.join(directory, "{0}_job{1}a*".format(stem, job_id))):
+      if os.path.isfile(filename): os.remove(filename)
+
+
+def quad_processor(data_block, quad, data_dir=None, same_crs_fast_path=True, metrics_path=None, run=None, plan=None, window=None, tag=None):
+  """
+  Run the processing chain for one quad of a data block. plan (a hmt_processor.memory.MemoryPlan, for one
+  worker by default) sets the block size and warp memory.
   
-  logger.info("Welcome to the {0} data processor!".format(name))
+  window (a gmtools.geospatial.Window of the quad, see hmt_processor.aoi) limits every stage to those cells; tag
+  is added to the names of the outputs (<quad>_<tag>) so they do not replace the outputs of the whole quad.
   
-  # Limit the number of tiles to two if we don't want to do the full run
-  if small is True:
-    lidar_quads = lidar_quads[0:1]
-    logger.warn("Restricting lidar quads to the first item in list")
+  Run as a job of the work queue (backend='queue'), the quad's outputs are written under names tagged with the
+  attempt and renamed into place only when the queue records this attempt's result, so an attempt that lost its
+  lease never touches the files of the retry.
   
-  # Lists to holds filepaths
-  lidar_paths_full = list()
-  output_quads = list()
-  output_shps = list()
-  if parallel is True:
-    # Set up the parallel python server
-    ppserver = pp.Server(secret="TheEagleHasLanded")
-    ppserver.set_ncpus(1)  # Set the number of CPUs to 1, comment out to autodetect
-    logger.info("Using {0} CPUs".format(ppserver.get_ncpus()))
-    logger.info("Active PP nodes: {0}".format(ppserver.get_active_nodes()))
+  Returns a dict with the quad, its output shapefiles and the metrics record of each stage (see
+  hmt_processor.metrics), which are also appended to metrics_path when it is set.
+  """
+  logger.info("Working on quad: {0}".format(quad))
+  lidar_dir, tidaldatums_dir, tidalincriment_dir = data_paths(data_dir)
+  timer = hmt_metrics.StageTimer(quad=quad, log_path=metrics_path, run=run)
+  if plan is None: plan = hmt_memory.MemoryBudget().plan(1)
+  blocksize = plan.blocksize
   
-    ppjobs = list()
-    for quad in lidar_quads:
-      job = ppserver.submit(test_job, (quad,))
-      ppjobs.append((quad, job))
-    # Done adding jobs
-    
-    # wait for jobs to complete
-    ppserver.wait()  
-    
-    # Print out the stats from parallel python
-    logger.info("Parallel Python Stats")
-    job_stats = ppserver.get_stats()  # get stats as dict
-    for src in job_stats.keys():
-      logger.info("  {0} - {1}: {2}".format(src, 'ncpus', job_stats[src].ncpus))
-      logger.info("  {0} - {1}: {2}".format(src, 'njobs', job_stats[src].njobs))
-      logger.info("  {0} - {1}: {2}".format(src, 'rworker', job_stats[src].rworker))
-      logger.info("  {0} - {1}: {2}".format(src, 'time', job_stats[src].time))
-    
-    # Get results from the job
-    for quad, jobresult in ppjobs:
-      output = jobresult()
-      print output
+  # Filepaths for rasters
+  raw_quad_path = os.path.join(lidar_dir, data_block, 'raw', quad)  # This holds the full path to the LIDAR dataset
+  assert(hmt_store.exists(raw_quad_path)), "The path for quad {0} does not exist!:\r\n  {1}".format(quad, raw_quad_path)  # Test to make sure quad_path exists
+  raw_quad_path = hmt_ingest.source_path(raw_quad_path)  # Read the tiled GeoTIFF from ingest_lidar.py when there is one
+  stem = quad if tag is None else "{0}_{1}".format(quad, tag)  # Name of the outputs
+  job = hmt_workqueue.current_job()  # a queue job writes under names of its attempt and publishes them on commit
+  work_stem = stem if job is None else "{0}_{1}".format(stem, job.tag)
+  processed_dir = hmt_store.local_path(os.path.join(lidar_dir, data_block, 'processed'))  # local mirror of a remote block
+  if window is not None:
+    raw_quad_path = hmt_aoi.clip_raster(raw_quad_path, window, os.path.join(processed_dir, "{0}.vrt".format(stem)))  # The stages read the window only
+    logger.info("  Window {0}".format(window))
+  logger.info("  Reading {0}".format(raw_quad_path))
   
-    #ppserver.print_stats()  # print stats
+  # Get the filesize
+  quad_filesize = hmt_store.get_size(raw_quad_path)
+  logger.info("  Filesize: {1} MB".format(quad, quad_filesize['MB']))
   
-    # close out of Parallel Python server
-    ppserver.destroy()
-    sys.exit(1)
+  # Statewide source grids (served from shared memory when data_processor published them)
+  tss_path, mhhw_path, hmt_incriment_mhhw_path, hmt_incriment_navd88_path = source_grid_paths(data_dir)
+  mllw_path = hmt_formats.find_raster(tidaldatums_dir, "mllw_merged_epsg2992_filled_invdist")  # MLLW source grid
   
-  # Loop through each quad, this could be easily parallelized
-  for quad in lidar_quads:
-    logger.info("Working on quad: {0}".format(quad))
-    
-    # Filepaths for rasters
-    raw_quad_path = os.path.join(LIDAR_DIR, data_block, 'raw', quad)  # This holds the full path to the LIDAR dataset
-    processed_quad_path = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_belowHMT.img".format(quad))  # This holds the full path to the output LIDAR dataset
-    assert(os.path.exists(raw_quad_path)), "The path for quad {0} does not exist!:\r\n  {1}".format(quad, quad_path)  # Test to make sure quad_path exists
-    lidar_paths_full.append(raw_quad_path)
+  # Output files, in the pipeline-wide output format
+  lidar_in_mhhw_path = hmt_formats.raster_path(processed_dir, "{0}_lidar_in_mhhw".format(work_stem))
+  binary_raster_path_mhhw = hmt_formats.raster_path(processed_dir, "{0}_HMT_binary_via_MHHW".format(work_stem))
+  binary_raster_path_navd = hmt_formats.raster_path(processed_dir, "{0}_HMT_binary_via_NAVD88".format(work_stem))
+  
+  # Block indexes (per-block min / max) of the LIDAR quad and of the quad in MHHW datum. The raw quad's index is
+  # built once and reused by later runs; the MHHW one is recorded while the conversion writes the quad.
+  with timer.stage('block_index', outputs=[os.path.join(processed_dir, "{0}_raw.blockindex.npz".format(stem))]) as record:
+    raw_quad_index = hmt_blocks.get_block_index(raw_quad_path, index_path=os.path.join(processed_dir, "{0}_raw.blockindex.npz".format(stem)), blocksize=blocksize)
+    record.update(hmt_costs.quad_features(raw_quad_path, raw_quad_index))  # calibrates the cost model of later runs
+  lidar_in_mhhw_index_path = hmt_blocks.block_index_path(lidar_in_mhhw_path)
+  
+  if same_crs_fast_path is True and hmt_gdal.datasets_share_crs(raw_quad_path, tss_path, mhhw_path, hmt_incriment_mhhw_path, hmt_incriment_navd88_path):
+    ##
+    # Same CRS: sample the statewide grids in memory inside the block loops instead of warping them to the quad
+    ##
+    logger.info("  ################### Converting NAVD88 to MHHW datum (sampling TSS / MHHW grids) ###################")
+    with timer.stage('convert', outputs=[lidar_in_mhhw_path]):
+      lidar_in_mhhw_path = hmt.convert_navd88_to_tidal_sampled(raw_quad_path, tss_path, mhhw_path, lidar_in_mhhw_path, blocksize=blocksize, block_index_path=lidar_in_mhhw_index_path)
+    logger.info("  ####### done.")
     
-    # Get the filesize
-    quad_filesize = gm_fs.get_size(raw_quad_path)
-    logger.info("  Filesize: {1} MB".format(quad, quad_filesize['MB']))
+    logger.info("  ################### Processing binary raster based on MHHW incriment (sampling HMT grid) ###################")
+    with timer.stage('binary_mhhw', outputs=[binary_raster_path_mhhw]):
+      binary_raster_path_mhhw = hmt.hmt_tile_binary_processor_sampledHMT(lidar_in_mhhw_path, hmt_incriment_mhhw_path, binary_raster_path_mhhw, blocksize=blocksize, block_index=lidar_in_mhhw_index_path)
+    logger.info("  ####### done.")
     
+    logger.info("  ################### Processing binary raster based on NAVD88 (sampling HMT grid) ###################")
+    with timer.stage('binary_navd88', outputs=[binary_raster_path_navd]):
+      binary_raster_path_navd = hmt.hmt_tile_binary_processor_sampledHMT(raw_quad_path, hmt_incriment_navd88_path, binary_raster_path_navd, blocksize=blocksize, block_index=raw_quad_index)
+    logger.info("  ####### done.")
+  else:
     ##
-    # TIDAL conversion grid work
+    # TIDAL conversion and HMT grid work
     ##
-    logger.info("  ################### Reprojecting / resampling tidal conversion quads to match LIDAR tiles ###################")
+    logger.info("  ################### Reprojecting / resampling tidal conversion and HMT quads to match LIDAR tiles ###################")
     # Paths
-    tss_path = os.path.join(TIDALDATUMS_DIR, "tss_merged_epsg2992_filled_invdist.img")  # TSS source grid
-    mhhw_path = os.path.join(TIDALDATUMS_DIR, "mhhw_merged_epsg2992_filled_invdist.img")  # MHHW source grid
-    mllw_path = os.path.join(TIDALDATUMS_DIR, "mllw_merged_epsg2992_filled_invdist.img")  # MLLW source grid
-    processed_tss_quad_path = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_tss_conversion.img".format(quad))  # Output file
-    processed_mhhw_quad_path = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_mhhw_conversion.img".format(quad))  # Output file
-    processed_mllw_quad_path = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_mllw_conversion.img".format(quad))  # Output file
-    # Work
-    logger.info("  Reshaping TSS Quad")
-    processed_tss_quad_path = hmt.reproject_dataset_to_quad(tss_path, raw_quad_path, processed_tss_quad_path, band=1, respample_method=gdal.GRA_Bilinear, maxmem=500, output_driver="HFA")  # Do the work
-    #tss_tile = processed_tss_quad_path
-    logger.info("    done.")
-    logger.info("  Reshaping MHHW Quad")
-    processed_mhhw_quad_path = hmt.reproject_dataset_to_quad(mhhw_path, raw_quad_path, processed_mhhw_quad_path, band=1, respample_method=gdal.GRA_Bilinear, maxmem=500, output_driver="HFA")  # Do the work
-    #mhhw_tile = processed_mhhw_quad_path
+    processed_tss_quad_path = hmt_formats.raster_path(processed_dir, "{0}_tss_conversion".format(work_stem))  # Output file
+    processed_mhhw_quad_path = hmt_formats.raster_path(processed_dir, "{0}_mhhw_conversion".format(work_stem))  # Output file
+    processed_mllw_quad_path = hmt_formats.raster_path(processed_dir, "{0}_mllw_conversion".format(work_stem))  # Output file
+    hmt_incriment_mhhw_path_quad = hmt_formats.raster_path(processed_dir, "{0}_hmt_incriment_mhhw".format(work_stem))  # Output file
+    hmt_incriment_navd88_path_quad = hmt_formats.raster_path(processed_dir, "{0}_hmt_incriment_navd88".format(work_stem))  # Output file
+    # Work. All four grids are warped in one pass; grids on the same source grid share a stacked warp.
+    logger.info("  Reshaping TSS, MHHW, HMT (in MHHW datum) and HMT (in NAVD88 datum) Quads")
+    src_paths = [tss_path, mhhw_path, hmt_incriment_mhhw_path, hmt_incriment_navd88_path]
+    quad_paths = [processed_tss_quad_path, processed_mhhw_quad_path, hmt_incriment_mhhw_path_quad, hmt_incriment_navd88_path_quad]
+    with timer.stage('warp', outputs=quad_paths):
+      processed_tss_quad_path, processed_mhhw_quad_path, hmt_incriment_mhhw_path_quad, hmt_incriment_navd88_path_quad = hmt.reproject_datasets_to_quad(src_paths, raw_quad_path, quad_paths, band=1, respample_method=gdal.GRA_Bilinear, maxmem=plan.warp_mb)  # Do the work
     logger.info("    done.")
     #logger.info("  Reshaping MLLW Quad")
-    #mllw_tile = hmt.reproject_dataset_to_quad(mllw_path, raw_quad_path, processed_mllw_quad_path, band=1, respample_method=gdal.GRA_Bilinear, maxmem=500, output_driver="HFA")  # Do the work
+    #mllw_tile = hmt.reproject_dataset_to_quad(mllw_path, raw_quad_path, processed_mllw_quad_path, band=1, respample_method=gdal.GRA_Bilinear, maxmem=500)  # Do the work
     #logger.info("    done.")
     logger.info("  ####### done.")
     
@@ -177,34 +220,22 @@ def data_processor(name, data_block, lidar_quads, small=False, parallel=False):
     # Convert LIDAR data to MHHW datum
     ##
     logger.info("  ################### Converting NAVD88 to MHHW datum using mhhw_tile ###################")
-    lidar_in_mhhw_path = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_lidar_in_mhhw.img".format(quad))  # Output file
-    lidar_in_mhhw_path = hmt.convert_navd88_to_tidal(raw_quad_path, processed_tss_quad_path, processed_mhhw_quad_path, lidar_in_mhhw_path)
+    with timer.stage('convert', outputs=[lidar_in_mhhw_path]):
+      lidar_in_mhhw_path = hmt.convert_navd88_to_tidal(raw_quad_path, processed_tss_quad_path, processed_mhhw_quad_path, lidar_in_mhhw_path, blocksize=blocksize, block_index_path=lidar_in_mhhw_index_path)
     logger.info(" done.")
     logger.info("  Deleting TSS conversion quad raster...")
-    gdal.GetDriverByName("HFA").Delete(processed_tss_quad_path)  # Delete the raster
+    hmt_formats.delete(processed_tss_quad_path)  # Delete the raster
     logger.info("  done.")
     logger.info("  Deleting MHHW conversion quad raster...")
-    gdal.GetDriverByName("HFA").Delete(processed_mhhw_quad_path)  # Delete the raster
+    hmt_formats.delete(processed_mhhw_quad_path)  # Delete the raster
     logger.info("  done.")
     logger.info("  ####### done.")
     
-    logger.info("  ################### Reshaping HMT (in MHHW datum) to match LIDAR quad ###################")
-    hmt_incriment_mhhw_path = os.path.join(TIDALINCRIMENT_DIR, 'dlcd_hmt_mhhw_invdist.img')
-    hmt_incriment_mhhw_path_quad = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_hmt_incriment_mhhw.img".format(quad))  # Output file
-    hmt_incriment_mhhw_path_quad = hmt.reproject_dataset_to_quad(hmt_incriment_mhhw_path, raw_quad_path, hmt_incriment_mhhw_path_quad, band=1, respample_method=gdal.GRA_Bilinear, maxmem=500, output_driver="HFA")  # Do the work
-    logger.info("  ####### done.")
-    
-    logger.info("  ################### Reshaping HMT (in NAVD88 datum) to match LIDAR quad ###################")
-    hmt_incriment_navd88_path = os.path.join(TIDALINCRIMENT_DIR, 'dlcd_hmt_mhhw_nearest.img')
-    hmt_incriment_navd88_path_quad = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_hmt_incriment_navd88.img".format(quad))  # Output file
-    hmt_incriment_navd88_path_quad = hmt.reproject_dataset_to_quad(hmt_incriment_navd88_path, raw_quad_path, hmt_incriment_navd88_path_quad, band=1, respample_method=gdal.GRA_Bilinear, maxmem=500, output_driver="HFA")  # Do the work
-    logger.info("  ####### done.")
-    
     ##
     # Convert LIDAR data to MLLW datum
     ##
     #logger.info("  ################### Converting NAVD88 to MLLW datum using mllw_tile ###################")
-    #lidar_in_mllw_path = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_lidar_in_mllw.img".format(quad))  # Output file
+    #lidar_in_mllw_path = hmt_formats.raster_path(processed_dir, "{0}_lidar_in_mllw".format(stem))  # Output file
     #lidar_in_mllw_path = hmt.convert_navd88_to_tidal(raw_quad_path, tss_tile, mllw_tile, lidar_in_mllw_path)
     #logger.info(" done.")
     #logger.info("  ####### done.")
@@ -213,16 +244,10 @@ def data_processor(name, data_block, lidar_quads, small=False, parallel=False):
     # Process raster to binary below HMT / above HMT raster via MHHW incriment
     ##
     logger.info("  ################### Processing binary raster based on MHHW incriment ###################")
-    binary_raster_path_mhhw = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_HMT_binary_via_MHHW.img".format(quad))                     # Output file
-    binary_raster_path_mhhw = hmt.hmt_tile_binary_processor_griddedHMT(lidar_in_mhhw_path, hmt_incriment_mhhw_path_quad, binary_raster_path_mhhw)   # Create binary raster
-    output_vector_path_mhhw = os.path.join(LIDAR_DIR, data_block, 'shp', "{0}_belowHMT_viaMHHW.shp".format(quad))                              # Vector filepath
-    if os.path.exists(output_vector_path_mhhw): ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(output_vector_path_mhhw)                # Delete if exists
-    output_vector_path_mhhw = hmt.binary_raster_to_vector(binary_raster_path_mhhw, output_vector_path_mhhw, driver="ESRI Shapefile")           # Create shapefile from binary raster
-    logger.info("  Deleting binary raster...")
-    gdal.GetDriverByName("HFA").Delete(binary_raster_path_mhhw)  # Delete the binary raster
-    logger.info("  done.")
+    with timer.stage('binary_mhhw', outputs=[binary_raster_path_mhhw]):
+      binary_raster_path_mhhw = hmt.hmt_tile_binary_processor_griddedHMT(lidar_in_mhhw_path, hmt_incriment_mhhw_path_quad, binary_raster_path_mhhw, blocksize=blocksize, block_index=lidar_in_mhhw_index_path)   # Create binary raster
     logger.info("  Deleting HMT incriment raster...")
-    gdal.GetDriverByName("HFA").Delete(hmt_incriment_mhhw_path_quad)  # Delete the raster
+    hmt_formats.delete(hmt_incriment_mhhw_path_quad)  # Delete the raster
     logger.info("  done.")
     logger.info("  ####### done.")
     
@@ -230,45 +255,196 @@ def data_processor(name, data_block, lidar_quads, small=False, parallel=False):
     # Process raster to binary below HMT / above HMT raster via MLLW incriment
     ##
     #logger.info("  ################### Processing binary raster based on MLLW incriment ###################")
-    #binary_raster_path_mllw = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_HMT_binary_via_MLLW.img".format(quad))            # Output file
+    #binary_raster_path_mllw = hmt_formats.raster_path(processed_dir, "{0}_HMT_binary_via_MLLW".format(stem))          # Output file
     #binary_raster_path_mllw = hmt.hmt_tile_binary_processor(lidar_in_mllw_path, 11.62, binary_raster_path_mllw)                         # Create binary raster
-    #output_vector_path_mllw = os.path.join(LIDAR_DIR, data_block, 'shp', "{0}_belowHMT_viaMLLW.shp".format(quad))                     # Vector filepath
-    #if os.path.exists(output_vector_path_mllw): ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(output_vector_path_mllw)       # Delete if exists
-    #output_vector_path_mllw = hmt.binary_raster_to_vector(binary_raster_path_mhhw, output_vector_path_mllw, driver="ESRI Shapefile")  # Create shapefile from binary raster
-    #logger.info("  Deleting binary raster...")
-    #gdal.GetDriverByName("HFA").Delete(binary_raster_path_mllw)  # Delete the binary raster
-    #logger.info("  done.")
-    #logger.info("  ####### done.")
-    
     
     ##
     # Process raster to binary below HMT / above HMT raster via NAVD88 incriment
     ##
     logger.info("  ################### Processing binary raster based on NAVD88 ###################")
-    binary_raster_path_navd = os.path.join(LIDAR_DIR, data_block, 'processed', "{0}_HMT_binary_via_NAVD88.img".format(quad))          # Output file
-    binary_raster_path_navd = hmt.hmt_tile_binary_processor_griddedHMT(raw_quad_path, hmt_incriment_navd88_path_quad, binary_raster_path_navd)                              # Create binary raster
-    output_vector_path_navd = os.path.join(LIDAR_DIR, data_block, 'shp', "{0}_belowHMT_viaNAVD88.shp".format(quad))                   # Vector filepath
-    if os.path.exists(output_vector_path_navd): ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(output_vector_path_navd)       # Delete if exists
-    output_vector_path_navd = hmt.binary_raster_to_vector(binary_raster_path_navd, output_vector_path_navd, driver="ESRI Shapefile")  # Create shapefile from binary raster
-    logger.info("  Deleting binary raster...")
-    gdal.GetDriverByName("HFA").Delete(binary_raster_path_navd)  # Delete the binary raster
-    logger.info("  done.")
+    with timer.stage('binary_navd88', outputs=[binary_raster_path_navd]):
+      binary_raster_path_navd = hmt.hmt_tile_binary_processor_griddedHMT(raw_quad_path, hmt_incriment_navd88_path_quad, binary_raster_path_navd, blocksize=blocksize, block_index=raw_quad_index)  # Create binary raster
     logger.info("  Deleting HMT incriment raster...")
-    gdal.GetDriverByName("HFA").Delete(hmt_incriment_navd88_path_quad)  # Delete the raster
+    hmt_formats.delete(hmt_incriment_navd88_path_quad)  # Delete the raster
     logger.info("  done.")
     logger.info("  ####### done.")
+  
+  ##
+  # Convert the binary rasters to vectors
+  ##
+  if job is not None: job.check_lease()  # a retry may own the job by now; it writes the final outputs then
+  logger.info("  ################### Vectorizing binary raster based on MHHW incriment ###################")
+  output_vector_path_mhhw = hmt_store.local_path(os.path.join(lidar_dir, data_block, 'shp', "{0}_belowHMT_viaMHHW.shp".format(work_stem)))                              # Vector filepath
+  if os.path.exists(output_vector_path_mhhw): ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(output_vector_path_mhhw)                # Delete if exists
+  with timer.stage('polygonize', outputs=[output_vector_path_mhhw]):
+    output_vector_path_mhhw = hmt.binary_raster_to_vector(binary_raster_path_mhhw, output_vector_path_mhhw, driver="ESRI Shapefile")         # Create shapefile from binary raster
+  logger.info("  Deleting binary raster...")
+  hmt_formats.delete(binary_raster_path_mhhw)  # Delete the binary raster
+  logger.info("  done.")
+  logger.info("  ####### done.")
+  
+  logger.info("  ################### Vectorizing binary raster based on NAVD88 ###################")
+  output_vector_path_navd = hmt_store.local_path(os.path.join(lidar_dir, data_block, 'shp', "{0}_belowHMT_viaNAVD88.shp".format(work_stem)))                   # Vector filepath
+  if os.path.exists(output_vector_path_navd): ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(output_vector_path_navd)       # Delete if exists
+  with timer.stage('polygonize', outputs=[output_vector_path_navd]):
+    output_vector_path_navd = hmt.binary_raster_to_vector(binary_raster_path_navd, output_vector_path_navd, driver="ESRI Shapefile")  # Create shapefile from binary raster
+  logger.info("  Deleting binary raster...")
+  hmt_formats.delete(binary_raster_path_navd)  # Delete the binary raster
+  logger.info("  done.")
+  logger.info("  ####### done.")
+  
+  if job is not None:
+    # Rename this attempt's outputs into place when the queue records its result (see hmt_processor.workqueue)
+    final_paths = [hmt_formats.raster_path(processed_dir, "{0}_lidar_in_mhhw".format(stem)),
+                   hmt_store.local_path(os.path.join(lidar_dir, data_block, 'shp', "{0}_belowHMT_viaMHHW.shp".format(stem))),
+                   hmt_store.local_path(os.path.join(lidar_dir, data_block, 'shp', "{0}_belowHMT_viaNAVD88.shp".format(stem)))]
+    job.on_commit(hmt_formats.rename, lidar_in_mhhw_path, final_paths[0])
+    job.on_commit(rename_shapefile, output_vector_path_mhhw, final_paths[1])
+    job.on_commit(rename_shapefile, output_vector_path_navd, final_paths[2])
+    job.on_commit(remove_attempt_outputs, [processed_dir, os.path.dirname(final_paths[1])], stem, job.job_id)
+    lidar_in_mhhw_path, output_vector_path_mhhw, output_vector_path_navd = final_paths
+  
+  logger.info(" done.")
+  hmt_trace.flush()  # pool workers exit without running atexit handlers
+  return {'quad': quad, 'shapefiles': [output_vector_path_mhhw, output_vector_path_navd], 'stages': timer.records}
+
+def data_processor(name, data_block, lidar_quads=None, small=False, parallel=False, same_crs_fast_path=True, workers=None, data_dir=None, backend=None, metrics_path=METRICS_PATH, trace_path=None, memory_mb=None, status_path=STATUS_PATH, status_port=None, aoi=None, queue_path=None):
+  """
+  Process data for the estuary
+  
+  lidar_quads are the quads of data_block to run, every quad in the catalog (see hmt_processor.catalog, updated
+  first) by default. aoi (a hmt_processor.aoi.AOI, a 'minx,miny,maxx,maxy' box in the quads' CRS or a polygon
+  file) keeps the quads whose footprint intersects it, found through the catalog's R-tree, and clips each to the
+  window covering its part of the AOI; the outputs are named <quad>_<AOI name>.
+  
+  When the LIDAR quads and the statewide grids share a CRS (same_crs_fast_path=True) the grids are sampled
+  in memory by the processors instead of being warped to a full resolution copy of each quad.
+  
+  Quads are independent jobs. parallel=True runs them on `workers` processes (all CPUs by default); backend
+  selects the scheduler backend (see hmt_processor.scheduler). backend='queue' submits the quads to the SQLite
+  work queue at queue_path (HMT_QUEUE or logs/hmt_queue.sqlite) as queue <run>, so hmt_worker.py processes on
+  other hosts sharing the project directory can help with them. data_dir overrides PROJECT_DIR/data; it may be an
+  s3:// URI, in which case the outputs are written to its local mirror (see hmt_processor.objectstore).
+  Stage metrics are appended to the JSON-lines file metrics_path (None to disable) and summarised at the end.
+  trace_path writes a Chrome trace of every block's read / compute / write spans (see hmt_processor.tracing).
+  memory_mb is the memory budget of the whole run (HMT_MEMORY_MB or half the physical memory by default); it
+  is split across the workers, after taking out the shared grids of the fast path, and sets their GDAL cache, warp
+  memory, block size and how many quads run at once (see hmt_processor.memory).
+  Quads run longest first by the cost model calibrated from metrics_path; progress (quads done, pixels/s, ETA)
+  is written to status_path and, when status_port is set, served at http://127.0.0.1:<status_port>/.
+  Returns the quad_processor() result of each quad.
+  """
+  
+  hmt_runtime.configure()  # does nothing if the caller already configured this process
+  logger.info("Welcome to the {0} data processor!".format(name))
+  
+  if parallel is True:
+    if workers is None: workers = multiprocessing.cpu_count()
+  else:
+    workers = 1
+  
+  # Split the memory budget across the workers, using the tuned settings (autotune.py) where they fit
+  profile = hmt_autotune.load_profile() or {}
+  if profile: logger.info("Using tuned profile {0}".format(hmt_autotune.profile_path()))
+  plan = hmt_memory.MemoryBudget(memory_mb).plan(workers, profile=profile)
+  if plan.workers < workers: logger.warn("Reducing workers from {0} to {1} to fit the memory budget".format(workers, plan.workers))
+  workers = plan.workers
+  logger.info(hmt_memory.describe(plan))
+  
+  # Bring the catalog of the block up to date; it lists the quads and holds their sizes
+  lidar_dir = data_paths(data_dir)[0]
+  catalog = hmt_catalog.open_catalog(lidar_dir, blocks=[data_block], workers=workers)
+  if lidar_quads is None:
+    lidar_quads = catalog.quads(data_block)
+  entries = [catalog.entry(data_block, quad) for quad in lidar_quads]
+  windows = [None]*len(lidar_quads)
+  tag = None
+  if aoi is not None:
+    # Only the quads that intersect the AOI, each clipped to its part of it
+    aoi = hmt_aoi.parse(aoi)
+    selected = set(entry['quad'] for entry in aoi.select(catalog, blocks=[data_block]))
+    entries = [entry for quad, entry in zip(lidar_quads, entries) if quad in selected]
+    windows = [aoi.window(entry) for entry in entries]
+    entries = [entry for entry, window in zip(entries, windows) if window is not None]
+    windows = [window for window in windows if window is not None]
+    lidar_quads = [entry['quad'] for entry in entries]
+    tag = aoi.name
+    logger.info("AOI {0} intersects {1} quads of {2}: {3}".format(aoi.name, len(lidar_quads), data_block, ', '.join(lidar_quads)))
+  catalog.close()
+  
+  # Limit the number of tiles to two if we don't want to do the full run
+  if small is True:
+    lidar_quads = lidar_quads[0:1]
+    entries = entries[0:1]
+    windows = windows[0:1]
+    logger.warn("Restricting lidar quads to the first item in list")
+  
+  # Each quad is a job
+  run = "{0}-{1}".format(name, time.strftime('%Y%m%dT%H%M%S'))
+  raw_quad_paths = [hmt_ingest.source_path(os.path.join(lidar_dir, data_block, 'raw', quad)) for quad in lidar_quads]
+  
+  # Decode the statewide grids once, covering just these quads, into shared memory the workers map (same-CRS fast path).
+  # The files live in RAM, so they come out of the workers' budget; the parent's GDAL cache is emptied of the grids' blocks.
+  shared_grids = ()
+  cache_max = gdal.GetCacheMax()
+  progress = None
+  try:
+    grid_paths = source_grid_paths(data_dir)
+    if same_crs_fast_path is True and lidar_quads and hmt_gdal.datasets_share_crs(raw_quad_paths[0], *grid_paths):
+      bounds = (min(entry['minx'] for entry in entries), max(entry['maxx'] for entry in entries),
+                min(entry['miny'] for entry in entries), max(entry['maxy'] for entry in entries))
+      shared_grids = tuple(hmt_shared.publish(grid_paths, bounds=bounds))
+      gdal.SetCacheMax(0)  # flushes the cached blocks of the grids
+      gdal.SetCacheMax(cache_max)
+      shared_mb = int(math.ceil(hmt_shared.size_mb(shared_grids)))
+      plan = hmt_memory.MemoryBudget(max(hmt_memory.MIN_WORKER_MB, plan.total_mb - shared_mb)).plan(workers, profile=profile)
+      if plan.workers < workers: logger.warn("Reducing workers from {0} to {1} to fit the memory budget".format(workers, plan.workers))
+      workers = plan.workers
+      logger.info("{0} MB of shared grids leaves {1}".format(shared_mb, hmt_memory.describe(plan)))
     
-    # Clean up and exit
-    #output_quads.append(binary_raster_path)
-    #output_shps.append(vector_path)
+    # Predict each quad's cost (from its block index if an earlier run built one) and run the longest first
+    cost_model = hmt_costs.CostModel.from_metrics(metrics_path)
+    features = [hmt_costs.quad_features(raw_quad_path, hmt_blocks.get_block_index(raw_quad_path, blocksize=plan.blocksize, build=False,
+                                                                                index_path=hmt_store.local_path(os.path.join(lidar_dir, data_block, 'processed', "{0}_raw.blockindex.npz".format(quad)))), entry=entry)
+                if window is None else hmt_costs.window_features(entry, window)
+                for quad, raw_quad_path, entry, window in zip(lidar_quads, raw_quad_paths, entries, windows)]
+    costs = [cost_model.predict(quad_features) for quad_features in features]
+    order = hmt_costs.lpt_order(costs)
+    logger.info("Predicted {0:.0f} quad-seconds of work ({1} calibration samples)".format(sum(costs), cost_model.samples))
     
-    logger.info(" done.")
-  # Done
+    jobs = [(data_block, lidar_quads[job_n], data_dir, same_crs_fast_path, metrics_path, run, plan, windows[job_n], tag) for job_n in order]
+    job_mb = [hmt_memory.estimate_job_mb(plan, raster_bytes=features[job_n]['file_mb']*1000000) for job_n in order]
+    progress = hmt_costs.Progress(run, [lidar_quads[job_n] for job_n in order], [costs[job_n] for job_n in order],
+                                  [features[job_n]['valid_pixels'] for job_n in order], workers=workers, status_path=status_path, http_port=status_port)
+    if trace_path is not None:
+      trace_events_path = trace_path + ".events"
+      if os.path.exists(trace_events_path): os.remove(trace_events_path)
+      hmt_trace.enable(trace_events_path)  # before the workers start so they inherit it
+    worker_runtime = hmt_runtime.current().for_worker(workers, cache_mb=plan.cache_mb, num_threads=profile.get('num_threads'))  # each worker's share of cores and cache
+    
+    worker_runtime.shared_grids = shared_grids
+    
+    results = hmt_scheduler.run_jobs(quad_processor, jobs, workers=workers, backend=backend, job_mb=job_mb, memory_mb=plan.total_mb,
+                                     initializer=hmt_runtime.configure_worker, initargs=(worker_runtime,),
+                                     on_done=lambda job_n, result: progress.finished(job_n), queue_path=queue_path, queue_name=run)
+  finally:
+    if progress is not None: progress.close()
+    hmt_shared.release(shared_grids)
+  results = [result for job_n, result in sorted(zip(order, results))]  # back in lidar_quads order
+  if trace_path is not None:
+    hmt_trace.disable()
+    hmt_trace.write_chrome_trace(trace_events_path, trace_path)
+  
+  hmt_metrics.log_summary([record for result in results for record in result['stages']], title="Stage summary for run {0}:".format(run))
+  
+  return results
   
 if __name__ == '__main__':
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
   # Each quad takes about 30 minutes (2012-06-05) on the old MacBook Pro (2.6 GHz Intel Core 2 Duo, 4gb 667 MHz DDR2 RAM)
-  data_processor("SSNERR", 'SSNERR_LIDAR', ['be42124d3', 'be43124b2', 'be43124c1', 'be43124c2', 'be43124c3', 'be43124d1', 'be43124d2', 'be43124d3','be43124e3','be43124e2'], small=False)
-  data_processor("Nehalem", 'Neh_LIDAR', ['be45123f8', 'be45123f7', 'be45123g7b'], small=False)
-  #data_processor("Tillamook", 'Till_LIDAR', ['be45123e8', 'be45123e7', 'be45123d8', 'be45123d7', 'be45123d6'], small=False)
+  # The quads of each block come from the catalog (data/LIDAR/hmt_catalog.sqlite, see catalog_lidar.py)
+  data_processor("SSNERR", 'SSNERR_LIDAR', small=False, data_dir=DATA_DIR)
+  data_processor("Nehalem", 'Neh_LIDAR', small=False, data_dir=DATA_DIR)
+  #data_processor("Tillamook", 'Till_LIDAR', small=False)
   #logging.warn("Enable one of the processors above.")
   pass
\ No newline at end of file
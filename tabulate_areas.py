@@ -24,20 +24,11 @@ import sys
 import os
 import pprint
 import csv
+import time
 
 # Import and configure logging
 import logging
 logger = logging.getLogger('hmt_processor')
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-fhnd = logging.FileHandler('logs/tabulate_areas.log')
-fhnd.setLevel(logging.DEBUG)
-fhnd.setFormatter(formatter)
-logger.addHandler(fhnd)
 
 
 # Import Numpy
@@ -54,19 +45,20 @@ from gmtools import geospatial as gm_gdal
 
 # Import HMT specific packages
 from hmt_processor import processors as hmt
-
-# Fix osgeo error reporting
-gdal.UseExceptions()
-ogr.UseExceptions()
-osr.UseExceptions()
-
-# Set gdal configuration parameters
-gdal.SetCacheMax(2147483648)  # 2 GB. This sets the caching max size for gdal. Bigger number can lead to faster reads / writes
-gdal.SetConfigOption('HFA_USE_RRD', 'YES')  # Configure GDAL to use blocks
+from hmt_processor import metrics as hmt_metrics
+from hmt_processor import runtime as hmt_runtime
+from hmt_processor import catalog as hmt_catalog
+from hmt_processor import aoi as hmt_aoi
 
 # get a reference to the path that holds this file
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Log file of the tabulator
+LOG_PATH = os.path.join(PROJECT_DIR, 'logs', 'tabulate_areas.log')
+
+# Stage metrics of every run (JSON lines, see hmt_processor.metrics)
+METRICS_PATH = os.path.join(PROJECT_DIR, 'logs', 'hmt_metrics.jsonl')
+
 # File folders that break up LIDAR tiles
 SITE_BLOCKS = ['Neh_LIDAR', 'SSNERR_LIDAR', 'Till_LIDAR']
 
@@ -74,24 +66,42 @@ SITE_BLOCKS = ['Neh_LIDAR', 'SSNERR_LIDAR', 'Till_LIDAR']
 def dissolve_polygons():
   pass
 
-def data_area_tabulator(name, output_csv_path, data_block, quads, simplify_tollerance=0, small=False):
+def data_area_tabulator(name, output_csv_path, data_block, quads=None, simplify_tollerance=0, small=False, project_dir=None, metrics_path=METRICS_PATH, aoi=None):
   """
+  Dissolve the below HMT shapefiles of the quads (every catalogued quad of data_block by default) and tabulate their area.
+  
+  With aoi (see process_tiles.data_processor) the quads default to those intersecting it, their <quad>_<AOI name>
+  shapefiles are read and the dissolved polygons are clipped to the AOI before their area is taken.
   
+  Reads data/LIDAR and writes to output/ under project_dir, PROJECT_DIR by default. Stage metrics are appended to
+  the JSON-lines file metrics_path (None to disable) and summarised at the end.
   """
+  if project_dir is None: project_dir = PROJECT_DIR
+  timer = hmt_metrics.StageTimer(log_path=metrics_path, run="{0}-tabulate-{1}".format(name, time.strftime('%Y%m%dT%H%M%S')))
+  hmt_runtime.configure()  # does nothing if the caller already configured this process
   logger.info("Welcome to the {0} area tabulator!".format(name))
+  if aoi is not None:
+    aoi = hmt_aoi.parse(aoi)
+  if quads is None:
+    catalog = hmt_catalog.open_catalog(os.path.join(project_dir, 'data', 'LIDAR'), blocks=[data_block])
+    if aoi is None:
+      quads = catalog.quads(data_block)
+    else:
+      quads = [entry['quad'] for entry in aoi.select(catalog, blocks=[data_block])]
+    catalog.close()
   logger.warn("  simplify tollerance is set to {0}".format(simplify_tollerance))
   
   # CSV setup
-  output_csv = csv.writer(open(os.path.join(PROJECT_DIR, 'output', output_csv_path), 'w'))  # Setup the CSV writer
+  output_csv = csv.writer(open(os.path.join(project_dir, 'output', output_csv_path), 'w'))  # Setup the CSV writer
   output_csv.writerow(['block_name', 'quad', 'datum', 'area_under_HMT_sqft'])  # Write Column Headings
   
   shp_driver = ogr.GetDriverByName("ESRI Shapefile")
   
-  output_filepath_mhhw = os.path.join(PROJECT_DIR, 'output', "{0}_merged_areas_viaMHHW.shp".format(name))
+  output_filepath_mhhw = os.path.join(project_dir, 'output', "{0}_merged_areas_viaMHHW.shp".format(name))
   if os.path.exists(output_filepath_mhhw): shp_driver.DeleteDataSource(output_filepath_mhhw)
   ds_mhhw = shp_driver.CreateDataSource( output_filepath_mhhw )
   
-  output_filepath_navd88 = os.path.join(PROJECT_DIR, 'output', "{0}_merged_areas_viaNAVD88.shp".format(name))
+  output_filepath_navd88 = os.path.join(project_dir, 'output', "{0}_merged_areas_viaNAVD88.shp".format(name))
   if os.path.exists(output_filepath_navd88): shp_driver.DeleteDataSource(output_filepath_navd88)
   ds_navd88 = shp_driver.CreateDataSource( output_filepath_navd88 )
   
@@ -111,105 +121,120 @@ def data_area_tabulator(name, output_csv_path, data_block, quads, simplify_tolle
   
   # Loop through each quad
   for quad in quads:
-    # Folder to shapefiles
-    quad_shp_folder_path = os.path.join(PROJECT_DIR, 'data', 'LIDAR', data_block, 'shp')
+    stem = quad if aoi is None else "{0}_{1}".format(quad, aoi.name)  # Name of the quad's outputs
+    with timer.stage('read_shapefiles', quad=quad):
+      # Folder to shapefiles
+      quad_shp_folder_path = os.path.join(project_dir, 'data', 'LIDAR', data_block, 'shp')
     
-    # HMT via vertical datums
-    quad_shp_path_viaMHHW = os.path.join(quad_shp_folder_path, "{0}_belowHMT_viaMHHW.shp".format(quad))
-    quad_shp_path_viaNAVD88 = os.path.join(quad_shp_folder_path, "{0}_belowHMT_viaNAVD88.shp".format(quad))
+      # HMT via vertical datums
+      quad_shp_path_viaMHHW = os.path.join(quad_shp_folder_path, "{0}_belowHMT_viaMHHW.shp".format(stem))
+      quad_shp_path_viaNAVD88 = os.path.join(quad_shp_folder_path, "{0}_belowHMT_viaNAVD88.shp".format(stem))
     
-    # Make sure that the shapefile exists. If it doesn't throw a warning and move to the next quad
-    if os.path.exists(quad_shp_path_viaMHHW) is False:
-      logger.error("The HMT shapefile (via MHHW) for quad {0} doesn't exist! Skipping!".format(quad))
-      continue
+      # Make sure that the shapefile exists. If it doesn't throw a warning and move to the next quad
+      if os.path.exists(quad_shp_path_viaMHHW) is False:
+        logger.error("The HMT shapefile (via MHHW) for quad {0} doesn't exist! Skipping!".format(quad))
+        continue
     
-    # Make sure that the shapefile exists. If it doesn't throw a warning and move to the next quad
-    if os.path.exists(quad_shp_path_viaNAVD88) is False:
-      logger.error("The HMT shapefile (via NAVD88) for quad {0} doesn't exist! Skipping!".format(quad))
-      continue
+      # Make sure that the shapefile exists. If it doesn't throw a warning and move to the next quad
+      if os.path.exists(quad_shp_path_viaNAVD88) is False:
+        logger.error("The HMT shapefile (via NAVD88) for quad {0} doesn't exist! Skipping!".format(quad))
+        continue
     
-    # Open the shapefile using OGR
-    quad_vect_fp_mhhw = ogr.Open(quad_shp_path_viaMHHW)
-    if quad_vect_fp_mhhw is None:
-      logger.error("Could not open shapefile: {0}".format(quad_shp_path_viaMHHW))
-      continue
+      # Open the shapefile using OGR
+      quad_vect_fp_mhhw = ogr.Open(quad_shp_path_viaMHHW)
+      if quad_vect_fp_mhhw is None:
+        logger.error("Could not open shapefile: {0}".format(quad_shp_path_viaMHHW))
+        continue
     
-    # Open the shapefile using OGR
-    quad_vect_fp_navd88 = ogr.Open(quad_shp_path_viaNAVD88)
-    if quad_vect_fp_navd88 is None:
-      logger.error("Could not open shapefile: {0}".format(quad_shp_path_viaNAVD88))
-      continue
+      # Open the shapefile using OGR
+      quad_vect_fp_navd88 = ogr.Open(quad_shp_path_viaNAVD88)
+      if quad_vect_fp_navd88 is None:
+        logger.error("Could not open shapefile: {0}".format(quad_shp_path_viaNAVD88))
+        continue
     
-    quad_vect_driver_mhhw = quad_vect_fp_mhhw.GetDriver()
-    quad_vect_layer_mhhw = quad_vect_fp_mhhw.GetLayer()
-    feat_defn_mhhw = quad_vect_layer_mhhw.GetLayerDefn()
+      quad_vect_driver_mhhw = quad_vect_fp_mhhw.GetDriver()
+      quad_vect_layer_mhhw = quad_vect_fp_mhhw.GetLayer()
+      feat_defn_mhhw = quad_vect_layer_mhhw.GetLayerDefn()
     
-    quad_vect_driver_navd88 = quad_vect_fp_navd88.GetDriver()
-    quad_vect_layer_navd88 = quad_vect_fp_navd88.GetLayer()
-    feat_defn_navd88 = quad_vect_layer_navd88.GetLayerDefn()
+      quad_vect_driver_navd88 = quad_vect_fp_navd88.GetDriver()
+      quad_vect_layer_navd88 = quad_vect_fp_navd88.GetLayer()
+      feat_defn_navd88 = quad_vect_layer_navd88.GetLayerDefn()
     
-    logger.info("  Looping through MHHW features...")
-    # Loop through each feature in the layer in the MHHW layer
-    for feature in quad_vect_layer_mhhw:
-      geom = feature.GetGeometryRef().Simplify(simplify_tollerance)
-      geom_to_merge_mhhw.AddGeometry(geom)
-    logger.info("    done.")
+      logger.info("  Looping through MHHW features...")
+      # Loop through each feature in the layer in the MHHW layer
+      for feature in quad_vect_layer_mhhw:
+        geom = feature.GetGeometryRef().Simplify(simplify_tollerance)
+        geom_to_merge_mhhw.AddGeometry(geom)
+      logger.info("    done.")
     
-    logger.info("  Looping through NAVD88 features...")
-    # Loop through each feature in the layer in the NAVD88 layer
-    for feature in quad_vect_layer_navd88:
-      geom = feature.GetGeometryRef().Simplify(simplify_tollerance)
-      geom_to_merge_navd88.AddGeometry(geom)
-    logger.info("    done.")
+      logger.info("  Looping through NAVD88 features...")
+      # Loop through each feature in the layer in the NAVD88 layer
+      for feature in quad_vect_layer_navd88:
+        geom = feature.GetGeometryRef().Simplify(simplify_tollerance)
+        geom_to_merge_navd88.AddGeometry(geom)
+      logger.info("    done.")
       
-  # This dissolves the overlapping regions of polygon components
-  logger.info("  Dissolving MHHW features...")
-  gb_mhhw = geom_to_merge_mhhw.Buffer(0)
-  logger.info("    done.")
-  
-  # This dissolves the overlapping regions of polygon components
-  logger.info("  Dissolving NAVD88 features...")
-  gb_navd88 = geom_to_merge_navd88.Buffer(0)
-  logger.info("    done.")
-  
-  logger.info("  Creating NA feature...")
-  layerDefinition_mhhw = layer_mhhw.GetLayerDefn()
-  layerDefinition_navd88 = layer_navd88.GetLayerDefn()
-  
-  feature_mhhw = ogr.Feature(layerDefinition_mhhw)
-  feature_mhhw.SetField( "belowHMT", "Yes" )
-  feature_mhhw.SetGeometry(gb_mhhw)
-  layer_mhhw.CreateFeature(feature_mhhw)
-  feature_mhhw.Destroy()
-  
-  feature_navd88 = ogr.Feature(layerDefinition_navd88)
-  feature_navd88.SetField( "belowHMT", "Yes" )
-  feature_navd88.SetGeometry(gb_navd88)
-  layer_navd88.CreateFeature(feature_navd88)
-  feature_navd88.Destroy()
-  
-  logger.info("  done.")
-  
-  # Get area of dissolved shapefile
-  new_area_mhhw = gb_mhhw.GetArea()
-  
-  # Get area of dissolved shapefile
-  new_area_navd88 = gb_navd88.GetArea()
-  
-  # Write output to CSV
-  output_csv.writerow([name, 'MHHW', new_area_mhhw])  # Write Column Headings
-  output_csv.writerow([name, 'NAVD88', new_area_navd88])  # Write Column Headings
+  with timer.stage('dissolve'):
+    # This dissolves the overlapping regions of polygon components
+    logger.info("  Dissolving MHHW features...")
+    gb_mhhw = geom_to_merge_mhhw.Buffer(0)
+    logger.info("    done.")
   
+    # This dissolves the overlapping regions of polygon components
+    logger.info("  Dissolving NAVD88 features...")
+    gb_navd88 = geom_to_merge_navd88.Buffer(0)
+    logger.info("    done.")
+    
+    if aoi is not None:
+      # The windows of the quads cover the bounding box of the AOI; keep what is inside the AOI itself
+      logger.info("  Clipping to AOI {0}...".format(aoi.name))
+      aoi_geometry = aoi.geometry_in(spatialReference.ExportToWkt())
+      gb_mhhw = gb_mhhw.Intersection(aoi_geometry)
+      gb_navd88 = gb_navd88.Intersection(aoi_geometry)
+      logger.info("    done.")
+  
+  with timer.stage('write', outputs=[output_filepath_mhhw, output_filepath_navd88]):
+    logger.info("  Creating NA feature...")
+    layerDefinition_mhhw = layer_mhhw.GetLayerDefn()
+    layerDefinition_navd88 = layer_navd88.GetLayerDefn()
+  
+    feature_mhhw = ogr.Feature(layerDefinition_mhhw)
+    feature_mhhw.SetField( "belowHMT", "Yes" )
+    feature_mhhw.SetGeometry(gb_mhhw)
+    layer_mhhw.CreateFeature(feature_mhhw)
+    feature_mhhw.Destroy()
+  
+    feature_navd88 = ogr.Feature(layerDefinition_navd88)
+    feature_navd88.SetField( "belowHMT", "Yes" )
+    feature_navd88.SetGeometry(gb_navd88)
+    layer_navd88.CreateFeature(feature_navd88)
+    feature_navd88.Destroy()
+  
+    logger.info("  done.")
+  
+    # Get area of dissolved shapefile
+    new_area_mhhw = gb_mhhw.GetArea()
+  
+    # Get area of dissolved shapefile
+    new_area_navd88 = gb_navd88.GetArea()
+  
+    # Write output to CSV
+    output_csv.writerow([name, 'MHHW', new_area_mhhw])  # Write Column Headings
+    output_csv.writerow([name, 'NAVD88', new_area_navd88])  # Write Column Headings
+  
+  hmt_metrics.log_summary(timer.records)
   return output_csv_path
 
 if __name__ == '__main__':
   """
   blah
   """
+  hmt_runtime.Runtime(log_path=LOG_PATH).configure()
   
   # Each quad takes about 30 minutes (2012-06-05) on the old MacBook Pro (2.6 GHz Intel Core 2 Duo, 4gb 667 MHz DDR2 RAM)
-  data_area_tabulator("SSNERR", "SSNERR_areas.csv", 'SSNERR_LIDAR', ['be42124d3', 'be43124b2', 'be43124c1', 'be43124c2', 'be43124c3', 'be43124d1', 'be43124d2', 'be43124d3','be43124e3','be43124e2'], small=False)
-  data_area_tabulator("Nehalem", "Nehalem_areas.csv", 'Neh_LIDAR', ['be45123f8', 'be45123f7', 'be45123g7b'], small=False)
-  #data_area_tabulator("Tillamook", "Tillamook_areas.csv", 'Till_LIDAR', ['be45123e8', 'be45123e7', 'be45123d8', 'be45123d7', 'be45123d6'], small=False)
+  # The quads of each block come from the catalog (data/LIDAR/hmt_catalog.sqlite, see catalog_lidar.py)
+  data_area_tabulator("SSNERR", "SSNERR_areas.csv", 'SSNERR_LIDAR', small=False)
+  data_area_tabulator("Nehalem", "Nehalem_areas.csv", 'Neh_LIDAR', small=False)
+  #data_area_tabulator("Tillamook", "Tillamook_areas.csv", 'Till_LIDAR', small=False)
   #logging.warn("Enable one of the processors above.")
   pass
\ No newline at end of file
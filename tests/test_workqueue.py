@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2012 Michael Ewald, Geomatics Research. <michael.ewald@geomaticsresearch.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial
+portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+IN THE SOFTWARE.
+
+Tests of the SQLite work queue with local worker processes: lease expiry and retry, and attempt fencing of
+results and outputs.
+
+  python -m unittest discover tests
+"""
+
+# Import core modules
+import sys
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hmt_processor import workqueue as hmt_workqueue
+
+# How long the first attempt of a job hangs (the test kills or outlives it)
+HANG_SECONDS = 30
+
+
+def write_output(output_dir, value, first_attempt_seconds):
+  """ A job that writes its output under its attempt's name and publishes it on commit """
+  job = hmt_workqueue.current_job()
+  if job.attempt == 1:
+    time.sleep(first_attempt_seconds)
+  job.check_lease()
+  staged_path = os.path.join(output_dir, "output_{0}".format(job.tag))
+  with open(staged_path, 'w') as output_file:
+    output_file.write("{0} attempt {1}".format(value, job.attempt))
+  job.on_commit(os.rename, staged_path, os.path.join(output_dir, 'output'))
+  return (value, job.attempt)
+
+
+def run_worker(queue_path, lease_seconds, heartbeat_seconds):
+  hmt_workqueue.work(queue_path, lease_seconds=lease_seconds, heartbeat_seconds=heartbeat_seconds, poll_seconds=0.1)
+
+
+def start_worker(queue_path, lease_seconds, heartbeat_seconds):
+  worker = multiprocessing.Process(target=run_worker, args=(queue_path, lease_seconds, heartbeat_seconds))
+  worker.start()
+  return worker
+
+
+class WorkQueueTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.queue_path = os.path.join(self.directory, 'queue.sqlite')
+    self.queue = hmt_workqueue.WorkQueue(self.queue_path)
+
+  def tearDown(self):
+    self.queue.close()
+    shutil.rmtree(self.directory)
+
+  def wait_for_status(self, job_id, status, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      if self.queue.jobs([job_id])[job_id][0] == status:
+        return
+      time.sleep(0.1)
+    self.fail("job {0} never became {1}".format(job_id, status))
+
+  def attempts(self, job_id):
+    return self.queue.connection.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+  def test_killed_worker_is_retried_after_lease_expiry(self):
+    job_id, = self.queue.submit('run', write_output, [(self.directory, 'quad', HANG_SECONDS)])
+    first = start_worker(self.queue_path, 1.0, 0.2)
+    self.wait_for_status(job_id, hmt_workqueue.RUNNING)
+    first.terminate()  # dies holding the lease
+    first.join()
+    
+    second = start_worker(self.queue_path, 1.0, 0.2)
+    self.assertEqual(self.queue.wait([job_id], poll_seconds=0.1), [('quad', 2)])
+    second.join(20)
+    self.assertEqual(self.attempts(job_id), 2)
+    self.assertEqual(open(os.path.join(self.directory, 'output')).read(), "quad attempt 2")
+
+  def test_worker_that_lost_its_lease_publishes_nothing(self):
+    job_id, = self.queue.submit('run', write_output, [(self.directory, 'quad', 3)])
+    stale = start_worker(self.queue_path, 0.5, 60)  # never heartbeats in time, so its lease runs out
+    self.wait_for_status(job_id, hmt_workqueue.RUNNING)
+    retry = start_worker(self.queue_path, 5.0, 0.5)
+    self.assertEqual(self.queue.wait([job_id], poll_seconds=0.1), [('quad', 2)])
+    stale.join(20)
+    retry.join(20)
+    self.assertEqual(open(os.path.join(self.directory, 'output')).read(), "quad attempt 2")
+    self.assertFalse(os.path.exists(os.path.join(self.directory, "output_job{0}a1".format(job_id))))  # stopped at check_lease()
+
+  def test_stale_complete_is_rejected(self):
+    job_id, = self.queue.submit('run', write_output, [(self.directory, 'quad', 0)])
+    stale = self.queue.claim('stale', lease_seconds=0.2)
+    time.sleep(0.4)
+    retry = self.queue.claim('retry', lease_seconds=60)
+    self.assertEqual((stale['attempt'], retry['attempt']), (1, 2))
+    
+    published = list()
+    self.assertFalse(self.queue.complete(job_id, 'stale', 1, 'stale result', on_commit=[lambda: published.append('stale')]))
+    self.assertFalse(self.queue.heartbeat(job_id, 'stale', 1))
+    self.assertFalse(self.queue.fail(job_id, 'stale', 1, 'stale error'))
+    self.assertTrue(self.queue.complete(job_id, 'retry', 2, 'retry result', on_commit=[lambda: published.append('retry')]))
+    self.assertEqual(published, ['retry'])
+    self.assertEqual(self.queue.jobs([job_id])[job_id], (hmt_workqueue.DONE, 'retry result', None))
+
+  def test_resubmitting_a_key_keeps_the_job(self):
+    first = self.queue.submit('run', write_output, [(self.directory, 'a', 0)], keys=['quad'])
+    again = self.queue.submit('run', write_output, [(self.directory, 'b', 0)], keys=['quad'])
+    self.assertEqual(first, again)
+    self.assertEqual(self.queue.counts('run'), {hmt_workqueue.PENDING: 1})
+
+
+if __name__ == '__main__':
+  unittest.main()